@@ -0,0 +1,452 @@
+import errno
+import heapq
+import os
+import select
+import socket
+import threading
+import time
+import traceback
+import urllib
+from collections import deque
+
+#
+# An event driven HTTP server for the Flask app in server.py, selected with
+# --engine async.
+#
+# The Flask development server uses a thread per request, so every client
+# waiting in a long poll or reading a message stream holds a thread. Here all
+# connections are handled by one thread running an event loop (using epoll
+# where available, otherwise poll). Requests are dispatched to the same Flask
+# routes, so the API and wire format are identical, but a route that needs to
+# wait for messages returns a Wait instead of blocking. The connection is then
+# parked: it costs a callback registered with the user (see User.addWaiter) and
+# a timer, and is resumed when a message is queued or the timeout passes.
+#
+# Connections are kept alive between requests (HTTP/1.1), and streamed
+# responses are sent with chunked encoding.
+#
+# NOTE: Routes run on the event loop thread, including waiting for storage to
+#       commit, so a slow disk slows every connection down. Waiting clients
+#       don't, which is what this is for.
+#
+
+# The most bytes of request line and headers we accept
+MAX_HEADER_BYTES = 64 * 1024
+
+# How many connections may be waiting to be accepted
+LISTEN_BACKLOG = 1024
+
+# A point where a request (or a stream) waits until a message is queued for
+# user, or until timeout seconds pass. If then is given it is called once the
+# wait is over to carry on with the request. Using the threaded engine the
+# wait just blocks (see block), with this engine it parks the connection.
+class Wait(object):
+    def __init__(self, user, timeout, then=None):
+        self.user = user
+        self.timeout = timeout
+        self.then = then
+
+    # wait on the current thread
+    def block(self):
+        self.user.waitForMessages(self.timeout)
+
+# Polls sockets for readiness using epoll, or poll where there is no epoll.
+# Both take the same event flags.
+class Poller(object):
+    READ = select.POLLIN
+    WRITE = select.POLLOUT
+    ERROR = select.POLLERR | select.POLLHUP
+
+    def __init__(self):
+        if hasattr(select, 'epoll'):
+            self.poller = select.epoll()
+            self.scale = 1.0
+        else:
+            self.poller = select.poll()
+            self.scale = 1000.0
+
+    def register(self, fd, events):
+        self.poller.register(fd, events)
+
+    def modify(self, fd, events):
+        self.poller.modify(fd, events)
+
+    def unregister(self, fd):
+        self.poller.unregister(fd)
+
+    # the (fd, events) pairs that are ready, waiting at most timeout seconds
+    def poll(self, timeout):
+        try:
+            return self.poller.poll(timeout * self.scale)
+        except (IOError, OSError, select.error) as e:
+            if e.args[0] == errno.EINTR:
+                return []
+            raise
+
+# The event loop. Runs callbacks when their socket is ready, when their timer
+# is due, or when they are scheduled with callSoon (which can be done from any
+# thread).
+class Loop(object):
+    def __init__(self):
+        self.poller = Poller()
+        self.handlers = {}
+        # (due, sequence, callback) entries, callback is None once cancelled
+        self.timers = []
+        self.sequence = 0
+        self.ready = deque()
+        self.thread = None
+
+        # written to by callSoon to wake the loop from another thread
+        self.wakeRead, self.wakeWrite = os.pipe()
+        self.add(self.wakeRead, Poller.READ, self.drainWake)
+
+    # call handler(events) whenever fd is ready for any of events
+    def add(self, fd, events, handler):
+        self.handlers[fd] = handler
+        self.poller.register(fd, events)
+
+    def modify(self, fd, events):
+        self.poller.modify(fd, events)
+
+    def remove(self, fd):
+        self.handlers.pop(fd, None)
+        self.poller.unregister(fd)
+
+    # call callback on the loop thread as soon as possible
+    def callSoon(self, callback):
+        self.ready.append(callback)
+        if threading.current_thread() is not self.thread:
+            os.write(self.wakeWrite, 'x')
+
+    # call callback after delay seconds. Returns the timer, for cancel.
+    def callLater(self, delay, callback):
+        self.sequence += 1
+        timer = [time.time() + delay, self.sequence, callback]
+        heapq.heappush(self.timers, timer)
+        return timer
+
+    def cancel(self, timer):
+        timer[2] = None
+
+    def drainWake(self, events):
+        os.read(self.wakeRead, 4096)
+
+    # run forever
+    def run(self):
+        self.thread = threading.current_thread()
+        while True:
+            timeout = 1.0
+            if self.ready:
+                timeout = 0
+            elif self.timers:
+                timeout = max(0, min(timeout, self.timers[0][0] - time.time()))
+
+            for fd, events in self.poller.poll(timeout):
+                handler = self.handlers.get(fd)
+                if handler is not None:
+                    handler(events)
+
+            now = time.time()
+            while self.timers and self.timers[0][0] <= now:
+                _, _, callback = heapq.heappop(self.timers)
+                if callback is not None:
+                    self.ready.append(callback)
+
+            for _ in xrange(len(self.ready)):
+                self.ready.popleft()()
+
+# Parks until a message is queued for wait.user or wait.timeout passes, then
+# calls resume once. Returns a function that cancels the wait.
+def park(loop, wait, resume):
+    state = {'done': False, 'timer': None}
+
+    def wake():
+        if state['done']:
+            return
+        state['done'] = True
+        wait.user.removeWaiter(queued)
+        loop.cancel(state['timer'])
+        resume()
+
+    # called with the user's lock held, possibly on another thread
+    def queued():
+        loop.callSoon(wake)
+
+    def cancel():
+        state['done'] = True
+        wait.user.removeWaiter(queued)
+        loop.cancel(state['timer'])
+
+    state['timer'] = loop.callLater(wait.timeout, wake)
+    wait.user.addWaiter(queued)
+    if wait.user.hasMessages():
+        loop.callSoon(wake)
+    return cancel
+
+# A client connection. Requests are read and answered one at a time, in the
+# order they arrive.
+class Connection(object):
+    def __init__(self, server, sock):
+        self.server = server
+        self.loop = server.loop
+        self.sock = sock
+        self.fd = sock.fileno()
+        self.input = ''
+        self.output = []
+        self.requests = deque()
+        # the request being answered, whether to close once it has been, the
+        # body of a streamed response and how to cancel a parked wait
+        self.busy = False
+        self.closeAfter = False
+        self.stream = None
+        self.cancelWait = None
+        # set once the client has sent something we can't answer
+        self.failed = False
+        self.closed = False
+        self.loop.add(self.fd, Poller.READ, self.ready)
+
+    def ready(self, events):
+        if events & Poller.READ:
+            self.read()
+        if events & Poller.WRITE and not self.closed:
+            self.flush()
+        if events & Poller.ERROR and not self.closed:
+            self.close()
+
+    def read(self):
+        try:
+            data = self.sock.recv(65536)
+        except socket.error as e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ''
+        if not data:
+            self.close()
+            return
+        if self.failed:
+            return
+
+        self.input += data
+        while self.parse():
+            pass
+        self.next()
+
+    # parse one complete request from the input, returning whether there was
+    # one
+    def parse(self):
+        end = self.input.find('\r\n\r\n')
+        if end < 0:
+            if len(self.input) > MAX_HEADER_BYTES:
+                self.fail('431 Request Header Fields Too Large')
+            return False
+
+        lines = self.input[:end].split('\r\n')
+        try:
+            method, target, version = lines[0].split(' ', 2)
+        except ValueError:
+            self.fail('400 Bad Request')
+            return False
+        headers = {}
+        for line in lines[1:]:
+            name, _, value = line.partition(':')
+            headers[name.strip().lower()] = value.strip()
+
+        if 'chunked' in headers.get('transfer-encoding', '').lower():
+            self.fail('411 Length Required')
+            return False
+        try:
+            length = int(headers.get('content-length', 0))
+        except ValueError:
+            self.fail('400 Bad Request')
+            return False
+        if len(self.input) < end + 4 + length:
+            return False
+
+        body = self.input[end + 4:end + 4 + length]
+        self.input = self.input[end + 4 + length:]
+
+        connection = headers.get('connection', '').lower()
+        if version == 'HTTP/1.1':
+            keepAlive = connection != 'close'
+        else:
+            keepAlive = connection == 'keep-alive'
+        self.requests.append((method, target, headers, body, keepAlive))
+        return True
+
+    # answer the next request, unless we are still answering one
+    def next(self):
+        if self.busy or self.closed or not self.requests:
+            return
+        method, target, headers, body, keepAlive = self.requests.popleft()
+        self.busy = True
+        self.closeAfter = not keepAlive
+        self.respond(self.server.dispatch(method, target, headers, body))
+
+    # send a Flask response, parking first if it is waiting for messages
+    def respond(self, response):
+        wait = getattr(response, 'wait', None)
+        if wait is not None:
+            self.cancelWait = park(self.loop, wait,
+                                   lambda: self.respond(self.server.resume(wait)))
+            return
+        self.cancelWait = None
+
+        head = ['HTTP/1.1 %s' % response.status]
+        for name, value in response.headers:
+            if name.lower() not in ('content-length', 'transfer-encoding', 'connection'):
+                # Werkzeug may give us unicode, which mustn't meet the body
+                head.append(('%s: %s' % (name, value)).encode('latin-1'))
+        if self.closeAfter:
+            head.append('Connection: close')
+
+        if response.is_streamed:
+            head.append('Transfer-Encoding: chunked')
+            self.write('\r\n'.join(head) + '\r\n\r\n')
+            self.stream = (response, iter(response.response))
+            self.pump()
+        else:
+            body = response.get_data()
+            head.append('Content-Length: %d' % len(body))
+            self.write('\r\n'.join(head) + '\r\n\r\n' + body)
+            response.close()
+            self.finish()
+
+    # send the body of a streamed response until it ends or waits
+    def pump(self):
+        self.cancelWait = None
+        response, body = self.stream
+        while not self.closed:
+            try:
+                item = next(body)
+            except StopIteration:
+                self.write('0\r\n\r\n')
+                break
+            except Exception:
+                # the response has already started, all we can do is drop it
+                traceback.print_exc()
+                self.closeAfter = True
+                break
+            if isinstance(item, Wait):
+                self.cancelWait = park(self.loop, item, self.pump)
+                return
+            if item:
+                self.write('%x\r\n%s\r\n' % (len(item), item))
+
+        response.close()
+        self.stream = None
+        self.finish()
+
+    # the current request has been answered
+    def finish(self):
+        self.busy = False
+        if self.closeAfter:
+            if not self.output:
+                self.close()
+            return
+        self.next()
+
+    # respond with an error and close the connection
+    def fail(self, status):
+        self.failed = True
+        self.input = ''
+        self.requests.clear()
+        self.closeAfter = True
+        if not self.busy:
+            self.write('HTTP/1.1 %s\r\nContent-Length: 0\r\nConnection: close\r\n\r\n' % status)
+
+    def write(self, data):
+        self.output.append(data)
+        self.flush()
+
+    # send as much of the output as the socket will take, and poll for
+    # writability while there is more
+    def flush(self):
+        while self.output:
+            try:
+                sent = self.sock.send(self.output[0])
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    break
+                self.close()
+                return
+            if sent < len(self.output[0]):
+                self.output[0] = self.output[0][sent:]
+                break
+            self.output.pop(0)
+
+        if self.output:
+            self.loop.modify(self.fd, Poller.READ | Poller.WRITE)
+        else:
+            self.loop.modify(self.fd, Poller.READ)
+            if self.closeAfter and not self.busy:
+                self.close()
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        if self.cancelWait is not None:
+            self.cancelWait()
+        if self.stream is not None:
+            self.stream[0].close()
+            self.stream = None
+        self.loop.remove(self.fd)
+        self.sock.close()
+
+# Accepts connections and dispatches their requests to a Flask app.
+class AsyncServer(object):
+    def __init__(self, app, host, port):
+        self.app = app
+        self.loop = Loop()
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(LISTEN_BACKLOG)
+        self.sock.setblocking(False)
+        self.loop.add(self.sock.fileno(), Poller.READ, self.accept)
+
+    def accept(self, events):
+        while True:
+            try:
+                sock, _ = self.sock.accept()
+            except socket.error as e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK, errno.ECONNABORTED):
+                    return
+                raise
+            sock.setblocking(False)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            Connection(self, sock)
+
+    # run a request through the Flask app, returning its response
+    def dispatch(self, method, target, headers, body):
+        path, _, query = target.partition('?')
+        with self.app.test_request_context(urllib.unquote(path), method=method,
+                                           query_string=query, data=body, headers=headers,
+                                           content_type=headers.get('content-type')):
+            try:
+                return self.app.full_dispatch_request()
+            except Exception as e:
+                return self.error(e)
+
+    # carry on with a request that was waiting, returning its response
+    def resume(self, wait):
+        try:
+            return self.app.make_response(wait.then())
+        except Exception as e:
+            return self.error(e)
+
+    def error(self, e):
+        traceback.print_exc()
+        return self.app.response_class('Internal Server Error', status=500)
+
+    def run(self):
+        self.loop.run()
+
+# serve app on host and port until interrupted
+def serve(app, host, port):
+    server = AsyncServer(app, host, port)
+    print " * Running on http://%s:%d/ (async engine)" % (host, port)
+    try:
+        server.run()
+    except KeyboardInterrupt:
+        pass
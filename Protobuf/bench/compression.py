@@ -0,0 +1,159 @@
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from build.protobufs import response_pb2 as ResponseProtoBuf
+from compression import compress, decompress
+from model import User, UserList, Group, GroupList, DirectMessage, GroupMessage, MessageList
+
+#
+# Measures how many bytes compression and the sender dictionary save on
+# MessageLists, and what they cost in CPU time (see compression.py and
+# MessageList.indexSenders).
+#
+# For each workload we queue messages for a user and fetch them as one
+# MessageList of each size, encoded each way:
+#
+#   plain        - as the server sends it to a client that asks for nothing
+#   dictionary   - with the dictionary parameter
+#   gzip-<level> - plain, compressed at that zlib level (the server uses
+#                  level 1, see compression.LEVEL)
+#   dict+gzip-1  - both
+#
+# For each we print the bytes sent, how that compares to plain, the server's
+# time to encode and compress the list, and the client's time to decompress,
+# parse it and put the senders back.
+#
+# Run from anywhere with
+#
+#   python bench/compression.py
+#   python bench/compression.py --sizes 100 1000 --output compression.json
+#
+
+# words the messages are made of
+WORDS = ('the meeting moved to three tomorrow can you bring slides I will be late '
+         'lunch anyone ok sounds good thanks see you there where is the build broken '
+         'again fixed it pushed review please ship').split()
+
+# How each workload's messages are made: (sender count, group message?,
+# words per message)
+WORKLOADS = {
+    'direct': (5, False, 8),
+    'group': (200, True, 8),
+    'long': (5, False, 80),
+}
+
+ENCODINGS = ['plain', 'dictionary', 'gzip-1', 'gzip-6', 'gzip-9', 'dict+gzip-1']
+
+# The longest we spend timing one encoding, see best
+TRIAL_SECONDS = 0.2
+MIN_TRIALS = 3
+
+# the serialized messages queued for a user, size of them in the given
+# workload
+def queuedMessages(workload, size, rng):
+    senderCount, toGroup, words = WORKLOADS[workload]
+    users = UserList()
+    recipient = User('recipient')
+    senders = [User('sender%d' % i) for i in xrange(senderCount)]
+    for user in [recipient] + senders:
+        users.addUser(user)
+    group = Group('team')
+    GroupList().addGroup(group)
+    for i in xrange(size):
+        text = ' '.join(rng.choice(WORDS) for _ in xrange(words))
+        sender = rng.choice(senders)
+        if toGroup:
+            recipient.queueMessage(GroupMessage(sender, group, text))
+        else:
+            recipient.queueMessage(DirectMessage(sender, recipient, text))
+    return recipient.undeliveredMessages.take()
+
+# Returns (server, client) functions for an encoding: server makes the bytes
+# sent from the serialized messages, and client turns them back into a
+# MessageList
+def codec(encoding):
+    dictionary = encoding.startswith('dict')
+    level = int(encoding.rsplit('-', 1)[1]) if 'gzip' in encoding else None
+
+    def server(messages):
+        encoded = MessageList.encode(messages, 0, dictionary)
+        return compress(encoded, 'gzip', level) if level else encoded
+
+    def client(body):
+        if level:
+            body = decompress(body, 'gzip', len(body) * 1000)
+        messages = ResponseProtoBuf.MessageList()
+        messages.ParseFromString(body)
+        expandSenders(messages)
+        return messages
+    return server, client
+
+# Puts the sender back in each message of a MessageList fetched with the
+# dictionary parameter, which sends each sender once in the list's senders
+# rather than in every message
+def expandSenders(messages):
+    for message in messages.messages:
+        if message.HasField('sender'):
+            message.frm.CopyFrom(messages.senders[message.sender])
+            message.ClearField('sender')
+    del messages.senders[:]
+
+# the fastest time f takes, in seconds
+def best(f, *args):
+    times = []
+    started = time.time()
+    while len(times) < MIN_TRIALS or time.time() - started < TRIAL_SECONDS:
+        start = time.time()
+        f(*args)
+        times.append(time.time() - start)
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Measure the bytes compression saves on message lists, and its cost')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 1000],
+                        help='the numbers of messages per list (default: %(default)s)')
+    parser.add_argument('--output', help='also write the results here as JSON')
+    args = parser.parse_args()
+
+    rng = random.Random(262)
+    results = {}
+    for workload in sorted(WORKLOADS):
+        for size in args.sizes:
+            messages = queuedMessages(workload, size, rng)
+            expected = None
+            print '%s, %d messages' % (workload, size)
+            print '  %-12s %10s %7s %12s %12s' % ('', 'bytes', 'saved', 'server', 'client')
+            for encoding in ENCODINGS:
+                server, client = codec(encoding)
+                body = server(messages)
+                decoded = client(body)
+                if expected is None:
+                    expected = decoded
+                assert decoded == expected, encoding
+                plain = results.get((workload, size, 'plain'), {}).get('bytes', len(body))
+
+                result = {
+                    'bytes': len(body),
+                    'saved': 1 - float(len(body)) / plain,
+                    'serverSeconds': best(server, messages),
+                    'clientSeconds': best(client, body),
+                }
+                results[workload, size, encoding] = result
+                print '  %-12s %10d %6.1f%% %10.3fms %10.3fms' % (
+                    encoding, result['bytes'], result['saved'] * 100,
+                    result['serverSeconds'] * 1000, result['clientSeconds'] * 1000)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(dict(('%s/%d/%s' % key, result) for key, result in results.items()),
+                      f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
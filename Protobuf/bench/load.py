@@ -0,0 +1,288 @@
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from build.protobufs import request_pb2 as RequestProtoBuf
+from router import waitForPort
+
+#
+# Drives a chat server with a mix of requests and reports the throughput and
+# latency of each endpoint, and how much memory the server used.
+#
+# The server is started as a subprocess (server.py, with --engine), or in this
+# process with --in-process, or not at all with --url to load a server that is
+# already running (a sharded one behind router.py, say). We create the users
+# and the groups, with sizes drawn from --group-sizes:
+#
+#   fixed    - every group has --group-size members
+#   uniform  - between 2 and --group-size members
+#   zipf     - the nth largest group has --group-size / n members, so a few
+#              large groups and many small ones
+#
+# then client processes send requests for --seconds, each picking what to do
+# at random in proportion to the weights --dm, --gm, --poll and --list:
+#
+#   dm    - POST /v1/users/<user>/messages
+#   gm    - POST /v1/groups/<group>/messages
+#   poll  - GET /v1/users/<user>/messages (without waiting)
+#   list  - GET /v1/users?q=<prefix>*
+#
+# The results are written as JSON (to --output, or printed), with the git
+# revision they were measured at. Pass an earlier result as --compare to see
+# what changed, we exit with status 1 if any endpoint's p99 latency or
+# throughput got more than --tolerance worse.
+#
+# Run from anywhere with
+#
+#   python bench/load.py --users 1000 --groups 100 --clients 4 --seconds 10
+#
+
+ENDPOINTS = ['dm', 'gm', 'poll', 'list']
+GROUP_SIZES = ['fixed', 'uniform', 'zipf']
+
+# the most operations we put in one setup batch, see MAX_BATCH_SIZE in server.py
+SETUP_BATCH_SIZE = 1000
+
+# the resident set size, and the most it has been, of a process in bytes
+# (Linux only)
+def residentBytes(pid):
+    sizes = {}
+    with open('/proc/%d/status' % pid) as f:
+        for line in f:
+            if line.startswith(('VmRSS:', 'VmHWM:')):
+                name, kb, _ = line.split()
+                sizes[name[:-1]] = int(kb) * 1024
+    return sizes['VmRSS'], sizes['VmHWM']
+
+# the git revision being measured, if there is one
+def revision():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                           stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# the value below which a fraction q of the ordered samples fall
+def percentile(ordered, q):
+    return ordered[min(len(ordered) - 1, int(len(ordered) * q))]
+
+# the size of each group
+def groupSizes(distribution, count, size, rng):
+    if distribution == 'fixed':
+        return [size] * count
+    elif distribution == 'uniform':
+        return [rng.randint(2, max(2, size)) for _ in xrange(count)]
+    return [max(2, size / (n + 1)) for n in xrange(count)]
+
+# Creates the users and the groups with their members, a batch at a time
+def setUp(base, usernames, groupnames, sizes, rng):
+    Operation = RequestProtoBuf.Operation
+    operations = [Operation(type=Operation.CREATE_USER, username=username)
+                  for username in usernames]
+    for groupname, size in zip(groupnames, sizes):
+        operations.append(Operation(type=Operation.CREATE_GROUP, groupname=groupname))
+        for username in rng.sample(usernames, min(size, len(usernames))):
+            operations.append(Operation(type=Operation.ADD_MEMBER, groupname=groupname,
+                                        username=username))
+
+    session = requests.Session()
+    for start in xrange(0, len(operations), SETUP_BATCH_SIZE):
+        batch = RequestProtoBuf.Batch()
+        batch.operations.extend(operations[start:start + SETUP_BATCH_SIZE])
+        session.post(base + '/batch', data=batch.SerializeToString()).raise_for_status()
+
+# Sends requests from one client until deadline, returning the latency of each
+# (in seconds) and the number of errors, per endpoint
+def runClient(args):
+    base, usernames, groupnames, weights, deadline, seed = args
+    rng = random.Random(seed)
+    session = requests.Session()
+    latencies = dict((endpoint, []) for endpoint in ENDPOINTS)
+    errors = dict((endpoint, 0) for endpoint in ENDPOINTS)
+    choices = [endpoint for endpoint in ENDPOINTS for _ in xrange(weights[endpoint])]
+
+    while time.time() < deadline:
+        endpoint = rng.choice(choices)
+        if endpoint == 'dm':
+            message = RequestProtoBuf.Message(frm=rng.choice(usernames), msg='hello')
+            method, url, data = 'POST', '/users/%s/messages' % rng.choice(usernames), \
+                message.SerializeToString()
+        elif endpoint == 'gm':
+            message = RequestProtoBuf.Message(frm=rng.choice(usernames), msg='hello all')
+            method, url, data = 'POST', '/groups/%s/messages' % rng.choice(groupnames), \
+                message.SerializeToString()
+        elif endpoint == 'poll':
+            method, url, data = 'GET', '/users/%s/messages' % rng.choice(usernames), None
+        else:
+            method, url, data = 'GET', '/users?q=user%d*' % rng.randint(1, 9), None
+
+        start = time.time()
+        r = session.request(method, base + url, data=data)
+        latencies[endpoint].append(time.time() - start)
+        if r.status_code != 200:
+            errors[endpoint] += 1
+    return latencies, errors
+
+# Runs the server in this process, in a thread
+def serveInProcess(host, port):
+    from werkzeug.serving import make_server
+    import server
+    # don't log every request
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    httpd = make_server(host, port, server.app, threaded=True)
+    thread = threading.Thread(target=httpd.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return os.getpid()
+
+# Starts server.py, returning the process
+def serveSubprocess(host, port, engine):
+    here = os.path.dirname(os.path.abspath(__file__))
+    return subprocess.Popen([sys.executable, os.path.join(here, '..', 'server.py'),
+                             '--host', host, '--port', str(port), '--engine', engine],
+                            stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+
+# Summarises the latencies and errors from every client
+def summarise(results, seconds):
+    endpoints = {}
+    for endpoint in ENDPOINTS:
+        ordered = sorted(sample for latencies, _ in results for sample in latencies[endpoint])
+        errors = sum(errors[endpoint] for _, errors in results)
+        if not ordered:
+            continue
+        endpoints[endpoint] = {
+            'requests': len(ordered),
+            'errors': errors,
+            'throughput': len(ordered) / seconds,
+            'mean_ms': 1000 * sum(ordered) / len(ordered),
+            'p50_ms': 1000 * percentile(ordered, 0.5),
+            'p99_ms': 1000 * percentile(ordered, 0.99),
+            'p999_ms': 1000 * percentile(ordered, 0.999),
+        }
+    return endpoints
+
+# Prints how each endpoint changed since an earlier result, returning whether
+# any got more than tolerance worse
+def compare(old, new, tolerance):
+    regressed = False
+    print 'compared with %s' % (old.get('revision') or 'the earlier result')
+    for endpoint in ENDPOINTS:
+        if endpoint not in old['endpoints'] or endpoint not in new['endpoints']:
+            continue
+        before, after = old['endpoints'][endpoint], new['endpoints'][endpoint]
+        throughput = after['throughput'] / before['throughput']
+        p99 = after['p99_ms'] / before['p99_ms']
+        worse = throughput < 1 - tolerance or p99 > 1 + tolerance
+        regressed = regressed or worse
+        print '%-6s throughput %5.2fx  p99 %5.2fx%s' % (endpoint, throughput, p99,
+                                                         '  REGRESSED' if worse else '')
+    return regressed
+
+def main():
+    parser = argparse.ArgumentParser(description='Load the chat server and measure latency')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--groups', type=int, default=100)
+    parser.add_argument('--group-size', type=int, default=20)
+    parser.add_argument('--group-sizes', choices=GROUP_SIZES, default='zipf')
+    for endpoint, weight in zip(ENDPOINTS, [40, 10, 40, 10]):
+        parser.add_argument('--' + endpoint, type=int, default=weight,
+                            help='how often to send %s requests (default: %%(default)s)' % endpoint)
+    parser.add_argument('--clients', type=int, default=4, help='client processes')
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--engine', choices=['threaded', 'async'], default='threaded')
+    parser.add_argument('--in-process', action='store_true',
+                        help='run the server in this process rather than a subprocess')
+    parser.add_argument('--url', help='load a running server instead, e.g. http://host:5000/v1')
+    parser.add_argument('--port', type=int, default=5300)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='write the JSON results here rather than printing them')
+    parser.add_argument('--compare', help='an earlier JSON result to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    args = parser.parse_args()
+
+    weights = dict((endpoint, getattr(args, endpoint)) for endpoint in ENDPOINTS)
+    rng = random.Random(args.seed)
+    usernames = ['user%d' % i for i in xrange(args.users)]
+    groupnames = ['group%d' % i for i in xrange(args.groups)]
+    sizes = groupSizes(args.group_sizes, args.groups, args.group_size, rng)
+
+    # the clients are forked before an in-process server starts its threads
+    pool = multiprocessing.Pool(args.clients)
+    process, pid = None, None
+    if args.url:
+        base = args.url
+    else:
+        base = 'http://127.0.0.1:%d/v1' % args.port
+        if args.in_process:
+            pid = serveInProcess('127.0.0.1', args.port)
+        else:
+            process = serveSubprocess('127.0.0.1', args.port, args.engine)
+            pid = process.pid
+        waitForPort('127.0.0.1', args.port)
+
+    try:
+        setUp(base, usernames, groupnames, sizes, rng)
+        idle = residentBytes(pid)[0] if pid else None
+
+        deadline = time.time() + args.seconds
+        results = pool.map(runClient, [(base, usernames, groupnames, weights, deadline,
+                                        args.seed * 1000 + client)
+                                       for client in xrange(args.clients)])
+        rss, peak = residentBytes(pid) if pid else (None, None)
+    finally:
+        pool.close()
+        pool.join()
+        if process is not None:
+            process.terminate()
+            process.wait()
+
+    endpoints = summarise(results, args.seconds)
+    result = {
+        'revision': revision(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'config': {
+            'users': args.users, 'groups': args.groups, 'group_size': args.group_size,
+            'group_sizes': args.group_sizes, 'members': sum(min(size, args.users) for size in sizes),
+            'weights': weights, 'clients': args.clients, 'seconds': args.seconds,
+            'server': 'external' if args.url else 'in-process' if args.in_process else args.engine,
+        },
+        'endpoints': endpoints,
+        'throughput': sum(e['throughput'] for e in endpoints.values()),
+        'server': {'idle_rss_bytes': idle, 'rss_bytes': rss, 'peak_rss_bytes': peak},
+    }
+
+    print '%-6s %9s %8s %9s %9s %9s %9s' % ('', 'requests', 'errors', 'req/s', 'p50 ms',
+                                           'p99 ms', 'p999 ms')
+    for endpoint in ENDPOINTS:
+        if endpoint in endpoints:
+            e = endpoints[endpoint]
+            print '%-6s %9d %8d %9.0f %9.2f %9.2f %9.2f' % (
+                endpoint, e['requests'], e['errors'], e['throughput'],
+                e['p50_ms'], e['p99_ms'], e['p999_ms'])
+    if rss:
+        print 'server rss %.1f MB (%.1f MB idle, %.1f MB peak)' % (rss / 1e6, idle / 1e6, peak / 1e6)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(result, f, indent=2, sort_keys=True)
+    else:
+        print json.dumps(result, indent=2, sort_keys=True)
+
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(json.load(f), result, args.tolerance):
+                sys.exit(1)
+
+if __name__ == '__main__':
+    main()
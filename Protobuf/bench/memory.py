@@ -0,0 +1,100 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from model import User, UserList, Group, GroupList, DirectMessage, GroupMessage
+
+#
+# Measures how much memory a queued message costs.
+#
+# Each representation is measured in a fresh process: we create the users and
+# groups, note the resident set size, queue the messages and note it again.
+# The difference divided by the number of queued messages is the cost of each.
+#
+#   legacy   - a deque of (time queued, serialized message) pairs per user, how
+#              queues were kept before the arena and ring buffers
+#   compact  - the MessageList queues in model.py
+#
+# Run from anywhere with
+#
+#   python bench/memory.py --users 10000 --messages 100 --groups 100
+#
+
+REPRESENTATIONS = ['legacy', 'compact']
+
+# the resident set size of this process in bytes (Linux only)
+def residentBytes():
+    with open('/proc/self/statm') as f:
+        pages = int(f.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE')
+
+# queues as a deque of (time, serialized message) pairs per user
+class LegacyQueue(object):
+    def __init__(self):
+        self.messages = deque()
+
+    def addMessage(self, message):
+        self.messages.append((time.time(), message.serializeToString()))
+
+# create the users and groups, then queue messagesPerUser direct messages for
+# every user and a message for each group. Returns (bytes used, messages
+# queued).
+def measure(representation, userCount, messagesPerUser, groupCount):
+    users = UserList()
+    groups = GroupList()
+    for i in xrange(userCount):
+        users.addUser(User('user%d' % i))
+        if representation == 'legacy':
+            users.getUser('user%d' % i).undeliveredMessages = LegacyQueue()
+    everyone = users.users.values()
+    for i in xrange(groupCount):
+        group = Group('group%d' % i)
+        groups.addGroup(group)
+        for user in everyone[i::groupCount]:
+            group.addUser(user)
+
+    before = residentBytes()
+    queued = 0
+    for n in xrange(messagesPerUser):
+        for user in everyone:
+            user.queueMessage(DirectMessage(everyone[n % len(everyone)], user,
+                                            'message %d for %s' % (n, user.username)))
+            queued += 1
+    for group in groups.groups.values():
+        group.receiveMessage(GroupMessage(everyone[0], group, 'hello %s' % group.groupname), users)
+        queued += len(group.users)
+    return residentBytes() - before, queued
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure memory per queued message')
+    parser.add_argument('--users', type=int, default=10000)
+    parser.add_argument('--messages', type=int, default=100,
+                        help='direct messages queued for each user')
+    parser.add_argument('--groups', type=int, default=100,
+                        help='groups to spread the users over, each sent one message')
+    parser.add_argument('--run', choices=REPRESENTATIONS, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run:
+        used, queued = measure(args.run, args.users, args.messages, args.groups)
+        print used, queued
+        return
+
+    print '%d users, %d direct messages each, %d groups' % (args.users, args.messages, args.groups)
+    for representation in REPRESENTATIONS:
+        output = subprocess.check_output([sys.executable, os.path.abspath(__file__),
+                                          '--run', representation,
+                                          '--users', str(args.users),
+                                          '--messages', str(args.messages),
+                                          '--groups', str(args.groups)])
+        used, queued = [int(x) for x in output.split()]
+        print '%-8s %10d messages %8.1f MB %6.1f bytes/message' % (
+            representation, queued, used / 1e6, float(used) / queued)
+
+if __name__ == '__main__':
+    main()
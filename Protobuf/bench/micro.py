@@ -0,0 +1,257 @@
+import argparse
+import json
+import math
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from model import User, UserList, Group, GroupList, DirectMessage, GroupMessage
+
+#
+# Microbenchmarks for the model's hot paths, without HTTP in the way.
+#
+# Each benchmark is run at a range of input sizes (the number of queued
+# messages, group members, names or groups) and we print the time per call at
+# each size along with how fast it grows: the exponent k in time ~ size^k
+# between each size and the last. A linear operation shows k near 1, a
+# lookup that shouldn't depend on the size near 0, so an operation that
+# becomes quadratic stands out even when the absolute times are small.
+#
+# Run from anywhere with
+#
+#   python bench/micro.py
+#   python bench/micro.py --max-size 1000000 --only filter
+#   python bench/micro.py --output micro.json
+#
+
+# the input sizes we try, up to --max-size
+SIZES = [1000, 10000, 100000, 1000000]
+
+# The longest we spend timing one benchmark at one size. Each is run at least
+# MIN_TRIALS times and we keep the fastest, which is the one least disturbed
+# by everything else going on.
+TRIAL_SECONDS = 0.5
+MIN_TRIALS = 3
+
+# wildcard queries of different shapes, see index.py
+QUERIES = [
+    ('prefix', 'user12*'),
+    ('infix', '*345*'),
+    ('sparse', 'u*9*8*7'),
+    ('all', '*'),
+    ('none', 'nobody*'),
+]
+
+# A benchmark is a function taking a size, that sets up whatever it needs and
+# returns a trial function. Each call of the trial runs the operation once and
+# returns how long the operation took, so trials can set themselves up again
+# without it being counted.
+BENCHMARKS = []
+
+def benchmark(name):
+    def register(f):
+        BENCHMARKS.append((name, f))
+        return f
+    return register
+
+def makeUsers(count):
+    users = UserList()
+    for i in xrange(count):
+        users.addUser(User('user%d' % i))
+    return users
+
+# lists of users that are only read (or put back as they were), shared between
+# benchmarks as they take a while to build
+_userLists = {}
+
+def sharedUsers(count):
+    if count not in _userLists:
+        _userLists[count] = makeUsers(count)
+    return _userLists[count]
+
+def timed(f, *args):
+    start = time.time()
+    f(*args)
+    return time.time() - start
+
+# a user with size direct messages waiting
+def backlog(size):
+    sender = User('sender')
+    user = makeUsers(1).getUser('user0')
+    for i in xrange(size):
+        user.queueMessage(DirectMessage(sender, user, 'message %d' % i))
+    return user
+
+@benchmark('MessageList.serialize')
+def messageListSerialize(size):
+    queue = backlog(size).undeliveredMessages
+    return lambda: timed(queue.serialize)
+
+@benchmark('User.flushMessages')
+def flushMessages(size):
+    def trial():
+        user = backlog(size)
+        return timed(user.flushMessages)
+    return trial
+
+@benchmark('User.flushMessages(100)')
+def flushMessagePage(size):
+    user = backlog(size)
+    def trial():
+        took = timed(user.flushMessages, 100)
+        # put back the page we took, so the backlog stays the same
+        for i in xrange(100):
+            user.queueMessage(DirectMessage(user, user, 'refill'))
+        return took
+    return trial
+
+# serializing a message to a group of size members, as each new group message
+# is. Each trial needs a new message as a message caches its encoding.
+def groupMessageSerialize(size, embed):
+    users = sharedUsers(size)
+    group = Group('group')
+    # adding members one at a time copies the set each time (see Group), which
+    # is fine for real groups but slow for a million members
+    group.users = frozenset(users.users.values())
+    sender = users.getUser('user0')
+
+    def trial():
+        GroupMessage.EMBED_GROUP = embed
+        try:
+            return timed(GroupMessage(sender, group, 'hello').serializeToString)
+        finally:
+            GroupMessage.EMBED_GROUP = False
+    return trial
+
+@benchmark('GroupMessage.serialize')
+def groupMessage(size):
+    return groupMessageSerialize(size, False)
+
+@benchmark('GroupMessage.serialize(legacy)')
+def legacyGroupMessage(size):
+    return groupMessageSerialize(size, True)
+
+# sending a message to a group of size members, queueing it for each of them
+# or adding it to the group's timeline. The users are shared, so each trial
+# empties their queues again.
+def groupReceive(size, timeline):
+    users = sharedUsers(size)
+    group = Group('group')
+    group.users = frozenset(users.users.values())
+    sender = users.getUser('user0')
+
+    def trial():
+        Group.TIMELINE_MEMBERS = 1 if timeline else None
+        try:
+            return timed(group.receiveMessage, GroupMessage(sender, group, 'hello'), users)
+        finally:
+            Group.TIMELINE_MEMBERS = None
+            for user in group.users:
+                user.clearMessages()
+    return trial
+
+@benchmark('Group.receiveMessage')
+def groupReceiveWrite(size):
+    return groupReceive(size, False)
+
+@benchmark('Group.receiveMessage(timeline)')
+def groupReceiveTimeline(size):
+    return groupReceive(size, True)
+
+# listing every user, as GET /v1/users does
+@benchmark('UserList.serialize')
+def userListSerialize(size):
+    users = sharedUsers(size)
+
+    def trial():
+        # so the listing isn't cached
+        users.listings.clear()
+        return timed(users.serialize)
+    return trial
+
+# a group with size members, as GET /v1/groups/<groupname> sends it
+@benchmark('Group.serializeToString')
+def groupSerialize(size):
+    group = Group('group')
+    group.users = frozenset(sharedUsers(size).users.values())
+    return lambda: timed(group.serializeToString)
+
+def filterBenchmark(name, query):
+    @benchmark('UserList.filter(%s)' % name)
+    def userFilter(size):
+        users = sharedUsers(size)
+        return lambda: timed(lambda: sum(1 for _ in users.filter(query)))
+
+    @benchmark('GroupList.filter(%s)' % name)
+    def groupFilter(size):
+        groups = GroupList()
+        for i in xrange(size):
+            groups.addGroup(Group('group%d' % i))
+        # group names start with g, not u
+        groupQuery = query.replace('user', 'group').replace('u*', 'g*')
+        return lambda: timed(lambda: sum(1 for _ in groups.filter(groupQuery)))
+
+for name, query in QUERIES:
+    filterBenchmark(name, query)
+
+# removing a user from every group, when there are size groups and the user
+# is in 10 of them
+@benchmark('GroupList.pruneUser')
+def pruneUser(size):
+    user = makeUsers(1).getUser('user0')
+    groups = GroupList()
+    for i in xrange(size):
+        groups.addGroup(Group('group%d' % i))
+
+    def trial():
+        for i in xrange(0, size, size / 10):
+            groups.getGroup('group%d' % i).addUser(user)
+        return timed(groups.pruneUser, user)
+    return trial
+
+# Times a trial function, returning the fastest time in seconds
+def best(trial):
+    times = []
+    started = time.time()
+    while len(times) < MIN_TRIALS or time.time() - started < TRIAL_SECONDS:
+        times.append(trial())
+    return min(times)
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the model layer at a range of sizes')
+    parser.add_argument('--max-size', type=int, default=100000,
+                        help='the largest input size to try (default: %(default)s)')
+    parser.add_argument('--only', help='only run benchmarks whose name contains this')
+    parser.add_argument('--output', help='also write the results here as JSON')
+    args = parser.parse_args()
+
+    sizes = [size for size in SIZES if size <= args.max_size]
+    results = {}
+    for name, setUp in BENCHMARKS:
+        if args.only and args.only not in name:
+            continue
+
+        times = []
+        for size in sizes:
+            times.append(best(setUp(size)))
+
+        # how the time grows from each size to the largest
+        last = len(sizes) - 1
+        exponents = [math.log(times[last] / max(t, 1e-9)) / math.log(float(sizes[last]) / n)
+                     for n, t in zip(sizes[:last], times[:last])]
+
+        print name
+        for i, (size, t) in enumerate(zip(sizes, times)):
+            growth = ' ~ size^%.2f' % exponents[i] if i < last else ''
+            print '  %8d %10.3fms %8.1fns/item%s' % (size, t * 1000, t * 1e9 / size, growth)
+
+        results[name] = {'sizes': sizes, 'seconds': times, 'exponents': exponents}
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+import argparse
+import multiprocessing
+import os
+import signal
+import subprocess
+import sys
+import time
+import requests
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from build.protobufs import request_pb2 as RequestProtoBuf
+from build.protobufs import response_pb2 as ResponseProtoBuf
+from sharding import HashRing
+from router import waitForPort
+
+#
+# Measures how message throughput grows with the number of shards.
+#
+# For each shard count we start router.py with that many shards, create the
+# users, then run client processes that send direct messages to random users
+# for a while, and count how many got through each second. Clients look up the
+# shards with GET /v1/shards and send each message straight to the shard of
+# its recipient (pass --via-router to send everything through the router
+# instead).
+#
+# Run from anywhere with
+#
+#   python bench/shards.py --shards 1 2 4 --clients 8 --seconds 10
+#
+# Shards only help when there are spare cores: on a machine with fewer cores
+# than shards plus clients the processes just take turns.
+#
+
+# Sends messages from one client process until deadline, returning how many
+# were sent
+def sendMessages(base, usernames, deadline, direct, seed):
+    import random
+    rng = random.Random(seed)
+    session = requests.Session()
+
+    urls, ring = [base], None
+    if direct:
+        shards = ResponseProtoBuf.ShardList()
+        shards.ParseFromString(session.get(base + '/shards').content)
+        urls, ring = list(shards.urls), HashRing(len(shards.urls), shards.vnodes)
+
+    sent = 0
+    while time.time() < deadline:
+        to = rng.choice(usernames)
+        url = urls[ring.shardFor(to)] if ring else base
+        message = RequestProtoBuf.Message(frm=rng.choice(usernames), msg='message %d' % sent)
+        r = session.post('%s/users/%s/messages' % (url, to), data=message.SerializeToString())
+        r.raise_for_status()
+        sent += 1
+    return sent
+
+def runClient(args):
+    return sendMessages(*args)
+
+# Starts count shards behind a router and returns the router process
+def startCluster(count, port, dataDir):
+    here = os.path.dirname(os.path.abspath(__file__))
+    router = subprocess.Popen([sys.executable, os.path.join(here, '..', 'router.py'),
+                               '--shards', str(count), '--port', str(port),
+                               '--data-dir', dataDir],
+                              stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+    for p in xrange(port, port + count + 1):
+        waitForPort('127.0.0.1', p)
+    return router
+
+def measure(count, args):
+    router = startCluster(count, args.port, args.data_dir)
+    try:
+        base = 'http://127.0.0.1:%d/v1' % args.port
+        session = requests.Session()
+        usernames = ['user%d' % i for i in xrange(args.users)]
+        batch = RequestProtoBuf.Batch()
+        for username in usernames:
+            batch.operations.add(type=RequestProtoBuf.Operation.CREATE_USER, username=username)
+        session.post(base + '/batch', data=batch.SerializeToString()).raise_for_status()
+
+        deadline = time.time() + args.seconds
+        pool = multiprocessing.Pool(args.clients)
+        try:
+            sent = pool.map(runClient, [(base, usernames, deadline, not args.via_router, seed)
+                                        for seed in xrange(args.clients)])
+        finally:
+            pool.close()
+            pool.join()
+        return sum(sent) / float(args.seconds)
+    finally:
+        # the router stops its shards when interrupted
+        router.send_signal(signal.SIGINT)
+        router.wait()
+
+def main():
+    parser = argparse.ArgumentParser(description='Measure throughput against the number of shards')
+    parser.add_argument('--shards', type=int, nargs='+', default=[1, 2, 4])
+    parser.add_argument('--clients', type=int, default=8,
+                        help='client processes sending messages')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--port', type=int, default=5200)
+    parser.add_argument('--data-dir', default='/tmp/bench-shards')
+    parser.add_argument('--via-router', action='store_true',
+                        help='send messages through the router instead of to the shards')
+    args = parser.parse_args()
+
+    print '%d cores, %d clients, %s' % (multiprocessing.cpu_count(), args.clients,
+                                        'through the router' if args.via_router else 'direct to shards')
+    baseline = None
+    for count in args.shards:
+        rate = measure(count, args)
+        baseline = baseline or rate
+        print '%2d shards %8.0f messages/s %5.2fx' % (count, rate, rate / baseline)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,167 @@
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from build.protobufs import request_pb2 as RequestProtoBuf
+from build.protobufs import response_pb2 as ResponseProtoBuf
+from model import UserList, Group, GroupList, UserError
+from queues import QueueLimits, removeSpillFiles
+import handlers
+
+#
+# Hammers the users, groups and queues from many threads at once and checks
+# that no message is lost, duplicated or delivered out of order.
+#
+# Senders send numbered direct messages to a fixed set of receivers and to
+# groups they all belong to, while readers flush the receivers' queues (a
+# random number of messages at a time) and other threads keep creating,
+# joining and deleting users in the same groups. Once the senders are done
+# every receiver must have got every direct message sent to them and every
+# group message exactly once, with each sender's messages in the order they
+# were sent.
+#
+# Run from anywhere with
+#
+#   python bench/stress.py --senders 8 --messages 2000
+#
+# It exits with status 1 if anything went wrong.
+#
+
+def request(frm, msg):
+    return RequestProtoBuf.Message(frm=frm, msg=msg)
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the model under concurrent load')
+    parser.add_argument('--senders', type=int, default=8)
+    parser.add_argument('--receivers', type=int, default=8)
+    parser.add_argument('--groups', type=int, default=4)
+    parser.add_argument('--messages', type=int, default=2000,
+                        help='messages sent by each sender')
+    parser.add_argument('--churners', type=int, default=4,
+                        help='threads creating, joining and deleting users')
+    parser.add_argument('--spill', action='store_true',
+                        help='use small queue limits so messages spill to disk')
+    parser.add_argument('--timeline-members', type=int,
+                        help='groups this large keep their messages in a timeline (see Group)')
+    args = parser.parse_args()
+
+    Group.TIMELINE_MEMBERS = args.timeline_members
+
+    limits = None
+    if args.spill:
+        removeSpillFiles('/tmp/stress-spill')
+        limits = QueueLimits(userMemoryBytes=4096, spillDir='/tmp/stress-spill')
+    users, groups = UserList(queueLimits=limits), GroupList()
+
+    senders = ['sender%d' % i for i in xrange(args.senders)]
+    receivers = ['receiver%d' % i for i in xrange(args.receivers)]
+    groupnames = ['group%d' % i for i in xrange(args.groups)]
+    for name in senders + receivers:
+        handlers.createUser(users, name)
+    for groupname in groupnames:
+        handlers.createGroup(groups, groupname)
+        for name in receivers:
+            handlers.addMember(users, groups, groupname, name)
+
+    # what each receiver should get, and has got, as a list of texts
+    expected = dict((name, []) for name in receivers)
+    received = dict((name, []) for name in receivers)
+    errors = []
+    sending = [len(senders)]
+    lock = threading.Lock()
+
+    def send(sender):
+        rng = random.Random(sender)
+        for n in xrange(args.messages):
+            if rng.random() < 0.8:
+                to = rng.choice(receivers)
+                text = '%s:%d:%s' % (sender, n, to)
+                handlers.sendDirectMessage(users, to, request(sender, text))
+                with lock:
+                    expected[to].append(text)
+            else:
+                to = rng.choice(groupnames)
+                text = '%s:%d:%s' % (sender, n, to)
+                handlers.sendGroupMessage(users, groups, to, request(sender, text))
+                with lock:
+                    for name in receivers:
+                        expected[name].append(text)
+        with lock:
+            sending[0] -= 1
+
+    def read(name):
+        rng = random.Random(name)
+        user = users.getUser(name)
+        messages = ResponseProtoBuf.MessageList()
+        while True:
+            with lock:
+                done = sending[0] == 0
+            user.waitForMessages(0.01)
+            messages.ParseFromString(user.flushMessages(rng.choice([None, 1, 7, 50])))
+            received[name].extend(m.msg for m in messages.messages)
+            if done and not user.hasMessages():
+                return
+
+    def churn(n):
+        rng = random.Random(n)
+        i = 0
+        while True:
+            with lock:
+                if sending[0] == 0:
+                    return
+            name = 'churn%dx%d' % (n, i)
+            i += 1
+            try:
+                handlers.createUser(users, name)
+                for groupname in rng.sample(groupnames, rng.randint(1, len(groupnames))):
+                    handlers.addMember(users, groups, groupname, name)
+                handlers.deleteUser(users, groups, name)
+            except UserError as ue:
+                errors.append('churn: %s' % ue.message)
+            # leave the senders some time, this only needs to overlap with them
+            time.sleep(0.001)
+
+    threads = [threading.Thread(target=send, args=(s,)) for s in senders]
+    threads += [threading.Thread(target=read, args=(r,)) for r in receivers]
+    threads += [threading.Thread(target=churn, args=(n,)) for n in xrange(args.churners)]
+
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+
+    total = 0
+    for name in receivers:
+        got, want = received[name], expected[name]
+        total += len(got)
+        if len(got) != len(set(got)):
+            errors.append('%s got %d duplicate messages' % (name, len(got) - len(set(got))))
+        if set(got) != set(want):
+            errors.append('%s lost %d messages and got %d unexpected ones' % (
+                name, len(set(want) - set(got)), len(set(got) - set(want))))
+
+        # each sender's messages must arrive in the order they were sent
+        last = {}
+        for text in got:
+            sender, n, _ = text.split(':')
+            if int(n) <= last.get(sender, -1):
+                errors.append('%s got %s out of order' % (name, text))
+                break
+            last[sender] = int(n)
+
+    print '%d messages delivered to %d receivers in %.2fs' % (total, len(receivers), elapsed)
+    for error in errors[:20]:
+        print 'ERROR', error
+    if errors:
+        sys.exit(1)
+    print 'OK'
+
+if __name__ == '__main__':
+    main()
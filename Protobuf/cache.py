@@ -0,0 +1,103 @@
+import threading
+from collections import OrderedDict, deque
+from itertools import islice
+
+#
+# Versions of the user and group lists (see UserList and GroupList), and what
+# we keep so clients don't have to fetch a whole list every time.
+#
+# Each list has a ChangeLog, which counts the changes made to it (the version)
+# and remembers the most recent, so a client can ask for just the changes
+# since the version it has (see GET /v1/changes/users).
+#
+# A ListingCache keeps serialized listings, so a listing nobody has changed
+# isn't built again for every client polling it. A listing is only cached for
+# the version it was built at: once the version moves on everything cached is
+# dropped. At any one version the listings for different queries and pages
+# are kept up to maxBytes in total, and up to maxEntries of them, dropping the
+# least recently used first. The count matters for listings that are empty
+# (a query matching nothing, or a cursor past the end), which cost no bytes
+# but are still kept under a key the client chose.
+#
+
+# the most bytes of listings a cache keeps, and the most listings
+MAX_BYTES = 64 * 1024 * 1024
+MAX_ENTRIES = 10000
+
+class ChangeLog(object):
+    # how many of the most recent changes are kept
+    LENGTH = 10000
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.version = 0
+        # (type, username, groupname) for each change up to version, oldest
+        # first, where type is a Change.Type
+        self.changes = deque(maxlen=self.LENGTH)
+
+    # record a change, after it has been made, moving on to the next version
+    def record(self, type, username=None, groupname=None):
+        with self.lock:
+            self.version += 1
+            self.changes.append((type, username, groupname))
+
+    # Returns the current version and the changes since version since, oldest
+    # first. The changes are None if they aren't all kept any more (or since
+    # is None or from the future).
+    def since(self, since):
+        with self.lock:
+            if since is None or not 0 <= self.version - since <= len(self.changes):
+                return self.version, None
+            return self.version, list(islice(self.changes,
+                                             len(self.changes) - (self.version - since), None))
+
+class ListingCache(object):
+    # version is called to get the list's current version
+    def __init__(self, version, maxBytes=MAX_BYTES, maxEntries=MAX_ENTRIES):
+        self.currentVersion = version
+        self.maxBytes = maxBytes
+        self.maxEntries = maxEntries
+        self.lock = threading.Lock()
+        # the version everything in entries was built at
+        self.version = None
+        # listings by key, least recently used first
+        self.entries = OrderedDict()
+        self.bytes = 0
+
+    # Returns the listing for key, calling build to make it if it isn't
+    # cached. It is only kept if the list didn't change while it was built.
+    def get(self, key, build):
+        version = self.currentVersion()
+        with self.lock:
+            if self.version == version:
+                listing = self.entries.pop(key, None)
+                if listing is not None:
+                    self.entries[key] = listing
+                    return listing
+
+        listing = build()
+        if len(listing) > self.maxBytes:
+            return listing
+        with self.lock:
+            if self.currentVersion() != version:
+                return listing
+            if self.version != version:
+                self.entries.clear()
+                self.bytes = 0
+                self.version = version
+
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= len(previous)
+            self.entries[key] = listing
+            self.bytes += len(listing)
+            while self.bytes > self.maxBytes or len(self.entries) > self.maxEntries:
+                _, evicted = self.entries.popitem(last=False)
+                self.bytes -= len(evicted)
+        return listing
+
+    # forget everything cached
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
@@ -1,9 +1,20 @@
+import argparse
 import cmd
+import re
 import requests
+import socket
+import threading
 import time
+import types
+from collections import OrderedDict, defaultdict, deque
+from datetime import timedelta
+from requests.adapters import HTTPAdapter
+from requests.packages.urllib3.util.retry import Retry
 from build.protobufs import request_pb2 as RequestProtoBuf
 from build.protobufs import response_pb2 as ResponseProtoBuf
 from functools import wraps
+from compression import compress, decompress
+from wire import frame, readFrame
 
 #
 # This file is the main client for our chat application. It exposes a command
@@ -12,6 +23,52 @@ from functools import wraps
 
 SERVER_HOST = 'http://127.0.0.1:5000/v1'
 
+# Where the server listens for the TCP transport (see tcpserver.py), when the
+# client is started with --transport tcp and no --tcp-address
+SERVER_TCP_ADDRESS = ('127.0.0.1', 6000)
+
+# How long (in seconds) the server may hold a message poll open waiting for new
+# messages before returning an empty list.
+POLL_TIMEOUT = 30
+
+# How many users, groups or messages to ask for at a time in listings
+PAGE_SIZE = 100
+
+# How many pages of user and group listings to remember, so that the server
+# only has to send them again if they have changed (see pages)
+LISTING_CACHE_SIZE = 100
+
+# When batching, how long (in seconds) to hold outgoing operations so they can
+# be sent together, and the most to send in one batch
+BATCH_WINDOW = 0.05
+BATCH_SIZE = 1000
+
+# Connections to the server are kept open and reused between requests. This is
+# how many idle connections to keep.
+POOL_SIZE = 10
+
+# How many times to retry a request that fails to connect, and the base of the
+# exponential backoff between attempts (in seconds). Requests that reached the
+# server are never retried, not even reads: reading messages removes them from
+# the queue, so if the answer were lost a retry would skip them.
+RETRIES = 3
+RETRY_BACKOFF = 0.1
+
+# How long (in seconds) to wait to connect to the server, and for it to answer
+REQUEST_TIMEOUT = (5, 30)
+
+# How many request latencies to remember per command (see /latency)
+LATENCY_SAMPLES = 1000
+
+# Request bodies of at least this many bytes are compressed with
+# COMPRESSION_ENCODING (see compression.py). Responses are compressed by the
+# server when we accept it, which requests says we do and undoes for us.
+COMPRESSION_MIN_BYTES = 1024
+COMPRESSION_ENCODING = 'gzip'
+
+# The most bytes a compressed answer over TCP may decompress to
+MAX_REPLY_BYTES = 64 * 1024 * 1024
+
 # This is a wrapper to "publish" methods on the Client object. Publishing a
 # method will make it callable from the command line (see below).
 def published(method):
@@ -34,6 +91,9 @@ def published(method):
 # UserError. Once the protobuf object is parsed, we create a string
 # representation of it and print it.
 #
+# The time each request took is recorded on the client under the name of the
+# wrapped function (see Client.latency).
+#
 # NOTE: If the wrapped function returns None, this simply returns None and
 #       doesn't attempt to parse. This allows wrapped functions to print an
 #       error message in the case of error and then just return None (so nothing
@@ -42,33 +102,531 @@ def published(method):
 def protoapi(expectedType):
     def decorator(f):
         @wraps(f)
-        def wrapped(*args, **kwargs):
-            response = f(*args, **kwargs)
+        def wrapped(self, *args, **kwargs):
+            response = f(self, *args, **kwargs)
 
             # There was a client error, and the request was never made.
             # Don't print anything and return.
             if response is None:
                 return
 
-            # Print the response object for the user to see (nice-to-have for
-            # technical users, allows them to see things like response code)
-            print response
+            # Listings are fetched a page at a time (see pages below), giving
+            # a response per page. Print each one as it arrives.
+            if isinstance(response, types.GeneratorType):
+                responses = response
+            else:
+                responses = [response]
+
+            for response in responses:
+                self.latencies[f.__name__].append(response.elapsed.total_seconds())
 
-            # if the response was okay (200), parse the content as expectedType
-            if response.status_code == 200:
-                obj = expectedType()
-                obj.ParseFromString(response.content)
-                print str(obj)
+                # Print the response object for the user to see (nice-to-have
+                # for technical users, allows them to see things like response
+                # code)
+                print response
 
-            # if the response was a bad request (400), parse as UserError
-            elif response.status_code == 400:
-                ue = ResponseProtoBuf.UserError()
-                ue.ParseFromString(response.content)
-                print str(ue)
+                # if the response was okay (200), parse the content as
+                # expectedType
+                if response.status_code == 200:
+                    obj = expectedType()
+                    obj.ParseFromString(response.content)
+                    print str(obj)
+
+                # if it hasn't changed since we last fetched it (304), parse
+                # what we fetched then (see pages)
+                elif response.status_code == 304:
+                    obj = expectedType()
+                    obj.ParseFromString(response.cached)
+                    print str(obj)
+
+                # if the response was a bad request (400), parse as UserError
+                elif response.status_code == 400:
+                    ue = ResponseProtoBuf.UserError()
+                    ue.ParseFromString(response.content)
+                    print str(ue)
 
         return wrapped
     return decorator
 
+# Requests a listing PAGE_SIZE items at a time, yielding the response for each
+# page. Each page tells us the cursor to pass to get the next one, and we stop
+# once a page doesn't have one (or there is an error).
+#
+# If listings is given, it holds the ETag and content of pages fetched before.
+# We send the ETag along, and if the page hasn't changed the server answers
+# 304 with no body, in which case the content we have is put on the response
+# as cached.
+#
+# NOTE: Reading messages removes them from the queue, so the server doesn't
+#       need the cursor for them, but a message page still sets it while there
+#       are more messages waiting.
+def pages(session, url, params, expectedType, listings=None):
+    params = dict(params, limit=PAGE_SIZE)
+    while True:
+        key = (url, tuple(sorted(params.items())))
+        known = listings.get(key) if listings is not None else None
+        headers = {'If-None-Match': known[0]} if known is not None else {}
+        r = session.get(url, params=params, headers=headers, timeout=REQUEST_TIMEOUT)
+
+        content = None
+        if r.status_code == 304 and known is not None:
+            r.cached = content = known[1]
+        elif r.status_code == 200:
+            content = r.content
+            if listings is not None and r.headers.get('ETag'):
+                listings.pop(key, None)
+                listings[key] = (r.headers['ETag'], content)
+                while len(listings) > LISTING_CACHE_SIZE:
+                    listings.popitem(last=False)
+        yield r
+
+        if content is None:
+            return
+        page = expectedType()
+        page.ParseFromString(content)
+        if not page.HasField('nextCursor'):
+            return
+        params['cursor'] = page.nextCursor
+
+# The body to send for data, and the headers to send with it, compressed if
+# it is big enough to be worth it
+def compressBody(data):
+    if len(data) < COMPRESSION_MIN_BYTES:
+        return data, {}
+    return (compress(data, COMPRESSION_ENCODING),
+            {'Content-Encoding': COMPRESSION_ENCODING})
+
+# POSTs data to url, compressed if it is big enough (see compressBody). Every
+# request with a body goes through here.
+def postBody(session, url, data):
+    data, headers = compressBody(data)
+    return session.post(url, data=data, headers=headers, timeout=REQUEST_TIMEOUT)
+
+# Makes a session which keeps up to pool_size connections to the server open
+# for reuse, and retries requests as described above RETRIES.
+def connect(pool_size=POOL_SIZE, retries=RETRIES):
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size,
+                          max_retries=Retry(total=retries, connect=retries, read=0,
+                                            status=0, backoff_factor=RETRY_BACKOFF))
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+#
+# Batching
+#
+# Rather than making a request for every message sent, a Batcher collects
+# operations (see the Operation protobuf) and sends them together to the
+# server's batch endpoint. Operations are held for up to BATCH_WINDOW seconds
+# after the first one arrives, or until there are BATCH_SIZE of them, then sent
+# in one request. Each operation's callback is called with its BatchResult once
+# the batch has been applied.
+#
+# For example, a bot sending many messages might do
+#
+#     batcher = Batcher()
+#     for line in lines:
+#         batcher.add(directMessage('bot', 'alice', line))
+#     batcher.close()
+#
+
+# build an Operation sending a message from frm to a user
+def directMessage(frm, username, msg):
+    operation = RequestProtoBuf.Operation(type=RequestProtoBuf.Operation.DIRECT_MESSAGE,
+                                          username=username)
+    operation.message.frm = frm
+    operation.message.msg = msg
+    return operation
+
+# build an Operation sending a message from frm to a group
+def groupMessage(frm, groupname, msg):
+    operation = RequestProtoBuf.Operation(type=RequestProtoBuf.Operation.GROUP_MESSAGE,
+                                          groupname=groupname)
+    operation.message.frm = frm
+    operation.message.msg = msg
+    return operation
+
+# build an Operation creating a user
+def createUser(username):
+    return RequestProtoBuf.Operation(type=RequestProtoBuf.Operation.CREATE_USER,
+                                     username=username)
+
+# build an Operation creating a group
+def createGroup(groupname):
+    return RequestProtoBuf.Operation(type=RequestProtoBuf.Operation.CREATE_GROUP,
+                                     groupname=groupname)
+
+# build an Operation adding a user to a group
+def addMember(groupname, username):
+    return RequestProtoBuf.Operation(type=RequestProtoBuf.Operation.ADD_MEMBER,
+                                     groupname=groupname, username=username)
+
+class Batcher(object):
+    def __init__(self, window=BATCH_WINDOW, size=BATCH_SIZE, session=None):
+        self.window = window
+        self.size = size
+        self.session = session or connect()
+        # (operation, callback) pairs waiting to be sent, and the time the
+        # oldest of them was added
+        self.lock = threading.Condition()
+        self.pending = []
+        self.since = None
+        self.closed = False
+
+        self.sender = threading.Thread(target=self.run, name='batcher')
+        self.sender.daemon = True
+        self.sender.start()
+
+    # queue an operation to be sent. callback, if given, is called (on the
+    # batcher's thread) with the operation's BatchResult.
+    def add(self, operation, callback=None):
+        with self.lock:
+            if self.closed:
+                raise ValueError("Batcher is closed")
+            if not self.pending:
+                self.since = time.time()
+            self.pending.append((operation, callback))
+            self.lock.notify_all()
+
+    # send everything still waiting, then stop
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+        self.sender.join()
+
+    # the sending thread, sends a batch whenever the window has passed since
+    # the oldest waiting operation or enough operations are waiting
+    def run(self):
+        while True:
+            with self.lock:
+                while True:
+                    if self.pending and (self.closed or len(self.pending) >= self.size):
+                        break
+                    if self.pending and time.time() - self.since >= self.window:
+                        break
+                    if self.closed:
+                        return
+                    if self.pending:
+                        self.lock.wait(self.window - (time.time() - self.since))
+                    else:
+                        self.lock.wait()
+                batch = self.pending[:self.size]
+                self.pending = self.pending[self.size:]
+                self.since = time.time()
+
+            self.send(batch)
+
+    # send a batch and hand each result to its callback. If the whole batch
+    # fails every operation gets the same error.
+    def send(self, batch):
+        request = RequestProtoBuf.Batch()
+        request.operations.extend([operation for operation, _ in batch])
+
+        try:
+            r = postBody(self.session, SERVER_HOST + '/batch', request.SerializeToString())
+            if r.status_code == 200:
+                response = ResponseProtoBuf.BatchResponse()
+                response.ParseFromString(r.content)
+                results = list(response.results)
+            else:
+                error = ResponseProtoBuf.UserError()
+                if r.status_code == 400:
+                    error.ParseFromString(r.content)
+                else:
+                    error.message = "Batch failed with status %d" % r.status_code
+                results = [ResponseProtoBuf.BatchResult(error=error)] * len(batch)
+        except requests.exceptions.RequestException as e:
+            error = ResponseProtoBuf.UserError(message="Batch failed: %s" % e)
+            results = [ResponseProtoBuf.BatchResult(error=error)] * len(batch)
+
+        for (_, callback), result in zip(batch, results):
+            if callback is not None:
+                callback(result)
+
+# prints the result of an operation sent in a batch
+def printResult(result):
+    print str(result)
+
+#
+# The TCP transport
+#
+# Instead of HTTP the client can talk to the server over one TCP connection
+# (see tcpserver.py), sending each request as an Envelope and getting back a
+# Reply with the same id. Requests are sent as soon as they are made, so a
+# program can have many on the way at once:
+#
+#     connection = TcpConnection()
+#     for line in lines:
+#         connection.send(Envelope(op=Envelope.DIRECT_MESSAGE, username='alice',
+#                                  payload=message.SerializeToString()))
+#     connection.flush()
+#
+# and it can subscribe to a user's messages, which the server then pushes down
+# the connection as they arrive. The server may compress any answer (with
+# deflate), the connection decompresses it before handing it on.
+#
+
+Envelope = RequestProtoBuf.Envelope
+Reply = ResponseProtoBuf.Reply
+
+class TcpConnection(object):
+    def __init__(self, address=None):
+        if address is None:
+            address = SERVER_TCP_ADDRESS
+        self.sock = socket.create_connection(address, REQUEST_TIMEOUT[0])
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.stream = self.sock.makefile('rb')
+
+        # the callback for each request waiting for its Reply, and for each
+        # subscription. Sending is under its own lock, so that the reader can
+        # still take replies while a send is blocked.
+        self.lock = threading.Condition()
+        self.sendLock = threading.Lock()
+        self.waiting = {}
+        self.subscriptions = {}
+        self.nextId = 1
+        self.closed = False
+
+        self.reader = threading.Thread(target=self.read, name='tcp-reader')
+        self.reader.daemon = True
+        self.reader.start()
+
+    # Sends a request without waiting for the answer. callback, if given, is
+    # called (on the reader thread) with the Reply, and pushed with each Reply
+    # pushed for a subscription. Returns the request id.
+    def send(self, envelope, callback=None, pushed=None):
+        with self.sendLock:
+            with self.lock:
+                if self.closed:
+                    raise socket.error("Connection closed")
+                envelope.id = self.nextId
+                self.nextId += 1
+                if not envelope.HasField('acceptEncoding'):
+                    envelope.acceptEncoding = 'deflate'
+                self.waiting[envelope.id] = callback
+                if pushed is not None:
+                    self.subscriptions[envelope.id] = pushed
+            self.sock.sendall(frame(envelope.SerializeToString()))
+        return envelope.id
+
+    # Sends a request and waits for its Reply
+    def call(self, envelope, pushed=None):
+        replies = []
+
+        def answered(reply):
+            with self.lock:
+                replies.append(reply)
+                self.lock.notify_all()
+
+        self.send(envelope, answered, pushed)
+        with self.lock:
+            while not replies and not self.closed:
+                self.lock.wait()
+        if not replies:
+            raise socket.error("Connection closed")
+        return replies[0]
+
+    # waits for the answers to every request sent so far
+    def flush(self):
+        with self.lock:
+            while self.waiting and not self.closed:
+                self.lock.wait()
+
+    # Asks the server to push username's messages. callback is called (on the
+    # reader thread) with a MessageList each time some arrive.
+    def subscribe(self, username, callback):
+        def pushed(reply):
+            messages = ResponseProtoBuf.MessageList()
+            messages.ParseFromString(reply.payload)
+            callback(messages)
+
+        return self.call(Envelope(op=Envelope.SUBSCRIBE, username=username), pushed)
+
+    # the reader thread, hands each Reply to the callback waiting for it
+    def read(self):
+        try:
+            while True:
+                payload = readFrame(self.stream)
+                if payload is None:
+                    return
+                reply = Reply()
+                reply.ParseFromString(payload)
+                if reply.contentEncoding:
+                    reply.payload = decompress(reply.payload, reply.contentEncoding,
+                                               MAX_REPLY_BYTES)
+                    reply.ClearField('contentEncoding')
+
+                with self.lock:
+                    if reply.status == Reply.PUSH:
+                        callback = self.subscriptions.get(reply.id)
+                    else:
+                        callback = self.waiting.pop(reply.id, None)
+                    self.lock.notify_all()
+                if callback is not None:
+                    callback(reply)
+        except (socket.error, ValueError):
+            return
+        finally:
+            with self.lock:
+                self.closed = True
+                self.lock.notify_all()
+
+    def close(self):
+        self.sock.shutdown(socket.SHUT_RDWR)
+        self.sock.close()
+
+# What the client expects from a requests Response, for an answer that came
+# over TCP
+class TcpResponse(object):
+    STATUS_CODES = {Reply.OK: 200, Reply.USER_ERROR: 400, Reply.SERVER_ERROR: 500}
+
+    def __init__(self, reply, elapsed):
+        self.status_code = self.STATUS_CODES[reply.status]
+        self.content = reply.payload
+        self.headers = {}
+        self.elapsed = timedelta(seconds=elapsed)
+
+    def __repr__(self):
+        return '<Response [%d]>' % self.status_code
+
+# The HTTP methods and paths (under /v1) the client uses, and the Envelope
+# operation each is sent as over TCP. The groups in the path are the username
+# and groupname, as named.
+TCP_ROUTES = [
+    ('GET', r'/users$', Envelope.LIST_USERS),
+    ('POST', r'/users/(?P<username>[^/]+)$', Envelope.CREATE_USER),
+    ('DELETE', r'/users/(?P<username>[^/]+)$', Envelope.DELETE_USER),
+    ('GET', r'/users/(?P<username>[^/]+)/groups$', Envelope.LIST_USER_GROUPS),
+    ('GET', r'/groups$', Envelope.LIST_GROUPS),
+    ('POST', r'/groups/(?P<groupname>[^/]+)$', Envelope.CREATE_GROUP),
+    ('GET', r'/groups/(?P<groupname>[^/]+)$', Envelope.GET_GROUP),
+    ('PUT', r'/groups/(?P<groupname>[^/]+)/users/(?P<username>[^/]+)$', Envelope.ADD_MEMBER),
+    ('POST', r'/users/(?P<username>[^/]+)/messages$', Envelope.DIRECT_MESSAGE),
+    ('POST', r'/groups/(?P<groupname>[^/]+)/messages$', Envelope.GROUP_MESSAGE),
+    ('GET', r'/users/(?P<username>[^/]+)/messages$', Envelope.LIST_MESSAGES),
+    ('POST', r'/batch$', Envelope.BATCH),
+    ('GET', r'/changes/users$', Envelope.USER_CHANGES),
+    ('GET', r'/changes/groups$', Envelope.GROUP_CHANGES),
+]
+TCP_ROUTES = [(method, re.compile(path), op) for method, path, op in TCP_ROUTES]
+
+#
+# Stands in for a requests Session, sending the same requests over a
+# TcpConnection, so the Client (and a Batcher) can use either transport.
+#
+# NOTE: A message listing's timeout is ignored, it always answers straight
+#       away. Use subscribe to wait for messages.
+#
+class TcpSession(object):
+    def __init__(self, address=None):
+        self.connection = TcpConnection(address)
+
+    def request(self, method, url, params=None, data=None, headers=None, timeout=None):
+        path = url[len(SERVER_HOST):] if url.startswith(SERVER_HOST) else url
+        for routeMethod, pattern, op in TCP_ROUTES:
+            match = pattern.match(path)
+            if routeMethod == method and match:
+                break
+        else:
+            raise ValueError("No TCP operation for %s %s" % (method, path))
+
+        params = params or {}
+        envelope = Envelope(op=op, **match.groupdict())
+        if params.get('q'):
+            envelope.query = params['q']
+        if params.get('limit'):
+            envelope.limit = int(params['limit'])
+        if params.get('cursor'):
+            envelope.cursor = params['cursor']
+        if params.get('since') is not None:
+            envelope.since = int(params['since'])
+            envelope.epoch = params['epoch']
+        if params.get('dictionary'):
+            envelope.dictionary = True
+        if data is not None:
+            envelope.payload = data
+            if headers and headers.get('Content-Encoding'):
+                envelope.contentEncoding = headers['Content-Encoding']
+
+        start = time.time()
+        reply = self.connection.call(envelope)
+        return TcpResponse(reply, time.time() - start)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.request('DELETE', url, **kwargs)
+
+    def close(self):
+        self.connection.close()
+
+#
+# A copy of the server's users and groups (with their members), kept up to
+# date by asking for what has changed since the version we have rather than
+# fetching the whole lists again (see GET /v1/changes/users). The first sync,
+# and any after the server has restarted or we have fallen too far behind,
+# fetches the whole list.
+#
+class Roster(object):
+    def __init__(self, session):
+        self.session = session
+        self.users = set()
+        # the members of each group, by name
+        self.groups = {}
+        # the version and epoch (see ChangeList) of each list we are up to
+        # date with
+        self.versions = {}
+
+    # Brings both lists up to date, returning the response for each
+    def sync(self):
+        return [self.syncList('users'), self.syncList('groups')]
+
+    def syncList(self, kind):
+        params = {}
+        if kind in self.versions:
+            params['since'], params['epoch'] = self.versions[kind]
+        r = self.session.get(SERVER_HOST + '/changes/' + kind, params=params,
+                             timeout=REQUEST_TIMEOUT)
+        if r.status_code != 200:
+            return r
+
+        changes = ResponseProtoBuf.ChangeList()
+        changes.ParseFromString(r.content)
+        if changes.HasField('users'):
+            self.users = set(u.username for u in changes.users.users)
+        if changes.HasField('groups'):
+            self.groups = dict((g.groupname, set(u.username for u in g.users))
+                               for g in changes.groups.groups)
+        for change in changes.changes:
+            self.apply(change)
+        self.versions[kind] = (changes.version, changes.epoch)
+        return r
+
+    # apply a Change to our copy. Changes may repeat what a whole list we
+    # fetched already has, so each just sets how things end up.
+    def apply(self, change):
+        Change = ResponseProtoBuf.Change
+        if change.type == Change.ADD_USER:
+            self.users.add(change.username)
+        elif change.type == Change.DELETE_USER:
+            self.users.discard(change.username)
+        elif change.type == Change.ADD_GROUP:
+            self.groups.setdefault(change.groupname, set())
+        elif change.type == Change.ADD_MEMBER:
+            self.groups.setdefault(change.groupname, set()).add(change.username)
+        elif change.type == Change.REMOVE_MEMBER:
+            self.groups.get(change.groupname, set()).discard(change.username)
+
 # The Client object, outlined below, is effectively exposed to the command line
 # interface. When the user types in a slash command to the command line, such as
 # "/METHODNAME ARG1 ARG2", we lookup METHODNAME on the Client object, and if it
@@ -82,7 +640,28 @@ def protoapi(expectedType):
 #       your command with "/send" (e.g. "FOO BAR" becomes "/send FOO BAR")
 
 class Client(object):
-    def __init__(self):
+    def __init__(self, pool_size=POOL_SIZE, retries=RETRIES, transport='http',
+                 tcp_address=None):
+        # All requests go through this session, so connections to the server
+        # are kept alive and reused. With the tcp transport they all go down
+        # one connection instead, to tcp_address (by default
+        # SERVER_TCP_ADDRESS).
+        self.transport = transport
+        if transport == 'tcp':
+            self.session = TcpSession(tcp_address)
+        else:
+            self.session = connect(pool_size, retries)
+
+        # The latencies (in seconds) of the last LATENCY_SAMPLES requests made
+        # by each command
+        self.latencies = defaultdict(lambda: deque(maxlen=LATENCY_SAMPLES))
+
+        # Pages of user and group listings fetched before, see pages
+        self.listings = OrderedDict()
+
+        # Our copy of the users and groups, see /roster
+        self.directory = Roster(self.session)
+
         # This is the current state for the clients. Allows user to send messages
         # to other users and groups without having to specify who every time.
 
@@ -93,6 +672,23 @@ class Client(object):
         self.current_to = None
         self.current_to_is_group = False
 
+        # When batching is turned on, sends and directory changes go through
+        # this instead of making a request each
+        self.batcher = None
+
+    @published
+    def batch(self, *args):
+        """
+        Turn batching of sends, new users and groups, and invites on or off
+        Usage: /batch <on|off>
+        """
+        on = len(args) == 0 or args[0] == 'on'
+        if on and self.batcher is None:
+            self.batcher = Batcher(session=self.session)
+        elif not on and self.batcher is not None:
+            self.batcher.close()
+            self.batcher = None
+
     @published
     def mvg(self, group):
         """
@@ -154,11 +750,19 @@ class Client(object):
             print "<Current user name not set>"
             return None
 
-        # Poll the server for messages until user interrupt
+        # Over TCP the server pushes messages to us as they arrive
+        if self.transport == 'tcp':
+            return self.subscribe()
+
+        # Long poll the server for messages until user interrupt. The server
+        # holds each request open until there is something to deliver (or
+        # POLL_TIMEOUT passes), so we can ask again straight away.
         while True:
             try:
                 # request server messages
-                r = requests.get(SERVER_HOST + '/users/' + self.current_user + '/messages')
+                r = self.session.get(SERVER_HOST + '/users/' + self.current_user + '/messages',
+                                     params={'timeout': POLL_TIMEOUT},
+                                     timeout=(REQUEST_TIMEOUT[0], POLL_TIMEOUT + 5))
 
                 # if the server returned Okay, print the list of messages if
                 # there are any
@@ -176,14 +780,34 @@ class Client(object):
                     print str(ue)
                     break
 
-                # Only poll the server every second, anything more is excessive
-                time.sleep(1)
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError):
+                # the server didn't answer in time, just poll again
+                continue
 
             except KeyboardInterrupt:
                 # in the case of user interrupt (i.e. ctrl-c) then stop polling
                 # for messages and return to prompt
                 break
 
+    # print the current user's messages as the server pushes them, until user
+    # interrupt. The subscription lasts until the connection closes.
+    def subscribe(self):
+        def printMessages(messages):
+            if len(messages.messages) > 0:
+                print str(messages)
+
+        reply = self.session.connection.subscribe(self.current_user, printMessages)
+        if reply.status != Reply.OK:
+            ue = ResponseProtoBuf.UserError()
+            ue.ParseFromString(reply.payload)
+            print str(ue)
+            return None
+        try:
+            while not self.session.connection.closed:
+                time.sleep(1)
+        except KeyboardInterrupt:
+            pass
+
     @published
     def clearuser(self):
         """
@@ -206,7 +830,8 @@ class Client(object):
         if len(args) > 0:
             query['q'] = args[0]
 
-        return requests.get(SERVER_HOST + '/users', params=query)
+        return pages(self.session, SERVER_HOST + '/users', query, ResponseProtoBuf.UserList,
+                     self.listings)
 
     @published
     @protoapi(ResponseProtoBuf.User)
@@ -215,7 +840,10 @@ class Client(object):
         Create user
         Usage: /adduser <username>
         """
-        return requests.post(SERVER_HOST + '/users/' + username)
+        if self.batcher is not None:
+            self.batcher.add(createUser(username), printResult)
+            return None
+        return self.session.post(SERVER_HOST + '/users/' + username, timeout=REQUEST_TIMEOUT)
 
     @published
     def leaveforever(self):
@@ -226,7 +854,8 @@ class Client(object):
         if self.current_user is None:
             print "<Not Logged In>"
             return None
-        return requests.delete(SERVER_HOST + '/users/' + self.current_user)
+        return self.session.delete(SERVER_HOST + '/users/' + self.current_user,
+                                   timeout=REQUEST_TIMEOUT)
 
     @published
     @protoapi(ResponseProtoBuf.GroupList)
@@ -239,7 +868,8 @@ class Client(object):
         if len(args) > 0:
             query['q'] = args[0]
 
-        return requests.get(SERVER_HOST + '/groups', params=query)
+        return pages(self.session, SERVER_HOST + '/groups', query, ResponseProtoBuf.GroupList,
+                     self.listings)
 
     @published
     @protoapi(ResponseProtoBuf.Group)
@@ -248,7 +878,33 @@ class Client(object):
         Create a group
         Usage: /group <groupname>
         """
-        return requests.post(SERVER_HOST + '/groups/' + groupname)
+        if self.batcher is not None:
+            self.batcher.add(createGroup(groupname), printResult)
+            return None
+        return self.session.post(SERVER_HOST + '/groups/' + groupname, timeout=REQUEST_TIMEOUT)
+
+    @published
+    @protoapi(ResponseProtoBuf.Group)
+    def members(self, groupname):
+        """
+        List the members of a group
+        Usage: /members <groupname>
+        """
+        return self.session.get(SERVER_HOST + '/groups/' + groupname, timeout=REQUEST_TIMEOUT)
+
+    @published
+    @protoapi(ResponseProtoBuf.GroupList)
+    def membership(self, *args):
+        """
+        List the groups a user belongs to
+        Usage: /membership <username default=current user>
+        """
+        username = args[0] if len(args) > 0 else self.current_user
+        if username is None:
+            print "<Not Logged In>"
+            return None
+        return self.session.get(SERVER_HOST + '/users/' + username + '/groups',
+                                timeout=REQUEST_TIMEOUT)
 
     @published
     @protoapi(ResponseProtoBuf.Group)
@@ -257,7 +913,11 @@ class Client(object):
         Add user to group
         Usage: /invite <groupname> <username>
         """
-        return requests.put(SERVER_HOST + '/groups/' + groupname + '/users/' + username)
+        if self.batcher is not None:
+            self.batcher.add(addMember(groupname, username), printResult)
+            return None
+        return self.session.put(SERVER_HOST + '/groups/' + groupname + '/users/' + username,
+                                timeout=REQUEST_TIMEOUT)
 
     @published
     @protoapi(ResponseProtoBuf.Message)
@@ -269,11 +929,16 @@ class Client(object):
         if self.current_user is None:
             print "<Not Logged In>"
             return None
+        if self.batcher is not None:
+            self.batcher.add(directMessage(self.current_user, to_name, (' ').join(args)),
+                             printResult)
+            return None
         message = RequestProtoBuf.Message()
         message.frm = self.current_user
         message.msg = (' ').join(args)
 
-        return requests.post(SERVER_HOST + '/users/' + to_name + '/messages', data=message.SerializeToString())
+        return postBody(self.session, SERVER_HOST + '/users/' + to_name + '/messages',
+                        message.SerializeToString())
 
 
     @published
@@ -286,11 +951,16 @@ class Client(object):
         if self.current_user is None:
             print "<Not Logged In>"
             return None
+        if self.batcher is not None:
+            self.batcher.add(groupMessage(self.current_user, to_name, (' ').join(args)),
+                             printResult)
+            return None
         message = RequestProtoBuf.Message()
         message.frm = self.current_user
         message.msg = (' ').join(args)
 
-        return requests.post(SERVER_HOST + '/groups/' + to_name + '/messages', data=message.SerializeToString())
+        return postBody(self.session, SERVER_HOST + '/groups/' + to_name + '/messages',
+                        message.SerializeToString())
 
     @published
     @protoapi(ResponseProtoBuf.MessageList)
@@ -302,7 +972,42 @@ class Client(object):
         if self.current_user is None:
             print "<Not Logged In>"
             return None
-        return requests.get(SERVER_HOST + '/users/' + self.current_user + '/messages')
+        return pages(self.session, SERVER_HOST + '/users/' + self.current_user + '/messages', {},
+                     ResponseProtoBuf.MessageList)
+
+    @published
+    def roster(self, *args):
+        """
+        Sync our copy of the users and groups, fetching only what has changed
+        Usage: /roster <groupname default=show all users and groups>
+        """
+        for r in self.directory.sync():
+            self.latencies['roster'].append(r.elapsed.total_seconds())
+            if r.status_code != 200:
+                print r
+                return None
+
+        if len(args) > 0:
+            print ' '.join(sorted(self.directory.groups.get(args[0], [])))
+            return None
+        print "%d users: %s" % (len(self.directory.users), ' '.join(sorted(self.directory.users)))
+        for groupname, members in sorted(self.directory.groups.items()):
+            print "%s (%d members)" % (groupname, len(members))
+
+    @published
+    def latency(self):
+        """
+        Show how long recent requests took, per command
+        Usage: /latency
+        """
+        if not self.latencies:
+            print "<No Requests Made>"
+            return None
+        for name, samples in sorted(self.latencies.items()):
+            ordered = sorted(samples)
+            print "%-12s %6d requests  mean %7.1fms  p50 %7.1fms  p99 %7.1fms" % (
+                name, len(ordered), 1000 * sum(ordered) / len(ordered),
+                1000 * ordered[len(ordered) / 2], 1000 * ordered[len(ordered) * 99 / 100])
 
     @published
     def help(self, function):
@@ -322,15 +1027,32 @@ class Client(object):
         Close the client
         Usage: /exit
         """
+        if self.batcher is not None:
+            self.batcher.close()
+        self.session.close()
         exit()
 
+# parse a --tcp-address, given as HOST:PORT
+def tcpAddress(value):
+    host, _, port = value.rpartition(':')
+    if not host or not port.isdigit():
+        raise argparse.ArgumentTypeError("expected HOST:PORT, got %r" % value)
+    return (host, int(port))
+
 #
 # This is the actual code that constructs a Client object, takes user input and
 # calls methods on the client objects
 #
 
 if __name__ == "__main__":
-    client = Client()
+    parser = argparse.ArgumentParser(description='Run the chat client')
+    parser.add_argument('--transport', choices=['http', 'tcp'], default='http',
+                        help='talk to the server over HTTP, or TCP (see tcpserver.py)')
+    parser.add_argument('--tcp-address', type=tcpAddress,
+                        help='HOST:PORT the server listens on for TCP (default %s:%d)'
+                             % SERVER_TCP_ADDRESS)
+    args = parser.parse_args()
+    client = Client(transport=args.transport, tcp_address=args.tcp_address)
 
     # take user input until the end of time (or at least until this program
     # stops)
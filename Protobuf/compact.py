@@ -0,0 +1,184 @@
+import threading
+from array import array
+
+#
+# Compact in-memory representations for queued messages.
+#
+# With millions of queued messages the overhead of a Python object per message
+# (and per field of each message) is most of the memory the server uses. These
+# keep that state in flat arrays instead:
+#
+#   - an Interner gives every user and group name a small integer id, so a
+#     queue entry can refer to them without holding a reference to an object.
+#
+#   - a MessageArena holds the serialized bodies of queued messages in one
+#     shared bytearray. A body is stored once no matter how many queues it is
+#     in (e.g. a group message) and is referred to by a slot number.
+#
+#   - a RingBuffer holds a queue's entries as fixed size records of integers
+#     in a single array.
+#
+
+# Gives each distinct name an integer id. Ids are never reused.
+class Interner(object):
+    def __init__(self):
+        self.ids = {}
+        self.names = []
+        self.lock = threading.Lock()
+
+    # the id for a name, assigning one if it doesn't have one yet
+    def intern(self, name):
+        id = self.ids.get(name)
+        if id is None:
+            with self.lock:
+                id = self.ids.get(name)
+                if id is None:
+                    id = len(self.names)
+                    self.names.append(name)
+                    self.ids[name] = id
+        return id
+
+    # the name for an id
+    def name(self, id):
+        return self.names[id]
+
+# Serialized message bodies, stored back to back in one bytearray.
+#
+# Each stored body gets a slot, which records where the body is and how many
+# queues refer to it. When the last reference is released the slot is reused
+# and the bytes become garbage. Each slot also has a generation, bumped when it
+# is freed, so that a reference taken later (e.g. while a group message is
+# still being fanned out) can tell whether the slot still holds its body. Once
+# there is more garbage than live data the live bodies are copied into a new
+# bytearray (only the slots need updating, as queues hold slot numbers rather
+# than offsets).
+class MessageArena(object):
+    # don't bother compacting until there is at least this much garbage
+    MIN_GARBAGE = 1024 * 1024
+
+    def __init__(self):
+        self.data = bytearray()
+        # offsets can pass 4GB, everything else fits in 32 bits
+        self.offsets = array('L')
+        self.lengths = array('I')
+        self.refs = array('I')
+        self.generations = array('I')
+        self.free = []
+        self.live = 0
+        self.garbage = 0
+        self.lock = threading.Lock()
+
+    # store a body with a single reference, returning its slot
+    def store(self, body):
+        with self.lock:
+            if self.free:
+                slot = self.free.pop()
+                self.offsets[slot] = len(self.data)
+                self.lengths[slot] = len(body)
+                self.refs[slot] = 1
+            else:
+                slot = len(self.refs)
+                self.offsets.append(len(self.data))
+                self.lengths.append(len(body))
+                self.refs.append(1)
+                self.generations.append(0)
+            self.data.extend(body)
+            self.live += len(body)
+            return slot
+
+    # add a reference to the body stored in a slot in the given generation.
+    # Returns False if it has since been freed, in which case it must be stored
+    # again.
+    def retain(self, slot, generation):
+        with self.lock:
+            if self.generations[slot] != generation:
+                return False
+            self.refs[slot] += 1
+            return True
+
+    # drop a reference to a stored body, freeing it if it was the last
+    def release(self, slot):
+        with self.lock:
+            self.refs[slot] -= 1
+            if self.refs[slot] == 0:
+                self.generations[slot] = (self.generations[slot] + 1) & 0xffffffff
+                self.free.append(slot)
+                self.live -= self.lengths[slot]
+                self.garbage += self.lengths[slot]
+                if self.garbage > self.MIN_GARBAGE and self.garbage > self.live:
+                    self.compact()
+
+    # the size of the body in a slot
+    def size(self, slot):
+        return self.lengths[slot]
+
+    # the body in a slot
+    def get(self, slot):
+        with self.lock:
+            offset = self.offsets[slot]
+            return str(self.data[offset:offset + self.lengths[slot]])
+
+    # copy the live bodies into a new bytearray. Must hold the lock.
+    def compact(self):
+        data = bytearray()
+        for slot in xrange(len(self.refs)):
+            if self.refs[slot] > 0:
+                offset = self.offsets[slot]
+                self.offsets[slot] = len(data)
+                data.extend(self.data[offset:offset + self.lengths[slot]])
+        self.data = data
+        self.garbage = 0
+
+# A FIFO of fixed size records of unsigned 32 bit integers, kept in one array
+# that wraps around. The array starts empty and doubles when it fills up.
+class RingBuffer(object):
+    __slots__ = ('width', 'items', 'capacity', 'head', 'count')
+
+    def __init__(self, width):
+        self.width = width
+        self.items = array('I')
+        self.capacity = 0
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    # add a record (a tuple of width integers) to the end
+    def append(self, record):
+        if self.count == self.capacity:
+            self.grow()
+        start = ((self.head + self.count) % self.capacity) * self.width
+        self.items[start:start + self.width] = array('I', record)
+        self.count += 1
+
+    # the record at position i from the front
+    def peek(self, i=0):
+        start = ((self.head + i) % self.capacity) * self.width
+        return tuple(self.items[start:start + self.width])
+
+    # remove and return the first record
+    def popleft(self):
+        record = self.peek()
+        self.head = (self.head + 1) % self.capacity
+        self.count -= 1
+        if self.count == 0:
+            # nothing left, give the memory back
+            self.items = array('I')
+            self.capacity = 0
+            self.head = 0
+        return record
+
+    # iterate over the records, front first
+    def __iter__(self):
+        for i in xrange(self.count):
+            yield self.peek(i)
+
+    # double the capacity, unwrapping the records so they start at 0
+    def grow(self):
+        records = [self.peek(i) for i in xrange(self.count)]
+        self.capacity = max(16, self.capacity * 2)
+        self.items = array('I', [0]) * (self.capacity * self.width)
+        self.head = 0
+        for i, record in enumerate(records):
+            self.items[i * self.width:(i + 1) * self.width] = array('I', record)
@@ -0,0 +1,85 @@
+import threading
+import zlib
+
+#
+# Compressing request and response bodies.
+#
+# Message lists in particular compress well: every message repeats its field
+# keys, its sender and what it was sent to. A client says which encodings it
+# takes in Accept-Encoding, and we compress any response body of at least
+# MIN_BYTES with the first of ENCODINGS it takes, saying which in
+# Content-Encoding. Smaller bodies go as they are, as compressing them costs
+# more time than it saves bytes. Clients can compress request bodies the same
+# way. Over TCP the Envelope and Reply carry the same two headers as fields
+# (see tcpserver.py).
+#
+# Both encodings are zlib's deflate: gzip is deflate with a gzip header, and
+# what HTTP calls deflate has a zlib header.
+#
+
+# the encodings we speak, best first
+ENCODINGS = ('gzip', 'deflate')
+
+# bodies smaller than this many bytes are sent as they are
+MIN_BYTES = 1024
+
+# The zlib compression level, from 1 (fastest) to 9 (smallest). On message
+# lists level 1 takes out 70-75% of the bytes, and higher levels only a few
+# percent more for several times the time (see bench/compression.py).
+LEVEL = 1
+
+# the window size zlib is told to use for each encoding, which also picks the
+# header it writes and expects
+WINDOW_BITS = {'gzip': 16 + zlib.MAX_WBITS, 'deflate': zlib.MAX_WBITS}
+
+# compress data with encoding
+def compress(data, encoding, level=LEVEL):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, WINDOW_BITS[encoding])
+    return compressor.compress(data) + compressor.flush()
+
+# Decompress data sent with encoding. Raises a ValueError if the encoding
+# isn't one of ours, the data is corrupt, or it would decompress to more than
+# maxBytes.
+def decompress(data, encoding, maxBytes):
+    if encoding not in WINDOW_BITS:
+        raise ValueError("Unsupported encoding %s" % encoding)
+    decompressor = zlib.decompressobj(WINDOW_BITS[encoding])
+    try:
+        decompressed = decompressor.decompress(data, maxBytes)
+        if decompressor.unconsumed_tail:
+            raise ValueError("Decompresses to more than %d bytes" % maxBytes)
+        return decompressed + decompressor.flush()
+    except zlib.error as e:
+        raise ValueError(str(e))
+
+# Compresses bodies that are worth it, and counts how much it saved
+class Compressor(object):
+    def __init__(self, minBytes=MIN_BYTES, level=LEVEL):
+        self.minBytes = minBytes
+        self.level = level
+        self.lock = threading.Lock()
+        # totals for the bodies we compressed
+        self.compressed = 0
+        self.bytesIn = 0
+        self.bytesOut = 0
+
+    # Returns data compressed with encoding, or None if there is no encoding,
+    # data is too small to bother or compressing doesn't make it smaller
+    def compress(self, data, encoding):
+        if encoding is None or len(data) < self.minBytes:
+            return None
+        compressed = compress(data, encoding, self.level)
+        if len(compressed) >= len(data):
+            return None
+        with self.lock:
+            self.compressed += 1
+            self.bytesIn += len(data)
+            self.bytesOut += len(compressed)
+        return compressed
+
+# The body of a request (or response) sent with the given Content-Encoding,
+# decompressed if it was compressed, see decompress
+def decodeBody(data, encoding, maxBytes):
+    if encoding in (None, '', 'identity'):
+        return data
+    return decompress(data, encoding, maxBytes)
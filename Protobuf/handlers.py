@@ -0,0 +1,163 @@
+from build.protobufs import request_pb2 as RequestProtoBuf
+from build.protobufs import response_pb2 as ResponseProtoBuf
+from model import User, Group, UserError, GroupMessage, DirectMessage
+from wire import encodeRepeated, fieldNumber
+
+#
+# The operations that change the server's users, groups and messages, with the
+# checks on their arguments. These don't know anything about HTTP, so the same
+# operation behaves the same whether it came in its own request (see
+# server.py) or as part of a batch (see applyBatch).
+#
+# Each one raises a UserError if the arguments are invalid, and otherwise
+# returns the object it created or changed. Checks that a user or group
+# exists (or doesn't) are made with the list's lock held until the change is
+# made, so that another thread can't create or delete it in between.
+#
+# On a sharded server (see sharding.py) messages are passed the server's
+# ShardMap as shards, and are refused unless the user or group they are sent
+# to belongs to this shard.
+#
+
+Operation = RequestProtoBuf.Operation
+
+# Creates a user and adds it to users.
+def createUser(users, username):
+    if not username.isalnum():
+        raise UserError("Invalid Username, Must Be Alphanumeric")
+
+    with users.lock:
+        if users.usernameExists(username):
+            raise UserError("User Exists")
+        user = User(username)
+        users.addUser(user)
+    return user
+
+# Deletes a user, removing them from any groups they may have joined and
+# dropping their undelivered messages.
+def deleteUser(users, groups, username):
+    with users.lock:
+        user = users.getUser(username)
+        if user is None:
+            raise UserError("Missing User")
+        users.deleteUser(username)
+        groups.pruneUser(user)
+
+# Creates a group with no members and adds it to groups.
+def createGroup(groups, groupname):
+    if not groupname.isalnum():
+        raise UserError("Invalid Groupname, Must Be Alphanumeric")
+
+    with groups.lock:
+        if groups.groupnameExists(groupname):
+            raise UserError("Group Exists")
+        group = Group(groupname)
+        groups.addGroup(group)
+    return group
+
+# Adds a user to a group by name.
+def addMember(users, groups, groupname, username):
+    group = groups.getGroup(groupname)
+    if group is None:
+        raise UserError("Missing Group")
+
+    # a user being deleted mustn't be added after they have been pruned
+    with users.lock:
+        if not users.usernameExists(username):
+            raise UserError("User does not exist")
+        group.addUser(users.getUser(username))
+    return group
+
+# Checks a message from a client (a request Message protobuf), returning the
+# text and the user sending it.
+def decodeSender(users, message):
+    if message.msg is None or message.msg == '':
+        raise UserError("Invaid Message Body")
+
+    fromUser = users.getUser(message.frm)
+    if fromUser is None:
+        raise UserError("Invalid from User")
+
+    return message.msg, fromUser
+
+# Checks that a user or group belongs to this shard, if the server is sharded
+def checkShard(shards, name):
+    if shards is not None and not shards.isLocal(name):
+        raise UserError("Wrong Shard")
+
+# Sends a message from a client to a user.
+def sendDirectMessage(users, username, message, shards=None):
+    checkShard(shards, username)
+    msg, fromUser = decodeSender(users, message)
+    toUser = users.getUser(username)
+    if toUser is None:
+        raise UserError("Missing To User")
+
+    directMessage = DirectMessage(fromUser, toUser, msg)
+    toUser.receiveMessage(directMessage)
+    return directMessage
+
+# Sends a message from a client to every member of a group. When sharded the
+# members on other shards get it from their shard.
+def sendGroupMessage(users, groups, groupname, message, shards=None):
+    checkShard(shards, groupname)
+    msg, fromUser = decodeSender(users, message)
+    toGroup = groups.getGroup(groupname)
+    if toGroup is None:
+        raise UserError("Missing To Group")
+
+    groupMessage = GroupMessage(fromUser, toGroup, msg)
+    if shards is not None:
+        shards.fanOut(toGroup, groupMessage)
+    else:
+        toGroup.receiveMessage(groupMessage, users)
+    return groupMessage
+
+#
+# Batches
+#
+
+RESULTS_FIELD = fieldNumber(ResponseProtoBuf.BatchResponse, 'results')
+USER_FIELD = fieldNumber(ResponseProtoBuf.BatchResult, 'user')
+GROUP_FIELD = fieldNumber(ResponseProtoBuf.BatchResult, 'group')
+MESSAGE_FIELD = fieldNumber(ResponseProtoBuf.BatchResult, 'message')
+ERROR_FIELD = fieldNumber(ResponseProtoBuf.BatchResult, 'error')
+
+# Applies one operation from a batch, returning its serialized BatchResult.
+# Messages are spliced in from their cached encoding.
+def applyOperation(users, groups, operation, shards=None):
+    try:
+        if operation.type == Operation.CREATE_USER:
+            user = createUser(users, operation.username)
+            return encodeRepeated(USER_FIELD, [user.serializeToString()])
+
+        elif operation.type == Operation.CREATE_GROUP:
+            group = createGroup(groups, operation.groupname)
+            return encodeRepeated(GROUP_FIELD, [group.serializeToString()])
+
+        elif operation.type == Operation.ADD_MEMBER:
+            # a group can have a great many members, so unlike the single
+            # request this doesn't send them all back
+            group = addMember(users, groups, operation.groupname, operation.username)
+            summary = ResponseProtoBuf.Group(groupname=group.groupname)
+            return encodeRepeated(GROUP_FIELD, [summary.SerializeToString()])
+
+        elif operation.type == Operation.DIRECT_MESSAGE:
+            message = sendDirectMessage(users, operation.username, operation.message, shards)
+            return encodeRepeated(MESSAGE_FIELD, [message.serializeToString()])
+
+        elif operation.type == Operation.GROUP_MESSAGE:
+            message = sendGroupMessage(users, groups, operation.groupname, operation.message,
+                                       shards)
+            return encodeRepeated(MESSAGE_FIELD, [message.serializeToString()])
+
+        raise UserError("Invalid Operation")
+    except UserError as ue:
+        return encodeRepeated(ERROR_FIELD, [ue.serialize().SerializeToString()])
+
+# Applies every operation in a Batch in order, returning a serialized
+# BatchResponse. An operation that fails doesn't stop the ones after it, its
+# result is just the UserError.
+def applyBatch(users, groups, batch, shards=None):
+    return encodeRepeated(RESULTS_FIELD,
+                          [applyOperation(users, groups, op, shards) for op in batch.operations])
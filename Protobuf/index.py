@@ -0,0 +1,243 @@
+import re
+import threading
+from collections import OrderedDict
+
+#
+# An index over a set of names (usernames or group names) that answers the
+# wildcard queries used by /v1/users?q= and /v1/groups?q= without looking at
+# every name.
+#
+# A query is alphanumeric characters and asterisks, where an asterisk matches
+# any run of characters. Queries are matched from the start of the name but
+# need not match all of it, so J*k matches Jack, Jak and Jackson.
+#
+# Names are kept in two structures:
+#
+#   - a radix trie, which lists every name starting with a prefix in sorted
+#     order. Queries that don't start with an asterisk only need to look at
+#     the names under their leading literal.
+#
+#   - trigram postings, mapping every 3 character substring to the names that
+#     contain it. Queries starting with an asterisk intersect the postings of
+#     their longest literal to find candidates.
+#
+# Candidates are then checked against the compiled query.
+#
+
+# The number of compiled queries to keep around
+PATTERN_CACHE_SIZE = 256
+
+# How many names to pull out of the trie at a time while iterating
+WALK_BATCH = 256
+
+_patterns = OrderedDict()
+_patternsLock = threading.Lock()
+
+# compile a query into a regex, reusing recently compiled queries
+def compileQuery(query):
+    with _patternsLock:
+        pattern = _patterns.pop(query, None)
+        if pattern is None:
+            pattern = re.compile(query.replace('*', '.*'))
+            if len(_patterns) >= PATTERN_CACHE_SIZE:
+                _patterns.popitem(last=False)
+        _patterns[query] = pattern
+        return pattern
+
+# every distinct 3 character substring of a string
+def trigrams(s):
+    return set(s[i:i + 3] for i in xrange(len(s) - 2))
+
+# A node in the radix trie. The label is the part of the name on the edge
+# leading to this node, and terminal is set if a name ends here.
+class TrieNode(object):
+    __slots__ = ('label', 'children', 'terminal')
+
+    def __init__(self, label, terminal=False):
+        self.label = label
+        self.children = {}
+        self.terminal = terminal
+
+class NameIndex(object):
+    def __init__(self):
+        self.root = TrieNode('')
+        self.postings = {}
+        self.lock = threading.Lock()
+
+    # add a name to the index
+    def add(self, name):
+        with self.lock:
+            self._insert(name)
+            for trigram in trigrams(name):
+                self.postings.setdefault(trigram, set()).add(name)
+
+    # remove a name from the index
+    def remove(self, name):
+        with self.lock:
+            self._delete(name)
+            for trigram in trigrams(name):
+                names = self.postings.get(trigram)
+                if names is not None:
+                    names.discard(name)
+                    if not names:
+                        del self.postings[trigram]
+
+    # iterate over all the names matching a query, in sorted order. If after
+    # is given, only names that sort after it are returned (this is how
+    # listings are paged through).
+    def match(self, query, after=None):
+        segments = query.split('*')
+        prefix = segments[0]
+
+        # a plain name or prefix query needs no checking, everything under the
+        # prefix in the trie matches
+        if len(segments) == 1 or (len(segments) == 2 and segments[1] == ''):
+            return self.iterPrefix(prefix, after)
+
+        pattern = compileQuery(query)
+        if prefix:
+            candidates = self.iterPrefix(prefix, after)
+        else:
+            candidates = self._trigramCandidates(max(segments, key=len), after)
+        return (name for name in candidates if pattern.match(name))
+
+    # iterate over all the names starting with prefix (and sorting after
+    # after), in sorted order. The trie is walked a batch at a time, so the
+    # index can change while the caller is consuming the names and we never
+    # copy more of it than the caller asks for.
+    def iterPrefix(self, prefix, after=None):
+        while True:
+            with self.lock:
+                batch = self._collect(prefix, after, WALK_BATCH)
+            for name in batch:
+                yield name
+            if len(batch) < WALK_BATCH:
+                return
+            after = batch[-1]
+
+    # names that contain all of the trigrams in literal, in sorted order. With
+    # fewer than 3 characters we can't narrow anything down, so that's all of
+    # them.
+    def _trigramCandidates(self, literal, after):
+        if len(literal) < 3:
+            return self.iterPrefix('', after)
+
+        with self.lock:
+            postings = [self.postings.get(t) for t in trigrams(literal)]
+            if not all(postings):
+                return iter([])
+            postings.sort(key=len)
+            candidates = set(postings[0])
+            for names in postings[1:]:
+                candidates &= names
+        if after is not None:
+            candidates = [name for name in candidates if name > after]
+        return iter(sorted(candidates))
+
+    # collect up to limit names starting with prefix that sort after after
+    def _collect(self, prefix, after, limit):
+        node, path = self._find(prefix)
+        if node is None:
+            return []
+
+        names = []
+        for name in self._walk(node, path, after):
+            names.append(name)
+            if len(names) == limit:
+                break
+        return names
+
+    # find the node for a prefix, returning the node and the full string
+    # leading to it (which may run past the prefix if the prefix ends part way
+    # along an edge)
+    def _find(self, prefix):
+        node = self.root
+        path = ''
+        i = 0
+        while i < len(prefix):
+            child = node.children.get(prefix[i])
+            if child is None:
+                return None, None
+            label = child.label
+            remaining = prefix[i:]
+            if label.startswith(remaining):
+                return child, path + label
+            if not remaining.startswith(label):
+                return None, None
+            node = child
+            path += label
+            i += len(label)
+        return node, path
+
+    # yield every name in the subtree under node in sorted order, skipping
+    # any that don't sort after after. Whole subtrees that sort before after
+    # are never visited.
+    def _walk(self, node, path, after=None):
+        stack = [(node, path)]
+        while stack:
+            node, path = stack.pop()
+            if node.terminal and (after is None or path > after):
+                yield path
+            for key in sorted(node.children, reverse=True):
+                child = node.children[key]
+                childPath = path + child.label
+                if after is not None and childPath < after and not after.startswith(childPath):
+                    continue
+                stack.append((child, childPath))
+
+    def _insert(self, name):
+        node = self.root
+        i = 0
+        while i < len(name):
+            child = node.children.get(name[i])
+            if child is None:
+                node.children[name[i]] = TrieNode(name[i:], terminal=True)
+                return
+
+            label = child.label
+            common = 0
+            while common < len(label) and i + common < len(name) and label[common] == name[i + common]:
+                common += 1
+
+            # the edge doesn't fully match, so split it where it diverges
+            if common < len(label):
+                middle = TrieNode(label[:common])
+                child.label = label[common:]
+                middle.children[child.label[0]] = child
+                node.children[name[i]] = middle
+                child = middle
+
+            node = child
+            i += common
+        node.terminal = True
+
+    def _delete(self, name):
+        # find the node for the name, remembering how we got there
+        parents = []
+        node = self.root
+        i = 0
+        while i < len(name):
+            child = node.children.get(name[i])
+            if child is None or not name.startswith(child.label, i):
+                return
+            parents.append(node)
+            node = child
+            i += len(child.label)
+
+        if not node.terminal:
+            return
+        node.terminal = False
+        if node is self.root:
+            return
+
+        # drop the node if it's now a leaf, then merge whatever is left with its
+        # only child so that the trie stays compressed
+        parent = parents[-1]
+        if not node.children:
+            del parent.children[node.label[0]]
+            node = parent
+            parent = parents[-2] if len(parents) > 1 else None
+        if parent is not None and not node.terminal and len(node.children) == 1:
+            (child,) = node.children.values()
+            child.label = node.label + child.label
+            parent.children[child.label[0]] = child
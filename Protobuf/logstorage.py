@@ -0,0 +1,406 @@
+import os
+import threading
+import time
+from build.protobufs import response_pb2 as ResponseProtoBuf
+from build.protobufs import storage_pb2 as StorageProtoBuf
+from google.protobuf.message import DecodeError
+from model import NAMES, User, UserList, Group, GroupList, DirectMessage, GroupMessage
+from storage import Storage
+from wire import frame, readFrame
+
+#
+# A Storage backend that keeps a write-ahead log on disk, so that users, groups
+# and undelivered messages survive a restart.
+#
+# Every change is appended to the log as a LogRecord (see storage.proto) in a
+# frame (see wire.py). Records are handed to a writer thread which writes out
+# everything that has built up since its last write and then fsyncs once, so
+# under load many records share one fsync (group commit). A request only has to
+# wait for the fsync covering its own records (see commit).
+#
+# The log is split into numbered segments. Once the current segment grows past
+# SEGMENT_BYTES the writer moves on to a new one, and a background thread
+# compacts the old ones: it replays the latest snapshot and the finished
+# segments into a fresh set of collections, writes their state out as a new
+# snapshot, then deletes the files it replaced. This never touches the live
+# collections, so the server doesn't pause while it happens.
+#
+# At startup the latest snapshot and every segment after it are replayed.
+#
+
+# How large a segment gets before we start a new one and compact
+SEGMENT_BYTES = 64 * 1024 * 1024
+
+Record = StorageProtoBuf.LogRecord
+
+class LogStorage(Storage):
+    def __init__(self, directory, segmentBytes=SEGMENT_BYTES):
+        self.directory = directory
+        self.segmentBytes = segmentBytes
+
+        # framed records waiting for the writer, and how many records have
+        # been appended and made durable so far
+        self.lock = threading.Condition()
+        self.pending = []
+        self.appended = 0
+        self.durable = 0
+        self.error = None
+        self.closed = False
+
+        # the position of the last record appended by each thread
+        self.local = threading.local()
+
+        # the open segment, only touched by the writer thread once running
+        self.segment = None
+        self.segmentNumber = 0
+        self.segmentSize = 0
+
+        self.compactor = None
+        self.replaying = False
+        self.replayTime = None
+
+    #
+    # Startup
+    #
+
+    # replay the snapshot and log into users and groups, then start logging
+    def load(self, users, groups):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        start = time.time()
+        snapshot, segments = self.files()
+
+        # the log records every message removed from a queue, so the queues
+        # mustn't drop or expire any more of their own while we replay it
+        self.replaying = True
+        limits = users.queueLimits
+        if limits is not None:
+            limits.enforced = False
+        count = 0
+        if snapshot is not None:
+            count += replay(self.snapshotPath(snapshot), users, groups)
+        for number in segments:
+            if snapshot is None or number > snapshot:
+                count += replay(self.segmentPath(number), users, groups)
+        if limits is not None:
+            limits.enforced = True
+        self.replaying = False
+
+        self.replayTime = time.time() - start
+        print "Replayed %d log records in %.3fs" % (count, self.replayTime)
+
+        self.segmentNumber = max(segments + [snapshot or 0]) + 1
+        self.segment = open(self.segmentPath(self.segmentNumber), 'ab')
+
+        writer = threading.Thread(target=self.write, name='log-writer')
+        writer.daemon = True
+        writer.start()
+
+    #
+    # Storage methods
+    #
+
+    def addUser(self, username):
+        self.append(Record(type=Record.ADD_USER, username=username))
+
+    def deleteUser(self, username):
+        self.append(Record(type=Record.DELETE_USER, username=username))
+
+    def addGroup(self, groupname):
+        self.append(Record(type=Record.ADD_GROUP, groupname=groupname))
+
+    def addMember(self, groupname, username):
+        self.append(Record(type=Record.ADD_MEMBER, groupname=groupname, username=username))
+
+    def sendDirectMessage(self, message):
+        self.append(Record(type=Record.DIRECT_MESSAGE, frm=message.frm.username,
+                           username=message.to.username, msg=message.msg,
+                           queued=time.time()))
+
+    def sendGroupMessage(self, message):
+        self.append(Record(type=Record.GROUP_MESSAGE, frm=message.frm.username,
+                           groupname=message.to.groupname, msg=message.msg,
+                           queued=time.time()))
+
+    def deliverMessage(self, message, usernames):
+        self.append(Record(type=Record.DELIVERY, frm=message.frm.username,
+                           groupname=message.to.groupname, msg=message.msg,
+                           usernames=usernames, queued=time.time()))
+
+    def flushMessages(self, username, count):
+        self.append(Record(type=Record.FLUSH, username=username, count=count))
+
+    # wait for the writer to fsync everything this thread has appended
+    def commit(self):
+        position = getattr(self.local, 'position', 0)
+        with self.lock:
+            while self.durable < position and self.error is None:
+                self.lock.wait()
+            if self.error is not None:
+                raise self.error
+
+    # write out everything pending and stop the writer
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.lock.notify_all()
+            while self.durable < self.appended and self.error is None:
+                self.lock.wait()
+
+    #
+    # Writing
+    #
+
+    # queue a record for the writer
+    def append(self, record):
+        if self.replaying:
+            return
+
+        data = frame(record.SerializeToString())
+        with self.lock:
+            self.pending.append(data)
+            self.appended += 1
+            self.local.position = self.appended
+            self.lock.notify_all()
+
+    # the writer thread, writes and fsyncs batches of pending records
+    def write(self):
+        while True:
+            with self.lock:
+                while not self.pending and not self.closed:
+                    self.lock.wait()
+                if not self.pending:
+                    self.segment.close()
+                    return
+                batch = self.pending
+                self.pending = []
+                position = self.appended
+
+            try:
+                data = ''.join(batch)
+                self.segment.write(data)
+                self.segment.flush()
+                os.fsync(self.segment.fileno())
+                self.segmentSize += len(data)
+                if self.segmentSize >= self.segmentBytes:
+                    self.rotate()
+            except (IOError, OSError) as e:
+                with self.lock:
+                    self.error = e
+                    self.lock.notify_all()
+                return
+
+            with self.lock:
+                self.durable = position
+                self.lock.notify_all()
+
+    # start a new segment, and compact the finished ones if we aren't already
+    def rotate(self):
+        self.segment.close()
+        finished = self.segmentNumber
+        self.segmentNumber += 1
+        self.segment = open(self.segmentPath(self.segmentNumber), 'ab')
+        self.segmentSize = 0
+
+        if self.compactor is None or not self.compactor.is_alive():
+            self.compactor = threading.Thread(target=self.compact, args=(finished,),
+                                              name='log-compactor')
+            self.compactor.daemon = True
+            self.compactor.start()
+
+    #
+    # Compaction
+    #
+
+    # fold every segment up to and including upto into a new snapshot
+    def compact(self, upto):
+        snapshot, segments = self.files()
+        segments = [n for n in segments if n <= upto and (snapshot is None or n > snapshot)]
+        if not segments:
+            return
+
+        users, groups = UserList(), GroupList()
+        if snapshot is not None:
+            replay(self.snapshotPath(snapshot), users, groups)
+        for number in segments:
+            replay(self.segmentPath(number), users, groups)
+
+        path = self.snapshotPath(upto)
+        with open(path + '.tmp', 'wb') as f:
+            writeSnapshot(f, users, groups)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(path + '.tmp', path)
+
+        if snapshot is not None:
+            os.remove(self.snapshotPath(snapshot))
+        for number in segments:
+            os.remove(self.segmentPath(number))
+
+    #
+    # Files
+    #
+
+    def snapshotPath(self, number):
+        return os.path.join(self.directory, 'snapshot-%08d.log' % number)
+
+    def segmentPath(self, number):
+        return os.path.join(self.directory, 'wal-%08d.log' % number)
+
+    # the number of the latest snapshot (or None) and the numbers of all the
+    # log segments, in order
+    def files(self):
+        snapshots = []
+        segments = []
+        for name in os.listdir(self.directory):
+            if name.startswith('snapshot-') and name.endswith('.log'):
+                snapshots.append(int(name[9:-4]))
+            elif name.startswith('wal-') and name.endswith('.log'):
+                segments.append(int(name[4:-4]))
+        return (max(snapshots) if snapshots else None), sorted(segments)
+
+#
+# Replaying
+#
+
+# apply every record in a log file to users and groups, returning how many
+# records there were. Stops at the first incomplete or corrupt record, which
+# is what is left behind if the server died part way through a write.
+def replay(path, users, groups):
+    count = 0
+    queued = {}
+    with open(path, 'rb') as f:
+        while True:
+            data = readFrame(f)
+            if data is None:
+                break
+            record = Record()
+            try:
+                record.ParseFromString(data)
+            except DecodeError:
+                break
+            apply(record, users, groups, queued)
+            count += 1
+    return count
+
+# the user object to use as a message's sender. The sender may since have been
+# deleted, in which case (like a live message) it holds its own user object.
+def sender(users, username):
+    return users.getUser(username) or User(username)
+
+# when the message in a record was queued, or None (for now) if the record
+# doesn't say, as in logs written before records kept it. Queued messages
+# keep their time, so they expire when they would have had the server not
+# restarted.
+def queuedTime(record):
+    return record.queued if record.HasField('queued') else None
+
+# make the change a record describes, the same way the server would have
+def apply(record, users, groups, queued):
+    if record.type == Record.ADD_USER:
+        users.addUser(User(record.username))
+
+    elif record.type == Record.DELETE_USER:
+        user = users.getUser(record.username)
+        if user is not None:
+            users.deleteUser(record.username)
+            groups.pruneUser(user)
+
+    elif record.type == Record.ADD_GROUP:
+        groups.addGroup(Group(record.groupname))
+
+    elif record.type == Record.ADD_MEMBER:
+        group = groups.getGroup(record.groupname)
+        user = users.getUser(record.username)
+        if group is not None and user is not None:
+            group.addUser(user)
+
+    elif record.type == Record.DIRECT_MESSAGE:
+        to = users.getUser(record.username)
+        if to is not None:
+            to.queueMessage(DirectMessage(sender(users, record.frm), to, record.msg),
+                            queuedTime(record))
+
+    elif record.type == Record.GROUP_MESSAGE:
+        group = groups.getGroup(record.groupname)
+        if group is not None:
+            group.receiveMessage(GroupMessage(sender(users, record.frm), group, record.msg), users,
+                                 queuedTime(record))
+
+    elif record.type == Record.DELIVERY:
+        group = groups.getGroup(record.groupname)
+        if group is not None:
+            recipients = [users.getUser(username) for username in record.usernames]
+            group.deliverMessage(GroupMessage(sender(users, record.frm), group, record.msg),
+                                 [user for user in recipients if user is not None],
+                                 queuedTime(record))
+
+    elif record.type == Record.FLUSH:
+        user = users.getUser(record.username)
+        if user is not None:
+            user.discardMessages(record.count)
+
+    elif record.type == Record.QUEUED:
+        user = users.getUser(record.username)
+        if user is None:
+            return
+        message = queued.get(record.messageId)
+        if message is None:
+            if record.HasField('groupname'):
+                message = GroupMessage(sender(users, record.frm),
+                                       groups.getGroup(record.groupname), record.msg)
+            else:
+                message = DirectMessage(sender(users, record.frm), user, record.msg)
+            queued[record.messageId] = message
+        user.queueMessage(message, queuedTime(record))
+
+# write the state of users and groups to f as records that will rebuild it.
+# Queued messages are written per recipient as QUEUED records, with a group
+# message that is queued for several users sharing a messageId so it is only
+# rebuilt once. Queues only hold serialized messages, so those are parsed for
+# the message text (and, for spilled messages, who they were from and to).
+# Messages a user has still to read from group timelines come after the rest
+# of their queue, and are queued for them directly when the snapshot is
+# loaded. Each record keeps when its message was queued (or posted to the
+# timeline), so messages don't get longer to live by being snapshotted.
+def writeSnapshot(f, users, groups):
+    for user in users.users.values():
+        f.write(frame(Record(type=Record.ADD_USER, username=user.username).SerializeToString()))
+
+    for group in groups.groups.values():
+        f.write(frame(Record(type=Record.ADD_GROUP, groupname=group.groupname).SerializeToString()))
+        for user in group.users:
+            f.write(frame(Record(type=Record.ADD_MEMBER, groupname=group.groupname,
+                                 username=user.username).SerializeToString()))
+
+    # messages in memory are identified by their (shared) arena slot, spilled
+    # ones are numbered and those in timelines by their sequence number,
+    # keeping them apart by the remainder when divided by three
+    message = ResponseProtoBuf.Message()
+    spilled = 0
+    for user in users.users.values():
+        for queued, sender, recipient, key, wire in user.undeliveredMessages.entries():
+            message.ParseFromString(wire)
+            if key is None:
+                messageId = spilled * 3 + 1
+                spilled += 1
+                frm = message.frm.username
+            else:
+                messageId = key * 3
+                frm = NAMES.name(sender)
+            record = Record(type=Record.QUEUED, username=user.username,
+                            frm=frm, msg=message.msg, messageId=messageId, queued=queued)
+            if message.type == ResponseProtoBuf.Message.GROUP:
+                if key is None:
+                    record.groupname = message.toGroupname or message.toGroup.groupname
+                else:
+                    record.groupname = NAMES.name(recipient)
+            f.write(frame(record.SerializeToString()))
+
+        for seq, posted, groupMessage in user.timelineMessages():
+            record = Record(type=Record.QUEUED, username=user.username,
+                            frm=groupMessage.frm.username, msg=groupMessage.msg,
+                            groupname=groupMessage.to.groupname, messageId=seq * 3 + 2,
+                            queued=posted)
+            f.write(frame(record.SerializeToString()))
@@ -0,0 +1,137 @@
+import bisect
+import threading
+from collections import deque
+
+#
+# Counters and latency histograms for the server's routes, served in the
+# Prometheus text format (see GET /metrics in server.py).
+#
+# This is on for every request, so recording one has to be cheap: observe
+# just appends a tuple to a deque, which is safe to do from any thread
+# without a lock. The tuples are added up into the totals (with a lock, by
+# one thread at a time) when the metrics are read, or every DRAIN_SIZE
+# requests by whichever request gets there, skipping it if another thread is
+# already at it.
+#
+
+# the upper bounds of the latency histogram buckets, in seconds
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+                   1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# how many observations may pile up before a request adds them up
+DRAIN_SIZE = 1000
+
+# The totals for one route. buckets[i] counts requests that took at most
+# LATENCY_BUCKETS[i] (and more than the bound before), the last counts the
+# rest.
+class RouteTotals(object):
+    __slots__ = ('requests', 'userErrors', 'serverErrors', 'seconds', 'requestBytes',
+                 'responseBytes', 'buckets')
+
+    def __init__(self):
+        self.requests = 0
+        self.userErrors = 0
+        self.serverErrors = 0
+        self.seconds = 0.0
+        self.requestBytes = 0
+        self.responseBytes = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS) + 1)
+
+class Metrics(object):
+    def __init__(self, prefix='chat'):
+        self.prefix = prefix
+        # observations not yet added to the totals
+        self.pending = deque()
+        # held while adding them up
+        self.lock = threading.Lock()
+        self.routes = {}
+        # (name, kind, help, function) for each value read when rendering, see
+        # gauge
+        self.gauges = []
+
+    # record a request to route that took seconds and was answered with
+    # status
+    def observe(self, route, seconds, status, requestBytes, responseBytes):
+        self.pending.append((route, seconds, status, requestBytes, responseBytes))
+        if len(self.pending) >= DRAIN_SIZE:
+            self.drain(False)
+
+    # add the pending observations to the totals. If block is False and
+    # another thread is already doing it, leave it to them.
+    def drain(self, block=True):
+        if not self.lock.acquire(block):
+            return
+        try:
+            pending = self.pending
+            while pending:
+                route, seconds, status, requestBytes, responseBytes = pending.popleft()
+                totals = self.routes.get(route)
+                if totals is None:
+                    totals = self.routes[route] = RouteTotals()
+                totals.requests += 1
+                if status >= 500:
+                    totals.serverErrors += 1
+                elif status >= 400:
+                    totals.userErrors += 1
+                totals.seconds += seconds
+                totals.requestBytes += requestBytes
+                totals.responseBytes += responseBytes
+                totals.buckets[bisect.bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        finally:
+            self.lock.release()
+
+    # add a gauge, whose value is read by calling function when the metrics
+    # are rendered. Counters kept elsewhere can be added the same way with a
+    # kind of 'counter'.
+    def gauge(self, name, help, function, kind='gauge'):
+        self.gauges.append((name, kind, help, function))
+
+    # the metrics in the Prometheus text format
+    def render(self):
+        self.drain()
+        with self.lock:
+            routes = sorted(self.routes.items())
+            lines = []
+
+            def family(name, kind, help, samples):
+                name = '%s_%s' % (self.prefix, name)
+                lines.append('# HELP %s %s' % (name, help))
+                lines.append('# TYPE %s %s' % (name, kind))
+                for suffix, labels, value in samples:
+                    lines.append('%s%s%s %s' % (name, suffix, labels, formatValue(value)))
+
+            def perRoute(name, help, field):
+                family(name, 'counter', help,
+                       [('', '{route="%s"}' % route, getattr(totals, field))
+                        for route, totals in routes])
+
+            perRoute('requests_total', 'Requests handled, by route.', 'requests')
+            perRoute('user_errors_total', 'Requests refused with a UserError, by route.',
+                     'userErrors')
+            perRoute('server_errors_total', 'Requests that failed with a server error, by route.',
+                     'serverErrors')
+            perRoute('request_bytes_total', 'Bytes received in request bodies, by route.',
+                     'requestBytes')
+            perRoute('response_bytes_total',
+                     'Bytes sent in response bodies, by route. Streamed responses are not counted.',
+                     'responseBytes')
+
+            samples = []
+            for route, totals in routes:
+                cumulative = 0
+                for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), totals.buckets):
+                    cumulative += count
+                    samples.append(('_bucket', '{route="%s",le="%s"}' % (route, bound),
+                                    cumulative))
+                samples.append(('_sum', '{route="%s"}' % route, totals.seconds))
+                samples.append(('_count', '{route="%s"}' % route, totals.requests))
+            family('request_seconds', 'histogram', 'How long requests took, by route.', samples)
+
+        for name, kind, help, function in self.gauges:
+            family(name, kind, help, [('', '', function())])
+        return '\n'.join(lines) + '\n'
+
+def formatValue(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
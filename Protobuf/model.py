@@ -1,6 +1,15 @@
-import re
-from sets import Set
+import itertools
+import threading
+import time
+from collections import deque
 from build.protobufs import response_pb2 as ResponseProtoBuf
+from cache import ChangeLog, ListingCache
+from compact import Interner, MessageArena, RingBuffer
+from index import NameIndex
+from queues import SpillFile
+from storage import Storage
+from wire import (encodeRepeated, encodeString, encodeUint, encodeWrapped, fieldNumber,
+                  paginate, splitField)
 
 #
 # These are effectively syntatic sugar for the ProtoBufs. They allow us to set
@@ -10,13 +19,78 @@ from build.protobufs import response_pb2 as ResponseProtoBuf
 # We prefer them to the protobuf representations because it allows us to use
 # OOP and extend our types with custom methods.
 #
+# UserList and GroupList are given a Storage (see storage.py), which they and
+# their users and groups tell about every change before making it. Objects that
+# don't belong to a list use NO_STORAGE, which keeps nothing.
+#
+# There can be a great many users, groups and messages, so these classes use
+# __slots__ rather than a __dict__ per object. Users and groups also get an
+# integer id from NAMES, which is what message queues refer to them by.
+#
+# The server handles requests on many threads at once, so:
+#
+#   - each user's queue is only touched with the user's lock held.
+#
+#   - UserList and GroupList have a lock that is held while adding or removing
+#     users and groups. Anything that checks whether a user or group exists
+#     before changing the lists (see handlers.py) holds it for both.
+#
+#   - a group's members are a frozenset which is replaced, never changed, when
+#     someone joins or leaves. Sending to a group or listing its members works
+#     on the set as it was when it started, without taking a lock. Each user
+#     keeps the groups they belong to in the same way, replaced with
+#     MEMBERSHIP_LOCK held.
+#
+#   - a group's Timeline, and its members' cursors into it, are only touched
+#     with the group's lock held. A user catching up on timelines holds their
+#     own lock and then each group's in turn, so a group never takes a user's
+#     lock while holding its own. Each user's cursors are a dict which, like
+#     their groups, is replaced with MEMBERSHIP_LOCK held rather than changed,
+#     as different groups update it holding only their own locks.
+#
+#   - reading users and groups by name doesn't take a lock.
+#
+
+NO_STORAGE = Storage()
+
+# held while changing the groups a user belongs to
+MEMBERSHIP_LOCK = threading.Lock()
+
+# the kinds of change recorded in the lists' ChangeLogs (see cache.py)
+Change = ResponseProtoBuf.Change
+
+# numbers every message added to a Timeline, so that a user reading several
+# timelines gets their messages in the order they were sent
+TIMELINE_SEQUENCE = itertools.count()
+
+# ids for user and group names
+NAMES = Interner()
 
 # A single user
 class User(object):
+    __slots__ = ('username', 'id', 'undeliveredMessages', 'messageAvailable', 'waiters',
+                 'groups', 'cursors', 'storage')
+    USERNAME_FIELD = fieldNumber(ResponseProtoBuf.User, 'username')
+
     def __init__(self, username):
         self.username = username
+        self.id = NAMES.intern(username)
         # this is a list of messages that still need to be delivered to the user
         self.undeliveredMessages = MessageList()
+        # notified whenever a message is queued, so that clients long polling
+        # for messages can be woken up as soon as there is something to deliver
+        self.messageAvailable = threading.Condition()
+        # callbacks to call the next time a message is queued (see addWaiter)
+        self.waiters = []
+        # the groups the user belongs to, kept up to date by Group
+        self.groups = frozenset()
+        # how far the user has read the timeline of each group that has one
+        # (see Timeline), created when first needed and replaced rather than
+        # changed (see setCursor). A group missing from it has had a timeline
+        # since before the user joined, so they start at the beginning.
+        self.cursors = None
+        # set when the user is added to a UserList
+        self.storage = NO_STORAGE
 
     # convert to protobuf
     def serialize(self):
@@ -24,21 +98,193 @@ class User(object):
         user.username = self.username
         return user
 
+    # convert to a serialized protobuf, without building one
+    def serializeToString(self):
+        return encodeString(self.USERNAME_FIELD, self.username)
+
     # add a message to the user's undelivered message queue
     def receiveMessage(self, message):
-        self.undeliveredMessages.addMessage(message)
-
-    # returns undelivered messages and empties the internal list of messages to
-    # deliver
-    def flushMessages(self):
-        messages = self.undeliveredMessages.serialize()
-        self.undeliveredMessages = MessageList()
-        return messages
+        self.storage.sendDirectMessage(message)
+        self.queueMessage(message)
+
+    # add a message to the queue without telling storage about it, used when
+    # the message has been stored some other way (e.g. as a group message).
+    # queued is when it was first queued, if that was before now (see
+    # MessageList.addMessage).
+    def queueMessage(self, message, queued=None):
+        with self.messageAvailable:
+            # anything waiting in timelines was sent first
+            self.catchUp()
+            self.undeliveredMessages.addMessage(message, queued)
+            self.storeRemoved()
+            self.wake()
+
+    # Tell storage how many messages have just been removed from the front of
+    # the queue: taken, plus any the queue expired or dropped to make room.
+    # Storage only records a count, so a queue rebuilt from it has to lose the
+    # same messages whichever way they went. Called with the user's lock held.
+    def storeRemoved(self, taken=0):
+        removed = getattr(self.undeliveredMessages, 'removed', 0)
+        if removed:
+            self.undeliveredMessages.removed = 0
+        if taken + removed:
+            self.storage.flushMessages(self.username, taken + removed)
+
+    # tell anyone waiting for this user's messages that there are some. Called
+    # with the user's lock held.
+    def wake(self):
+        self.messageAvailable.notify_all()
+        waiters, self.waiters = self.waiters, []
+        for waiter in waiters:
+            waiter()
+
+    # check if there is anything waiting to be delivered
+    def hasMessages(self):
+        return len(self.undeliveredMessages) > 0 or self.hasTimelineMessages()
+
+    # check if any of the user's groups has a message in its timeline that the
+    # user hasn't read
+    def hasTimelineMessages(self):
+        for group in self.groups:
+            timeline = group.timeline
+            if timeline is not None and self.cursor(group) < timeline.end():
+                return True
+        return False
+
+    # how far the user has read a group's timeline
+    def cursor(self, group):
+        if self.cursors is None:
+            return 0
+        return self.cursors.get(group, 0)
+
+    # Set how far the user has read a group's timeline, or forget it if
+    # cursor is None. Called with the group's lock held.
+    def setCursor(self, group, cursor):
+        with MEMBERSHIP_LOCK:
+            cursors = dict(self.cursors or ())
+            if cursor is None:
+                cursors.pop(group, None)
+            else:
+                cursors[group] = cursor
+            self.cursors = cursors
+
+    # move the messages the user hasn't read from their groups' timelines to
+    # the end of their queue, in the order they were sent. Called with the
+    # user's lock held.
+    #
+    # Timelines are read one after another while messages are still being
+    # sent, so we only take messages numbered before we started. Otherwise a
+    # message sent to a timeline we have already read could be passed over
+    # while a later one in a timeline we read after it is taken.
+    def catchUp(self):
+        before = next(TIMELINE_SEQUENCE)
+        pending = []
+        for group in self.groups:
+            timeline = group.timeline
+            if timeline is None:
+                continue
+            with group.lock:
+                cursor = self.cursor(group)
+                if cursor < timeline.end():
+                    messages, cursor = timeline.read(cursor, before)
+                    pending.extend(messages)
+                    self.setCursor(group, cursor)
+
+        # messages are queued as of when they were posted, so ones that have
+        # been in a timeline too long expire from the queue like any other
+        for _, posted, message in sorted(pending):
+            self.undeliveredMessages.addMessage(message, posted)
+
+    # the messages the user hasn't read in their groups' timelines, as
+    # (sequence number, time sent, message) in the order they were sent,
+    # leaving them unread
+    def timelineMessages(self):
+        pending = []
+        for group in self.groups:
+            timeline = group.timeline
+            if timeline is not None:
+                with group.lock:
+                    pending.extend(timeline.peek(self.cursor(group)))
+        return sorted(pending)
+
+    # ask the user's groups with timelines to wake us when they get a message.
+    # Called with the user's lock held.
+    def listen(self):
+        for group in self.groups:
+            timeline = group.timeline
+            if timeline is not None:
+                with group.lock:
+                    timeline.listeners.add(self)
+
+    # block until there is at least one undelivered message or until timeout
+    # seconds have passed. Returns whether there are messages to deliver.
+    def waitForMessages(self, timeout):
+        with self.messageAvailable:
+            # listen first, so a message sent to a timeline just after we
+            # checked still wakes us
+            self.listen()
+            if not self.hasMessages():
+                self.messageAvailable.wait(timeout)
+            return self.hasMessages()
+
+    # call waiter (once, with no arguments) the next time a message is queued.
+    # This lets a client wait for messages without blocking a thread. The
+    # waiter is called with the user's lock held, so shouldn't do much.
+    def addWaiter(self, waiter):
+        with self.messageAvailable:
+            self.listen()
+            self.waiters.append(waiter)
+
+    # stop waiting for a message
+    def removeWaiter(self, waiter):
+        with self.messageAvailable:
+            if waiter in self.waiters:
+                self.waiters.remove(waiter)
+
+    # returns undelivered messages (as a serialized MessageList) and empties the
+    # internal list of messages to deliver. If limit is given at most that many
+    # messages are returned and removed, and the list's nextCursor is set if
+    # there are still more waiting. With dictionary, each sender is sent once
+    # in the list's senders (see MessageList.indexSenders).
+    def flushMessages(self, limit=None, dictionary=False):
+        with self.messageAvailable:
+            self.catchUp()
+            messages = self.undeliveredMessages.take(limit)
+            waiting = len(self.undeliveredMessages)
+            self.storeRemoved(len(messages))
+        return MessageList.encode(messages, waiting, dictionary)
+
+    # remove the first count messages from the queue without returning them
+    def discardMessages(self, count):
+        with self.messageAvailable:
+            self.catchUp()
+            self.undeliveredMessages.discard(count)
+
+    # remove every message from the queue, e.g. when the user is deleted
+    def clearMessages(self):
+        with self.messageAvailable:
+            self.undeliveredMessages.clear()
 
 # a set of users
 class UserList(object):
-    def __init__(self):
+    USERS_FIELD = fieldNumber(ResponseProtoBuf.UserList, 'users')
+    NEXT_CURSOR_FIELD = fieldNumber(ResponseProtoBuf.UserList, 'nextCursor')
+
+    def __init__(self, storage=NO_STORAGE, queueLimits=None):
         self.users = {}
+        # held while adding and deleting users
+        self.lock = threading.RLock()
+        # usernames, indexed for filtering
+        self.index = NameIndex()
+        self.storage = storage
+        # limits on the message queues of users in the list (see queues.py)
+        self.queueLimits = queueLimits
+        # where the queues of users in the list keep their messages
+        self.arena = MessageArena()
+        # the users added and deleted, and listings of the users (see
+        # cache.py)
+        self.changes = ChangeLog()
+        self.listings = ListingCache(lambda: self.changes.version)
 
     # check if a user by username is in the user set
     def usernameExists(self, username):
@@ -50,53 +296,170 @@ class UserList(object):
 
     # add a user object to the set of this object
     def addUser(self, user):
-        self.users[user.username] = user
-
-    # construct and return a userlist that is a subset of users in this list
-    # who have usernames that match the query.
+        with self.lock:
+            self.storage.addUser(user.username)
+            user.storage = self.storage
+            queue = self.storage.messageQueue(user.username)
+            if queue is None:
+                queue = MessageList(self.queueLimits, self.arena)
+            user.undeliveredMessages = queue
+            self.users[user.username] = user
+            self.index.add(user.username)
+            self.changes.record(Change.ADD_USER, username=user.username)
+
+    # iterate over the users in this list who have usernames that match the
+    # query, in order of username.
     #
     # A query takes the form of alphanumeric characters and asterics (where
     # asterics can match unboundedly many of any element). A query must be match
     # some part of the username. For example:
     #
     # J*k will match both Jack and Jak.
-    def filter(self, query):
-        userList = UserList()
-
-        regex = re.compile(query.replace('*', '.*'))
-        userList.users = { u: v for u, v in self.users.items() if regex.match(u) }
-
-        return userList
+    #
+    # If after is given only users whose names sort after it are returned.
+    #
+    # See index.py for how this avoids looking at every user.
+    def filter(self, query, after=None):
+        for username in self.index.match(query, after):
+            user = self.users.get(username)
+            if user is not None:
+                yield user
 
     # Assumes a user with username exists
     def deleteUser(self, username):
-        del self.users[username]
-
-    # return a protobuf
+        with self.lock:
+            self.storage.deleteUser(username)
+            self.users.pop(username).clearMessages()
+            self.index.remove(username)
+            self.changes.record(Change.DELETE_USER, username=username)
+
+    # return a serialized UserList protobuf of every user (see
+    # wire.encodeWrapped). Listings are cached until the users change. The
+    # usernames are copied first, as users may be added and deleted while we
+    # encode them.
     def serialize(self):
-        users = ResponseProtoBuf.UserList()
-        users.users.extend([u.serialize() for u in self.users.values()])
-        return users
+        return self.listings.get(
+            None, lambda: encodeWrapped(self.USERS_FIELD, User.USERNAME_FIELD,
+                                        self.users.keys()))
+
+    # return a serialized UserList protobuf of the users matching a query,
+    # encoding each user as it is found rather than collecting them first
+    def serializeFilter(self, query):
+        return self.listings.get(
+            query, lambda: encodeWrapped(self.USERS_FIELD, User.USERNAME_FIELD,
+                                         (u.username for u in self.filter(query))))
+
+    # return serialized UserList protobufs, each holding a page of at most limit
+    # users matching the query. Users are listed by name, starting after the
+    # cursor (a username) if one is given, and each page but the last has its
+    # nextCursor set.
+    def serializePages(self, query, cursor, limit):
+        for page, more in paginate(self.filter(query, cursor), limit):
+            users = encodeWrapped(self.USERS_FIELD, User.USERNAME_FIELD,
+                                  [u.username for u in page])
+            if more:
+                users += encodeString(self.NEXT_CURSOR_FIELD, page[-1].username)
+            yield users
+
+    # return a single serialized page of users (see serializePages)
+    def serializePage(self, query, cursor, limit):
+        return self.listings.get(
+            (query, cursor, limit), lambda: next(self.serializePages(query, cursor, limit), ''))
 
 # a group, which includes 0 or more users
+#
+# A message to a group is normally queued for every member straight away
+# (fan-out on write). For a group with TIMELINE_MEMBERS members or more that is
+# a lot of work for each message, so instead the group keeps the message once
+# in its Timeline and each member picks it up from there the next time they
+# read their messages or are sent one (fan-out on read, see User.catchUp).
+# Set TIMELINE_MEMBERS to None to always fan out on write.
 class Group(object):
+    __slots__ = ('groupname', 'id', 'users', 'lock', 'timeline', 'storage', 'groupList')
+    GROUPNAME_FIELD = fieldNumber(ResponseProtoBuf.Group, 'groupname')
+    USERS_FIELD = fieldNumber(ResponseProtoBuf.Group, 'users')
+    TIMELINE_MEMBERS = None
+    # the most messages a timeline keeps. Beyond that the oldest are dropped,
+    # even if some members haven't read them.
+    TIMELINE_LENGTH = 10000
+
     def __init__(self, groupname):
         self.groupname = groupname
-        self.users = Set()
-
-    # add a user to the group
+        self.id = NAMES.intern(groupname)
+        # the members, replaced rather than changed (see the top of this file)
+        self.users = frozenset()
+        # held while changing the members or the timeline
+        self.lock = threading.Lock()
+        # created when the group is first sent a message while it is large
+        self.timeline = None
+        # set when the group is added to a GroupList
+        self.storage = NO_STORAGE
+        self.groupList = None
+
+    # add a user to the group. A new member only sees messages sent after they
+    # joined.
     def addUser(self, user):
-        self.users.add(user)
+        with self.lock:
+            self.storage.addMember(self.groupname, user.username)
+            self.users = self.users | frozenset([user])
+            with MEMBERSHIP_LOCK:
+                user.groups = user.groups | frozenset([self])
+            if self.groupList is not None:
+                self.groupList.changes.record(Change.ADD_MEMBER, user.username, self.groupname)
+            if self.timeline is not None:
+                user.setCursor(self, self.timeline.end())
 
     # remove a user from teh group
     def pruneUser(self, user):
-        self.users.discard(user)
+        with self.lock:
+            if user in self.users:
+                self.users = self.users - frozenset([user])
+                with MEMBERSHIP_LOCK:
+                    user.groups = user.groups - frozenset([self])
+                if self.groupList is not None:
+                    self.groupList.changes.record(Change.REMOVE_MEMBER, user.username,
+                                                  self.groupname)
+                if self.timeline is not None:
+                    # they won't be reading what they haven't read yet
+                    self.timeline.advance(user.cursor(self), self.timeline.end())
+                    if user.cursors is not None:
+                        user.setCursor(self, None)
 
     # recieve a message for the group (will be passed on to every member of the
-    # group)
-    def receiveMessage(self, message, userList):
-        for user in self.users:
-            user.receiveMessage(message)
+    # group). queued is when it was sent, if that was before now (see
+    # User.queueMessage).
+    def receiveMessage(self, message, userList, queued=None):
+        self.storage.sendGroupMessage(message)
+        if self.timeline is None and not self.isLarge():
+            for user in self.users:
+                user.queueMessage(message, queued)
+            return
+
+        with self.lock:
+            if self.timeline is None:
+                self.timeline = Timeline()
+            dropped = self.timeline.append(message, len(self.users), self.TIMELINE_LENGTH,
+                                           queued)
+            listeners, self.timeline.listeners = self.timeline.listeners, set()
+        if dropped and userList.queueLimits is not None:
+            userList.queueLimits.count(dropped=dropped)
+
+        for user in listeners:
+            with user.messageAvailable:
+                user.wake()
+
+    # check whether the group should fan out on read, see above
+    def isLarge(self):
+        return (self.TIMELINE_MEMBERS is not None and self.storage.TIMELINES and
+                len(self.users) >= self.TIMELINE_MEMBERS)
+
+    # queue a message for the given members only. Used by a sharded server,
+    # where each shard queues a group message for the members it holds (see
+    # sharding.py).
+    def deliverMessage(self, message, users, queued=None):
+        self.storage.deliverMessage(message, [user.username for user in users])
+        for user in users:
+            user.queueMessage(message, queued)
 
     # convert to a protobuf
     def serialize(self):
@@ -105,10 +468,95 @@ class Group(object):
         group.users.extend([u.serialize() for u in self.users])
         return group
 
+    # convert to a serialized protobuf, without building one (see
+    # wire.encodeWrapped)
+    def serializeToString(self):
+        return (encodeString(self.GROUPNAME_FIELD, self.groupname) +
+                encodeWrapped(self.USERS_FIELD, User.USERNAME_FIELD,
+                              [u.username for u in self.users]))
+
+# The messages sent to a large group that some of its members haven't read yet,
+# oldest first, see Group.
+#
+# Each message has a position, counting every message ever added, and each
+# member has a cursor: the position of the first message they haven't read
+# (see User.cursors). Messages also count how many members have yet to read
+# them, and are removed once everyone has.
+class Timeline(object):
+    __slots__ = ('entries', 'start', 'listeners')
+
+    def __init__(self):
+        # [sequence number, time sent, message, members yet to read it] for
+        # each message
+        self.entries = deque()
+        # the position of the first entry
+        self.start = 0
+        # users waiting for messages, to wake when one is added
+        self.listeners = set()
+
+    # the position the next message will have
+    def end(self):
+        return self.start + len(self.entries)
+
+    # add a message for the given number of members, as sent at the given time
+    # (by default now), dropping the oldest messages if there are more than
+    # length. Returns how many were dropped.
+    def append(self, message, readers, length, sent=None):
+        if sent is None:
+            sent = time.time()
+        self.entries.append([next(TIMELINE_SEQUENCE), sent, message, readers])
+        dropped = 0
+        while len(self.entries) > length:
+            self.entries.popleft()
+            self.start += 1
+            dropped += 1
+        return dropped
+
+    # return (sequence number, time sent, message) for each message from
+    # cursor on, stopping at the first numbered before or later
+    def peek(self, cursor, before=None):
+        first = max(cursor, self.start) - self.start
+        messages = []
+        for seq, sent, message, _ in itertools.islice(self.entries, first, None):
+            if before is not None and seq >= before:
+                break
+            messages.append((seq, sent, message))
+        return messages
+
+    # peek, counting the messages as read by one more member. Returns the
+    # messages and the new cursor.
+    def read(self, cursor, before=None):
+        messages = self.peek(cursor, before)
+        end = max(cursor, self.start) + len(messages)
+        self.advance(cursor, end)
+        return messages, end
+
+    # count the messages from cursor up to position end as read by one more
+    # member, and remove the ones everyone has read
+    def advance(self, cursor, end):
+        for entry in itertools.islice(self.entries, max(cursor, self.start) - self.start,
+                                      end - self.start):
+            entry[3] -= 1
+        while self.entries and self.entries[0][3] <= 0:
+            self.entries.popleft()
+            self.start += 1
+
 # a list of groups, fundamentally similar to userlist
 class GroupList(object):
-    def __init__(self):
+    GROUPS_FIELD = fieldNumber(ResponseProtoBuf.GroupList, 'groups')
+    NEXT_CURSOR_FIELD = fieldNumber(ResponseProtoBuf.GroupList, 'nextCursor')
+
+    def __init__(self, storage=NO_STORAGE):
         self.groups = {}
+        # held while adding groups
+        self.lock = threading.RLock()
+        # group names, indexed for filtering
+        self.index = NameIndex()
+        self.storage = storage
+        # the groups added and the changes to their members, and listings of
+        # the groups (see cache.py)
+        self.changes = ChangeLog()
+        self.listings = ListingCache(lambda: self.changes.version)
 
     # check if a group by a certain name exists in the set
     def groupnameExists(self, groupname):
@@ -120,58 +568,338 @@ class GroupList(object):
 
     # add a group object to the set
     def addGroup(self, group):
-        self.groups[group.groupname] = group
-
-    # Construct and return a list of groups whose name match a certain query.
+        with self.lock:
+            self.storage.addGroup(group.groupname)
+            group.storage = self.storage
+            group.groupList = self
+            self.groups[group.groupname] = group
+            self.index.add(group.groupname)
+            self.changes.record(Change.ADD_GROUP, groupname=group.groupname)
+
+    # Iterate over the groups whose name match a certain query.
     # See comment above UserList.filter
-    def filter(self, query):
-        groupList = GroupList()
-
-        regex = re.compile(query.replace('*', '.*'))
-        groupList.groups = { g: v for g, v in self.groups.items() if regex.match(g) }
-
-        return groupList
-
-    # remove a user from all groups in the group list
-    def pruneUser(self, username):
-        for group in self.groups.values():
-            group.pruneUser(username)
-
-    # convert to protobuf
+    def filter(self, query, after=None):
+        for groupname in self.index.match(query, after):
+            group = self.groups.get(groupname)
+            if group is not None:
+                yield group
+
+    # remove a user from all groups in the group list. Only the groups the user
+    # belongs to are looked at, not every group.
+    def pruneUser(self, user):
+        for group in user.groups:
+            group.pruneUser(user)
+
+    # return a serialized GroupList protobuf of the groups a user belongs to,
+    # in order of name. Groups are listed without their members, as a user may
+    # belong to many large groups.
+    def serializeMembership(self, user):
+        return encodeWrapped(self.GROUPS_FIELD, Group.GROUPNAME_FIELD,
+                             sorted(g.groupname for g in user.groups))
+
+    # return a serialized GroupList protobuf of every group, cached until the
+    # groups change
     def serialize(self):
-        groups = ResponseProtoBuf.GroupList()
-        groups.groups.extend([g.serialize() for g in self.groups.values()])
-        return groups
+        return self.listings.get(
+            None, lambda: encodeRepeated(self.GROUPS_FIELD,
+                                         [g.serializeToString() for g in self.groups.values()]))
+
+    # return a serialized GroupList protobuf of the groups matching a query.
+    # See comment above UserList.serializeFilter
+    def serializeFilter(self, query):
+        return self.listings.get(
+            query, lambda: encodeRepeated(self.GROUPS_FIELD,
+                                          (g.serializeToString() for g in self.filter(query))))
+
+    # return serialized pages of groups. See comment above
+    # UserList.serializePages
+    def serializePages(self, query, cursor, limit):
+        for page, more in paginate(self.filter(query, cursor), limit):
+            groups = encodeRepeated(self.GROUPS_FIELD, [g.serializeToString() for g in page])
+            if more:
+                groups += encodeString(self.NEXT_CURSOR_FIELD, page[-1].groupname)
+            yield groups
+
+    # return a single serialized page of groups
+    def serializePage(self, query, cursor, limit):
+        return self.listings.get(
+            (query, cursor, limit), lambda: next(self.serializePages(query, cursor, limit), ''))
 
 # A message representation, contains a from, to, and message. From must be a
 # user, although to can be either a group or user.
 class Message(object):
+    __slots__ = ('frm', 'to', 'msg', 'wire', 'stored')
+    FRM_FIELD = fieldNumber(ResponseProtoBuf.Message, 'frm')
+    SENDER_FIELD = fieldNumber(ResponseProtoBuf.Message, 'sender')
+
     def __init__(self, frm, to, msg):
         self.frm = frm
         self.to = to
         self.msg = msg
+        # the serialized protobuf, built the first time it is needed and then
+        # reused. A group message is shared by the queues of every member of
+        # the group, so this means it is only ever encoded once.
+        self.wire = None
+        # the (arena, slot, generation) the serialized message was last stored
+        # in by a queue, see storeIn
+        self.stored = None
 
     # convert to protobuf
     def serialize(self):
         message = ResponseProtoBuf.Message()
-        message.frm.CopyFrom(self.frm.serialize())
+        message.frm.username = self.frm.username
         message.msg = self.msg
         return message
 
-# A list of messages.
+    # convert to a serialized protobuf (cached)
+    def serializeToString(self):
+        if self.wire is None:
+            self.wire = self.serialize().SerializeToString()
+        return self.wire
+
+    # store the serialized message in an arena (see compact.py) for a queue,
+    # returning its slot. A message queued many times (i.e. a group message)
+    # is stored once, with a reference for each queue.
+    def storeIn(self, arena):
+        if self.stored is not None:
+            storedArena, slot, generation = self.stored
+            if storedArena is arena and arena.retain(slot, generation):
+                return slot
+        slot = arena.store(self.serializeToString())
+        self.stored = (arena, slot, arena.generations[slot])
+        return slot
+
+# A list of messages, used as a user's queue of undelivered messages.
+#
+# Messages are kept serialized, so that a queue doesn't keep the users and
+# groups a message refers to alive. The serialized messages live in a
+# MessageArena shared by every queue in a UserList, and the queue itself is a
+# RingBuffer of (time queued, sender id, recipient id, arena slot) records (see
+# compact.py), so a queued message costs a few integers rather than several
+# Python objects. If the list has QueueLimits (see queues.py) messages that
+# don't fit in memory are spilled to disk, and old messages are dropped or
+# expired.
+#
+# A Storage can keep queues somewhere else by giving users its own queue
+# object (see Storage.messageQueue), which needs the same addMessage, take,
+# discard, clear and __len__ methods.
 class MessageList(object):
-    def __init__(self):
-        self.messages = []
-
-    # add a message to the list
-    def addMessage(self, message):
-        self.messages.append(message)
-
-    # convert to protobuf
+    MESSAGES_FIELD = fieldNumber(ResponseProtoBuf.MessageList, 'messages')
+    NEXT_CURSOR_FIELD = fieldNumber(ResponseProtoBuf.MessageList, 'nextCursor')
+    SENDERS_FIELD = fieldNumber(ResponseProtoBuf.MessageList, 'senders')
+
+    # the fields of each record in the ring buffer
+    QUEUED, SENDER, RECIPIENT, SLOT = range(4)
+
+    def __init__(self, limits=None, arena=None):
+        self.limits = limits
+        # the arena is created when first needed if we weren't given one
+        self.arena = arena
+        # records for the messages held in memory, oldest first, and the total
+        # size of the serialized messages
+        self.messages = RingBuffer(4)
+        self.bytes = 0
+        # the newer messages that didn't fit in memory
+        self.spill = None
+        # how many messages have expired or been dropped to make room since
+        # the user last told storage (see User.storeRemoved)
+        self.removed = 0
+
+    # the number of messages in the list
+    def __len__(self):
+        return len(self.messages) + (self.spill.count if self.spill is not None else 0)
+
+    # iterate over the serialized messages, oldest first, without removing them
+    def __iter__(self):
+        for _, _, _, _, wire in self.entries():
+            yield wire
+
+    # iterate over (time queued, sender id, recipient id, key, serialized
+    # message) for each message, oldest first. Messages in memory that are
+    # shared between queues have the same key, spilled messages have a key of
+    # None.
+    def entries(self):
+        for queued, sender, recipient, slot in self.messages:
+            yield queued, sender, recipient, slot, self.arena.get(slot)
+        if self.spill is not None:
+            for queued, wire in self.spill.read():
+                yield queued, None, None, None, wire
+
+    # add a message to the end of the list, as queued at the given time (by
+    # default now)
+    def addMessage(self, message, queued=None):
+        wire = message.serializeToString()
+        now = time.time()
+        if queued is None:
+            queued = now
+        limits = self.limits
+        if limits is None:
+            self.append(message, queued)
+            return
+
+        self.expire(now)
+        size = len(wire)
+        if self.spill is None and limits.fitsInMemory(self.bytes, size):
+            self.append(message, queued)
+            limits.count(memoryMessages=1, memoryBytes=size)
+        elif limits.spillDir is not None:
+            if self.spill is None:
+                self.spill = SpillFile(limits.spillDir)
+            self.spill.append(queued, wire)
+            limits.count(diskMessages=1, diskBytes=size, spilled=1)
+        else:
+            # nowhere to put it, make room by dropping the oldest messages. If
+            # that isn't enough (other queues are using the memory) the new
+            # message is dropped instead. Storage was told about it before it
+            # got here, so it counts as removed from the front too: nothing
+            # older is left.
+            while limits.enforced and len(self.messages) > 0 and \
+                    not limits.fitsInMemory(self.bytes, size):
+                self.drop()
+            if limits.enforced and not limits.fitsInMemory(self.bytes, size):
+                limits.count(dropped=1)
+                self.removed += 1
+                return
+            self.append(message, queued)
+            limits.count(memoryMessages=1, memoryBytes=size)
+
+        if limits.enforced and limits.userQueueBytes is not None:
+            while len(self) > 0 and self.queueBytes() > limits.userQueueBytes:
+                self.drop()
+
+    # drop the oldest message to make room
+    def drop(self):
+        self.popOldest()
+        self.limits.count(dropped=1)
+        self.removed += 1
+
+    # add a message to the end of the messages in memory
+    def append(self, message, now):
+        if self.arena is None:
+            self.arena = MessageArena()
+        slot = message.storeIn(self.arena)
+        self.messages.append((int(now), message.frm.id, message.to.id, slot))
+        self.bytes += self.arena.size(slot)
+
+    # remove the first limit messages (or all of them if limit is None) and
+    # return them serialized. Spilled messages are read back from disk.
+    def take(self, limit=None):
+        if self.limits is not None:
+            self.expire(time.time())
+
+        taken = []
+        while len(self.messages) > 0 and (limit is None or len(taken) < limit):
+            taken.append(self.popOldest()[1])
+
+        if self.spill is not None and (limit is None or len(taken) < limit):
+            entries = self.spill.read(None if limit is None else limit - len(taken))
+            self.advanceSpill(entries)
+            taken.extend(wire for _, wire in entries)
+        return taken
+
+    # remove the first count messages
+    def discard(self, count):
+        self.take(count)
+
+    # remove every message
+    def clear(self):
+        self.take()
+
+    # the total size of the serialized messages in memory and on disk
+    def queueBytes(self):
+        return self.bytes + (self.spill.bytes if self.spill is not None else 0)
+
+    # remove and return the oldest message, wherever it is, as a (time queued,
+    # serialized message) pair
+    def popOldest(self):
+        if len(self.messages) > 0:
+            record = self.messages.popleft()
+            slot = record[self.SLOT]
+            wire = self.arena.get(slot)
+            self.arena.release(slot)
+            self.bytes -= len(wire)
+            if self.limits is not None:
+                self.limits.count(memoryMessages=-1, memoryBytes=-len(wire))
+            return record[self.QUEUED], wire
+
+        entries = self.spill.read(1)
+        self.advanceSpill(entries)
+        return entries[0]
+
+    # remove entries just read from the spill file, deleting the file once
+    # everything in it has been read
+    def advanceSpill(self, entries):
+        self.spill.advance(entries)
+        if self.limits is not None:
+            self.limits.count(diskMessages=-len(entries),
+                              diskBytes=-sum(len(wire) for _, wire in entries))
+        if self.spill.count == 0:
+            self.spill.close()
+            self.spill = None
+
+    # remove messages that have been waiting longer than the limits allow
+    def expire(self, now):
+        ttl = self.limits.ttl
+        if ttl is None or not self.limits.enforced:
+            return
+
+        # records only keep the time queued to the second, so round the cutoff
+        # down to match, which can leave a message up to a second late
+        while len(self.messages) > 0 and self.messages.peek()[self.QUEUED] < int(now - ttl):
+            self.popOldest()
+            self.limits.count(expired=1)
+            self.removed += 1
+        while len(self.messages) == 0 and self.spill is not None:
+            (queued, wire), = self.spill.read(1)
+            if queued >= now - ttl:
+                break
+            self.popOldest()
+            self.limits.count(expired=1)
+            self.removed += 1
+
+    # convert to a serialized MessageList protobuf. Like the user and group
+    # lists this returns a string, as we splice together the cached encoding
+    # of each message rather than building a new protobuf.
     def serialize(self):
-        messages = ResponseProtoBuf.MessageList()
-        messages.messages.extend([m.serialize() for m in self.messages])
-        return messages
+        return MessageList.encode(list(self))
+
+    # build a serialized MessageList protobuf from serialized messages.
+    #
+    # Reading messages removes them from the user's queue, so there is nothing
+    # for a cursor to point back to. If there are more messages waiting after
+    # these, nextCursor is set to how many so the client knows to keep reading.
+    @staticmethod
+    def encode(messages, waiting=0, dictionary=False):
+        senders = None
+        if dictionary:
+            messages, senders = MessageList.indexSenders(messages)
+        encoded = encodeRepeated(MessageList.MESSAGES_FIELD, messages)
+        if waiting:
+            encoded += encodeString(MessageList.NEXT_CURSOR_FIELD, str(waiting))
+        if senders:
+            encoded += encodeRepeated(MessageList.SENDERS_FIELD, senders)
+        return encoded
+
+    # Takes the sender out of each serialized message, replacing it with the
+    # index of the sender in a list of the different senders, so a user who
+    # sent many of the messages is only sent once. Returns the messages and
+    # the serialized senders.
+    @staticmethod
+    def indexSenders(messages):
+        indexes = {}
+        senders = []
+        indexed = []
+        for wire in messages:
+            sender, rest = splitField(wire, Message.FRM_FIELD)
+            if sender is None:
+                indexed.append(wire)
+                continue
+            index = indexes.get(sender)
+            if index is None:
+                index = indexes[sender] = len(senders)
+                senders.append(sender)
+            indexed.append(rest + encodeUint(Message.SENDER_FIELD, index))
+        return indexed, senders
 
 # NOTE: Both DirectMessage and GroupMessage are backed by the Message protobuf
 #       they just set different fields to indicate whether they are directed to
@@ -179,18 +907,27 @@ class MessageList(object):
 
 # A direct message to another user
 class DirectMessage(Message):
+    __slots__ = ()
+
     def serialize(self):
         dm = super(DirectMessage, self).serialize()
         dm.type = ResponseProtoBuf.Message.DIRECT
-        dm.toUser.CopyFrom(self.to.serialize())
+        dm.toUser.username = self.to.username
         return dm
 
-# A message to a group
+# A message to a group. Only the name of the group is sent, as embedding the
+# group would mean sending every member along with every message. Set
+# EMBED_GROUP to also include the full group for clients that expect it.
 class GroupMessage(Message):
+    __slots__ = ()
+    EMBED_GROUP = False
+
     def serialize(self):
         gm = super(GroupMessage, self).serialize()
         gm.type = ResponseProtoBuf.Message.GROUP
-        gm.toGroup.CopyFrom(self.to.serialize())
+        gm.toGroupname = self.to.groupname
+        if self.EMBED_GROUP:
+            gm.toGroup.MergeFromString(self.to.serializeToString())
         return gm
 
 # the error to the user from the server if an API call fails (typically user
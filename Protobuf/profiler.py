@@ -0,0 +1,140 @@
+import os
+import sys
+import threading
+import time
+
+#
+# A sampling profiler that can be turned on in a running server for a while,
+# without restarting it or turning on the debugger (see POST
+# /v1/admin/profile and SIGUSR1 in server.py).
+#
+# While it runs, a thread looks at every other thread's stack every
+# INTERVAL seconds and counts how often it sees each one. When the time is
+# up the counts are written out as collapsed stacks, one per line, which is
+# what flamegraph.pl and speedscope read:
+#
+#   [threading];[SocketServer];[werkzeug];[flask];server.py:protoapi_[j];... 12
+#
+# Frames from our own files are named file:function. Frames from anywhere
+# else (Flask, Werkzeug, the standard library) are named after their package
+# in brackets, and a run of frames from the same package is collapsed into
+# one. Frames in model.py and protoapi are marked with _[j], which
+# flamegraph.pl --color=java draws in green so the model stands out. Stacks
+# with none of our functions in them (only the module running the server, if
+# that) are threads waiting for a connection and are left out.
+#
+
+# how long to wait between samples, in seconds
+INTERVAL = 0.005
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# the files whose frames are marked, and the functions in other files
+HIGHLIGHT_FILES = ('model.py',)
+HIGHLIGHT_FUNCTIONS = ('protoapi',)
+
+class Profiler(object):
+    def __init__(self, directory, interval=INTERVAL):
+        self.directory = directory
+        self.interval = interval
+        # held while a profile is being taken
+        self.running = threading.Lock()
+        # the name of each code object's frames, see frameName
+        self.names = {}
+
+    # Starts profiling for seconds on another thread, returning the path the
+    # stacks will be written to, or None if a profile is already being taken.
+    def start(self, seconds):
+        if not self.running.acquire(False):
+            return None
+        try:
+            if not os.path.isdir(self.directory):
+                os.makedirs(self.directory)
+            path = os.path.join(self.directory,
+                                time.strftime('profile-%Y%m%d-%H%M%S.collapsed'))
+            thread = threading.Thread(target=self.run, args=(seconds, path))
+            thread.daemon = True
+            thread.start()
+        except Exception:
+            self.running.release()
+            raise
+        return path
+
+    def run(self, seconds, path):
+        try:
+            counts = self.sample(seconds)
+            with open(path + '.tmp', 'w') as f:
+                for stack, count in sorted(counts.items()):
+                    f.write('%s %d\n' % (stack, count))
+            os.rename(path + '.tmp', path)
+        finally:
+            self.running.release()
+
+    # samples every thread but this one for seconds, returning how many
+    # times each collapsed stack was seen
+    def sample(self, seconds):
+        me = threading.current_thread().ident
+        counts = {}
+        deadline = time.time() + seconds
+        while time.time() < deadline:
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                stack = self.collapse(frame)
+                if stack is not None:
+                    counts[stack] = counts.get(stack, 0) + 1
+            time.sleep(self.interval)
+        return counts
+
+    # the collapsed stack ending at frame, outermost frame first, or None if
+    # none of the frames are in our functions
+    def collapse(self, frame):
+        names = []
+        ours = False
+        while frame is not None:
+            code = frame.f_code
+            name, isOurs = self.frameName(code)
+            ours = ours or isOurs and code.co_name != '<module>'
+            # the stack is built innermost first, so the last name added is
+            # the frame this one called
+            if isOurs or not names or names[-1] != name:
+                names.append(name)
+            frame = frame.f_back
+        if not ours:
+            return None
+        names.reverse()
+        return ';'.join(names)
+
+    # the name of a code object's frames and whether it is one of ours
+    def frameName(self, code):
+        cached = self.names.get(code)
+        if cached is None:
+            path = os.path.abspath(code.co_filename)
+            if code.co_filename.startswith('<'):
+                # code that isn't in a file, like Werkzeug's URL builders
+                cached = ('[%s]' % code.co_filename.strip('<>'), False)
+            elif os.path.dirname(path) == HERE:
+                filename = os.path.basename(path)
+                function = code.co_name
+                # protoapi's wrapper is named wrapped
+                if filename == 'server.py' and function == 'wrapped':
+                    function = 'protoapi'
+                name = '%s:%s' % (filename, function)
+                if filename in HIGHLIGHT_FILES or function in HIGHLIGHT_FUNCTIONS:
+                    name += '_[j]'
+                cached = (name, True)
+            else:
+                cached = ('[%s]' % packageName(path), False)
+            self.names[code] = cached
+        return cached
+
+# the package a file outside this directory belongs to: the directory under
+# site-packages for installed packages, the module for the standard library
+def packageName(path):
+    parts = path.split(os.sep)
+    for packages in ('site-packages', 'dist-packages'):
+        if packages in parts:
+            index = parts.index(packages)
+            if index + 1 < len(parts):
+                return os.path.splitext(parts[index + 1])[0]
+    return os.path.splitext(parts[-1])[0]
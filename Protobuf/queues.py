@@ -0,0 +1,151 @@
+import os
+import struct
+import tempfile
+import threading
+from build.protobufs import response_pb2 as ResponseProtoBuf
+
+#
+# Limits on users' queues of undelivered messages (see MessageList in
+# model.py), and the accounting that enforces them.
+#
+# A queue keeps messages in memory until it holds userMemoryBytes, or until
+# all queues together hold totalMemoryBytes. Messages that don't fit are
+# spilled to a file in spillDir, and read back from it when the user flushes
+# their queue. Once a queue has spilled, newer messages keep going to disk
+# until the spilled ones have been delivered, so messages stay in order.
+#
+# A queue can hold at most userQueueBytes in memory and on disk together, and
+# if there is no spillDir it can only hold what fits in memory. When a queue is
+# full the oldest messages are dropped to make room. Messages that have been
+# waiting longer than ttl seconds expire.
+#
+# Any limit left as None doesn't apply.
+#
+# Storage that replays a log of changes at startup turns enforced off while it
+# does (see LogStorage.load). The log says which messages were dropped or
+# expired, so queues being rebuilt mustn't drop or expire any themselves.
+#
+# NOTE: A group message is shared by every member's queue, but each queue
+#       counts its bytes, so memory use is overestimated for group messages.
+#
+
+class QueueLimits(object):
+    def __init__(self, userMemoryBytes=None, totalMemoryBytes=None, userQueueBytes=None,
+                 spillDir=None, ttl=None):
+        self.userMemoryBytes = userMemoryBytes
+        self.totalMemoryBytes = totalMemoryBytes
+        self.userQueueBytes = userQueueBytes
+        self.spillDir = spillDir
+        self.ttl = ttl
+        # whether queues drop and expire messages
+        self.enforced = True
+
+        # counters for every queue using these limits
+        self.lock = threading.Lock()
+        self.memoryMessages = 0
+        self.memoryBytes = 0
+        self.diskMessages = 0
+        self.diskBytes = 0
+        self.spilled = 0
+        self.dropped = 0
+        self.expired = 0
+
+    # whether a message of size bytes fits in memory in a queue already holding
+    # queueBytes
+    def fitsInMemory(self, queueBytes, size):
+        if self.userMemoryBytes is not None and queueBytes + size > self.userMemoryBytes:
+            return False
+        if self.totalMemoryBytes is not None and self.memoryBytes + size > self.totalMemoryBytes:
+            return False
+        return True
+
+    # update the counters for messages moving into (positive) or out of
+    # (negative) memory or disk
+    def count(self, memoryMessages=0, memoryBytes=0, diskMessages=0, diskBytes=0,
+              spilled=0, dropped=0, expired=0):
+        with self.lock:
+            self.memoryMessages += memoryMessages
+            self.memoryBytes += memoryBytes
+            self.diskMessages += diskMessages
+            self.diskBytes += diskBytes
+            self.spilled += spilled
+            self.dropped += dropped
+            self.expired += expired
+
+    # convert the counters to a protobuf
+    def serialize(self):
+        stats = ResponseProtoBuf.QueueStats()
+        with self.lock:
+            stats.memoryMessages = self.memoryMessages
+            stats.memoryBytes = self.memoryBytes
+            stats.diskMessages = self.diskMessages
+            stats.diskBytes = self.diskBytes
+            stats.spilled = self.spilled
+            stats.dropped = self.dropped
+            stats.expired = self.expired
+        return stats
+
+# Delete the spill files an earlier run left in directory. They are never read
+# again, the messages in them are either lost or rebuilt by storage. This is
+# left to whoever runs the server, so that just building QueueLimits (or
+# importing server.py) doesn't delete anything.
+def removeSpillFiles(directory):
+    if not os.path.isdir(directory):
+        return
+    for name in os.listdir(directory):
+        if name.endswith('.spill'):
+            os.remove(os.path.join(directory, name))
+
+# Messages spilled to disk by one queue. Each record is the time the message
+# was queued and its length, followed by the serialized message. The file is
+# only opened while it is being read or written, so that many spilled queues
+# don't each hold a file open.
+class SpillFile(object):
+    RECORD = struct.Struct('>dI')
+
+    def __init__(self, directory):
+        # the directory is made by the first queue to spill
+        try:
+            os.makedirs(directory)
+        except OSError:
+            if not os.path.isdir(directory):
+                raise
+        fd, self.path = tempfile.mkstemp(suffix='.spill', dir=directory)
+        os.close(fd)
+        # where the oldest unread record starts, and how many messages and
+        # bytes (of serialized messages) are still to be read
+        self.offset = 0
+        self.count = 0
+        self.bytes = 0
+
+    # add a message to the end of the file
+    def append(self, queued, wire):
+        with open(self.path, 'ab') as f:
+            f.write(self.RECORD.pack(queued, len(wire)))
+            f.write(wire)
+        self.count += 1
+        self.bytes += len(wire)
+
+    # the oldest unread messages, as (time queued, serialized message) pairs.
+    # Reading them doesn't remove them, see advance.
+    def read(self, limit=None):
+        if limit is None:
+            limit = self.count
+        entries = []
+        with open(self.path, 'rb') as f:
+            f.seek(self.offset)
+            while len(entries) < min(limit, self.count):
+                queued, length = self.RECORD.unpack(f.read(self.RECORD.size))
+                entries.append((queued, f.read(length)))
+        return entries
+
+    # mark the oldest count of the entries just read as removed
+    def advance(self, entries):
+        for _, wire in entries:
+            self.offset += self.RECORD.size + len(wire)
+            self.count -= 1
+            self.bytes -= len(wire)
+
+    # delete the file
+    def close(self):
+        os.remove(self.path)
@@ -0,0 +1,369 @@
+from flask import Flask, Response, request
+import argparse
+import itertools
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from google.protobuf.message import DecodeError
+from build.protobufs import request_pb2 as RequestProtoBuf
+from build.protobufs import response_pb2 as ResponseProtoBuf
+from compression import decodeBody
+from model import UserError
+from sharding import ShardMap
+
+#
+# Runs the chat server as several processes (shards) behind a router, so that
+# it can use more than one core. See sharding.py for how users, groups and
+# messages are split between the shards.
+#
+#   python router.py --shards 4 --port 5000
+#
+# starts shards 0 to 3 (server.py) on ports 5001 to 5004, and the router on
+# port 5000. By default the shards keep everything in memory, with --storage
+# log or sqlite each keeps its data in data/shard-<n> (see --data-dir). Clients talk to the router
+# exactly as they would to a single server. The router:
+#
+#   - sends changes to users, groups and members to every shard, starting with
+#     the shard that owns the user or group, whose answer the client gets. If
+#     another shard fails to apply a change the owner made, the client is
+#     told (see toAll).
+#   - sends messages, and requests for a user's messages, to the shard that
+#     owns the user or group.
+#   - sends listings to any shard, as every shard has every user and group.
+#   - sends batches to every shard, each shard applies what is its own, and
+#     takes the result of each operation from the shard that owns it. Changes
+#     to users, groups and members are applied everywhere before the messages
+#     after them are sent (see batch).
+#
+# Clients that want to skip the router can fetch GET /v1/shards and send
+# messages and polls straight to the right shard (see HashRing).
+#
+
+app = Flask(__name__)
+
+# set in main
+SHARDS = None
+
+# connections to the shards, kept open
+SESSION = requests.Session()
+SESSION.mount('http://', HTTPAdapter(pool_connections=16, pool_maxsize=64))
+
+# listings are spread over the shards in turn
+NEXT_SHARD = itertools.count()
+
+# The headers we pass on from a client's request, and from a shard's
+# response. The rest (the length, transfer encoding and connection) are the
+# router's own business. Bodies are passed on as they are, so whether they are
+# compressed (see compression.py) is up to the client and the shard.
+FORWARDED_HEADERS = ('Content-Encoding', 'Accept-Encoding')
+PASSED_HEADERS = ('Content-Type', 'Content-Encoding', 'Vary')
+
+# the most bytes a compressed batch may decompress to
+MAX_BATCH_BYTES = 16 * 1024 * 1024
+
+# Forwards the current request to a shard, returning the requests Response.
+# The body isn't read yet, so long polls and streams can be passed on as they
+# arrive.
+def forward(shard, path, data=None):
+    headers = dict((name, request.headers[name]) for name in FORWARDED_HEADERS
+                   if name in request.headers)
+    # otherwise requests asks for a compressed response the client may not take
+    headers.setdefault('Accept-Encoding', 'identity')
+    return SESSION.request(request.method, SHARDS.url(shard) + path,
+                           params=request.args, data=request.data if data is None else data,
+                           headers=headers, stream=True)
+
+# Turns a shard's response into ours, without decompressing it
+def relay(r):
+    headers = [(name, r.headers[name]) for name in PASSED_HEADERS if name in r.headers]
+    chunks = r.raw.stream(None, decode_content=False)
+    return Response(chunks, status=r.status_code, headers=headers)
+
+# If a shard can't be reached we answer with a UserError, like the server
+# does for everything else that goes wrong
+def shardDown(shard):
+    error = UserError("Shard %d Unavailable" % shard)
+    return error.serialize().SerializeToString(), 503
+
+# Forwards the request to the shard that owns name
+def toOwner(name, path):
+    shard = SHARDS.owner(name)
+    try:
+        return relay(forward(shard, path))
+    except requests.ConnectionError:
+        return shardDown(shard)
+
+# Forwards the request to every shard, the owner of name first. Returns the
+# owner's response, unless the owner made the change and another shard
+# didn't, in which case the shards now disagree and we answer 502 with a
+# UserError naming the first shard that failed.
+#
+# The change goes to every shard even if the owner refuses it. Shards that
+# agree with the owner refuse it too, but if an earlier attempt only reached
+# some of them (so the owner now says the user exists), the rest catch up, and
+# retrying a change that failed partway repairs it.
+def toAll(name, path):
+    owner = SHARDS.owner(name)
+    try:
+        first = forward(owner, path)
+        content = first.content
+    except requests.ConnectionError:
+        return shardDown(owner)
+
+    failure = None
+    for shard in xrange(SHARDS.count):
+        if shard == owner:
+            continue
+        try:
+            r = forward(shard, path)
+            replied = r.content
+        except requests.ConnectionError:
+            failure = failure or UserError("Shard %d Unavailable" % shard)
+            continue
+        if first.status_code == 200 and r.status_code != 200 and failure is None:
+            reason = "status %d" % r.status_code
+            if r.status_code == 400:
+                error = ResponseProtoBuf.UserError()
+                error.ParseFromString(replied)
+                reason = error.message
+            failure = UserError("Shard %d Failed: %s" % (shard, reason))
+
+    if first.status_code == 200 and failure is not None:
+        return failure.serialize().SerializeToString(), 502
+    return Response(content, status=first.status_code)
+
+# Forwards the request to the next shard in turn
+def toAny(path):
+    shard = next(NEXT_SHARD) % SHARDS.count
+    try:
+        return relay(forward(shard, path))
+    except requests.ConnectionError:
+        return shardDown(shard)
+
+#
+# Users and groups
+#
+
+@app.route("/v1/users", methods=["GET"])
+def listUsers():
+    return toAny('/users')
+
+@app.route("/v1/users/<username>", methods=["POST", "DELETE"])
+def changeUser(username):
+    return toAll(username, '/users/' + username)
+
+@app.route("/v1/users/<username>/groups", methods=["GET"])
+def listUserGroups(username):
+    return toAny('/users/%s/groups' % username)
+
+@app.route("/v1/groups", methods=["GET"])
+def listGroups():
+    return toAny('/groups')
+
+@app.route("/v1/groups/<groupname>", methods=["POST"])
+def createGroup(groupname):
+    return toAll(groupname, '/groups/' + groupname)
+
+@app.route("/v1/groups/<groupname>", methods=["GET"])
+def getGroup(groupname):
+    return toOwner(groupname, '/groups/' + groupname)
+
+@app.route("/v1/groups/<groupname>/users/<username>", methods=["PUT"])
+def addUserToGroup(groupname, username):
+    return toAll(groupname, '/groups/%s/users/%s' % (groupname, username))
+
+#
+# Messages
+#
+
+@app.route("/v1/users/<username>/messages", methods=["GET", "POST"])
+def userMessages(username):
+    return toOwner(username, '/users/%s/messages' % username)
+
+@app.route("/v1/users/<username>/messages/stream", methods=["GET"])
+def streamMessages(username):
+    return toOwner(username, '/users/%s/messages/stream' % username)
+
+@app.route("/v1/groups/<groupname>/messages", methods=["POST"])
+def sendGroupMessage(groupname):
+    return toOwner(groupname, '/groups/%s/messages' % groupname)
+
+# the name of the user or group whose shard applies an operation
+def operationOwner(operation):
+    Operation = RequestProtoBuf.Operation
+    if operation.type in (Operation.CREATE_USER, Operation.DIRECT_MESSAGE):
+        return operation.username
+    return operation.groupname
+
+# whether an operation changes users, groups or members, which every shard
+# applies, rather than sending a message
+def isDirectoryChange(operation):
+    Operation = RequestProtoBuf.Operation
+    return operation.type in (Operation.CREATE_USER, Operation.CREATE_GROUP,
+                              Operation.ADD_MEMBER)
+
+# Splits operations into runs of directory changes and runs of messages,
+# returning the (start, end) of each
+def runs(operations):
+    bounds = []
+    start = 0
+    for i in xrange(1, len(operations) + 1):
+        if i == len(operations) or \
+                isDirectoryChange(operations[i]) != isDirectoryChange(operations[start]):
+            bounds.append((start, i))
+            start = i
+    return bounds
+
+# Sends a serialized batch to every shard at once, returning each shard's
+# response, or None for shards that couldn't be reached
+def sendBatch(data):
+    replies = [None] * SHARDS.count
+
+    def send(shard):
+        try:
+            replies[shard] = SESSION.post(SHARDS.url(shard) + '/batch', data=data)
+        except requests.ConnectionError:
+            pass
+
+    threads = [threading.Thread(target=send, args=(shard,)) for shard in xrange(SHARDS.count)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return replies
+
+# Sends the batch to every shard. Each applies the operations it owns and the
+# changes to users and groups, and refuses the rest, so we take each result
+# from the shard that owns the operation.
+#
+# A group message's shard sends it on to the shards of the group's members,
+# who must already have applied the changes before it in the batch, so the
+# batch goes in runs: every shard finishes a run of directory changes before
+# any is sent the messages after it, and the other way around.
+@app.route("/v1/batch", methods=["POST"])
+def batch():
+    try:
+        data = decodeBody(request.data, request.headers.get('Content-Encoding'), MAX_BATCH_BYTES)
+    except ValueError:
+        return UserError("Invalid Content Encoding").serialize().SerializeToString(), 400
+
+    batch = RequestProtoBuf.Batch()
+    try:
+        batch.ParseFromString(data)
+    except DecodeError:
+        return UserError("Invalid Batch Protocol Buffer").serialize().SerializeToString(), 400
+
+    response = ResponseProtoBuf.BatchResponse()
+    for start, end in runs(batch.operations):
+        run = RequestProtoBuf.Batch()
+        run.operations.extend(batch.operations[start:end])
+
+        results = []
+        for shard, reply in enumerate(sendBatch(run.SerializeToString())):
+            if reply is None:
+                return shardDown(shard)
+            if reply.status_code != 200:
+                return Response(reply.content, status=reply.status_code)
+            shardResponse = ResponseProtoBuf.BatchResponse()
+            shardResponse.ParseFromString(reply.content)
+            results.append(shardResponse.results)
+
+        for i, operation in enumerate(run.operations):
+            response.results.add().CopyFrom(results[SHARDS.owner(operationOwner(operation))][i])
+    return response.SerializeToString()
+
+# Every shard has every user and group, so the changes to them all come from
+# the first shard, which keeps the versions a client sees in step
+@app.route("/v1/changes/<kind>", methods=["GET"])
+def changes(kind):
+    try:
+        return relay(forward(0, '/changes/' + kind))
+    except requests.ConnectionError:
+        return shardDown(0)
+
+#
+# Stats and shards
+#
+
+# The queue counters added up over every shard
+@app.route("/v1/stats/queues", methods=["GET"])
+def queueStats():
+    total = ResponseProtoBuf.QueueStats()
+    for field in total.DESCRIPTOR.fields:
+        setattr(total, field.name, 0)
+
+    for shard in xrange(SHARDS.count):
+        try:
+            r = SESSION.get(SHARDS.url(shard) + '/stats/queues')
+        except requests.ConnectionError:
+            return shardDown(shard)
+        stats = ResponseProtoBuf.QueueStats()
+        stats.ParseFromString(r.content)
+        for field in total.DESCRIPTOR.fields:
+            setattr(total, field.name, getattr(total, field.name) + getattr(stats, field.name))
+    return total.SerializeToString()
+
+@app.route("/v1/shards", methods=["GET"])
+def listShards():
+    return SHARDS.serialize().SerializeToString()
+
+#
+# Starting the shards
+#
+
+# Waits until something is listening on host:port
+def waitForPort(host, port, timeout=30):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), 1).close()
+            return
+        except socket.error:
+            time.sleep(0.1)
+    raise RuntimeError("Shard on port %d did not start" % port)
+
+# Starts each shard's server.py, returning the processes. Shards run the
+# threaded engine, as a shard sending a group message on to another shard
+# waits for it to answer (see ShardMap.fanOut), which would stall an event
+# loop and could leave two shards waiting on each other.
+def startShards(count, host, basePort, storage, dataDir):
+    here = os.path.dirname(os.path.abspath(__file__))
+    processes = []
+    for shard in xrange(count):
+        processes.append(subprocess.Popen(
+            [sys.executable, os.path.join(here, 'server.py'),
+             '--host', host, '--port', str(basePort + shard),
+             '--shards', str(count), '--shard', str(shard),
+             '--storage', storage, '--data-dir', os.path.join(dataDir, 'shard-%d' % shard)]))
+    for shard in xrange(count):
+        waitForPort(host, basePort + shard)
+    return processes
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Run the chat server as several shards')
+    parser.add_argument('--shards', type=int, default=2)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=5000,
+                        help='the router\'s port, shards listen on the ports after it')
+    parser.add_argument('--storage', choices=['memory', 'log', 'sqlite'], default='memory',
+                        help='where the shards keep users, groups and messages '
+                             '(default: %(default)s, see server.py)')
+    parser.add_argument('--data-dir', default='data',
+                        help='where the shards keep their data, a directory each')
+    args = parser.parse_args()
+
+    SHARDS = ShardMap(args.shards, None, args.host, args.port + 1)
+    processes = startShards(args.shards, args.host, args.port + 1, args.storage,
+                            args.data_dir)
+    try:
+        app.run(host=args.host, port=args.port, threaded=True)
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
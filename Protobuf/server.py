@@ -1,9 +1,28 @@
-from flask import Flask, request
+from flask import Flask, Response, request
+import argparse
+import os
 import re
+import signal
+import time
 from google.protobuf.message import DecodeError
 from build.protobufs import request_pb2 as RequestProtoBuf
-from model import User, UserList, Group, GroupList, UserError, GroupMessage, DirectMessage
+from build.protobufs import response_pb2 as ResponseProtoBuf
+from model import User, UserList, Group, GroupList, UserError, GroupMessage
+from storage import Storage
+from cache import ChangeLog
+from compression import ENCODINGS, Compressor, decodeBody
+from logstorage import LogStorage
+from sqlitestorage import SqliteStorage
+from queues import QueueLimits, removeSpillFiles
+from wire import encodeRepeated, fieldNumber, frame
 from functools import wraps
+from asyncserver import Wait
+from sharding import ShardMap
+from metrics import Metrics
+from profiler import Profiler
+from tcpserver import TcpServer
+import asyncserver
+import handlers
 
 #
 # This file is the main chat server for the protobuf chat app.
@@ -11,197 +30,859 @@ from functools import wraps
 # The server is a flask app that exposes REST endpoints. All endpoints return
 # HTTP responses that encode Protobuf responses. 
 #
+# The operations themselves are in handlers.py, which is shared with the batch
+# endpoint.
+#
 
 app = Flask(__name__)
 
+# Which server runs the app, set from the command line (see PARSER):
+#
+#   'threaded' - the Flask server, with a thread per request.
+#   'async'    - an event loop (see asyncserver.py), where clients waiting for
+#                messages don't hold a thread.
+#
+ENGINE = 'threaded'
+
+# When the server is run as one shard of several (see sharding.py and
+# router.py) this is the ShardMap saying which users and groups are ours,
+# otherwise None.
+SHARDS = None
+
 #
 # Maintain global variables to act as a pseudo-database for all users and groups.
 #
-# N.B. There is no persistence, in that when the server restarts all information
-# about users and groups is lost.
+# Where they are kept across restarts depends on STORAGE_BACKEND (see
+# storage.py), set from the command line with --storage:
+#
+#   'memory' - nothing is kept, when the server restarts all information about
+#              users and groups is lost.
+#   'log'    - every change is written to a write-ahead log in DATA_DIR, which
+#              is replayed when the server starts.
+#   'sqlite' - everything is kept in a SQLite database in DATA_DIR. Only users
+#              and groups are loaded at startup, undelivered messages stay on
+#              disk until they are delivered.
+#
+# DATA_DIR is set with --data-dir. The shards of a sharded server each need
+# their own, router.py gives each shard a directory inside its own --data-dir.
+#
+
+STORAGE_BACKEND = 'memory'
+DATA_DIR = 'data'
+
+# The command line. When server.py is run it is parsed here rather than at the
+# bottom of this file, as it picks where everything below is kept.
+PARSER = argparse.ArgumentParser(description='Run the chat server')
+PARSER.add_argument('--engine', choices=['threaded', 'async'], default=ENGINE,
+                    help='the server to run the app with (default: %(default)s)')
+PARSER.add_argument('--host', default='127.0.0.1')
+PARSER.add_argument('--port', type=int, default=5000)
+PARSER.add_argument('--storage', choices=['memory', 'log', 'sqlite'], default=STORAGE_BACKEND,
+                    help='where users, groups and messages are kept (default: %(default)s)')
+PARSER.add_argument('--data-dir', default=DATA_DIR,
+                    help='where storage, spilled messages and profiles are kept '
+                         '(default: %(default)s)')
+PARSER.add_argument('--shards', type=int, default=1,
+                    help='the number of shards, when run by router.py')
+PARSER.add_argument('--shard', type=int, default=0,
+                    help='which of the shards this is, listening on --port')
+PARSER.add_argument('--tcp-port', type=int,
+                    help='also serve the API over TCP on this port (see tcpserver.py)')
+# NOTE: Never use debug in Prod, it lets anyone who can cause an error run
+#       code on the server
+PARSER.add_argument('--debug', action='store_true',
+                    help='turn on the Flask debugger and reloader')
+
+if __name__ == "__main__":
+    ARGS = PARSER.parse_args()
+    STORAGE_BACKEND = ARGS.storage
+    DATA_DIR = ARGS.data_dir
+
+if STORAGE_BACKEND == 'log':
+    STORAGE = LogStorage(DATA_DIR)
+elif STORAGE_BACKEND == 'sqlite':
+    STORAGE = SqliteStorage(os.path.join(DATA_DIR, 'chat.db'))
+else:
+    STORAGE = Storage()
+
+#
+# Limits on users' queues of undelivered messages (see queues.py). Queues that
+# outgrow memory spill to disk in SPILL_DIR, and when a queue is full its
+# oldest messages are dropped. Messages don't expire unless QUEUE_TTL is set
+# (in seconds).
 #
 
-USERS = UserList()
-GROUPS = GroupList()
+USER_QUEUE_MEMORY_BYTES = 1024 * 1024
+TOTAL_QUEUE_MEMORY_BYTES = 512 * 1024 * 1024
+USER_QUEUE_BYTES = 64 * 1024 * 1024
+SPILL_DIR = os.path.join(DATA_DIR, 'spill')
+QUEUE_TTL = None
+
+QUEUE_LIMITS = QueueLimits(userMemoryBytes=USER_QUEUE_MEMORY_BYTES,
+                           totalMemoryBytes=TOTAL_QUEUE_MEMORY_BYTES,
+                           userQueueBytes=USER_QUEUE_BYTES,
+                           spillDir=SPILL_DIR,
+                           ttl=QUEUE_TTL)
+
+# The last run's spill files are cleared out before storage is loaded, which
+# may spill. Only when server.py is run, importing it mustn't delete anything.
+if __name__ == "__main__":
+    removeSpillFiles(SPILL_DIR)
+
+# Messages to groups with at least GROUP_TIMELINE_MEMBERS members are kept once
+# in the group's timeline, which members read from, rather than being queued
+# for each member when sent (see Group). None queues every group message for
+# each member. A timeline keeps at most GROUP_TIMELINE_LENGTH messages.
+GROUP_TIMELINE_MEMBERS = 1000
+GROUP_TIMELINE_LENGTH = 10000
+Group.TIMELINE_MEMBERS = GROUP_TIMELINE_MEMBERS
+Group.TIMELINE_LENGTH = GROUP_TIMELINE_LENGTH
+
+# How many of the most recent changes to the users, and to the groups, are kept
+# for clients asking what has changed (see GET /v1/changes/users). A client
+# further behind than that is sent the whole list.
+DIRECTORY_CHANGES = 10000
+ChangeLog.LENGTH = DIRECTORY_CHANGES
+
+USERS = UserList(STORAGE, QUEUE_LIMITS)
+GROUPS = GroupList(STORAGE)
+STORAGE.load(USERS, GROUPS)
+
+# Group messages only carry the name of the group they were sent to. Clients
+# written before that expect the full group (with all of its members) in every
+# message, turn this on to keep sending it.
+LEGACY_GROUP_MESSAGES = False
+GroupMessage.EMBED_GROUP = LEGACY_GROUP_MESSAGES
+
+# The longest a client may block waiting for messages in a single long poll.
+MAX_POLL_TIMEOUT = 60
+
+# How often an idle message stream sends an empty MessageList. This lets
+# clients know the connection is still alive and lets the server notice when a
+# client has gone away.
+STREAM_KEEPALIVE = 30
+
+# Listings can be requested a page at a time. This is the page size used when a
+# client asks for paging or streaming without giving a limit, and the largest
+# page size a client may ask for.
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+
+# The most operations a client may send in one batch
+MAX_BATCH_SIZE = 1000
+
+# Response bodies of at least COMPRESSION_MIN_BYTES are compressed, at zlib
+# level COMPRESSION_LEVEL, for clients that accept it (see compression.py).
+# Clients may compress request bodies too, which may be at most
+# MAX_REQUEST_BYTES once decompressed.
+COMPRESSION_MIN_BYTES = 1024
+COMPRESSION_LEVEL = 1
+COMPRESSOR = Compressor(COMPRESSION_MIN_BYTES, COMPRESSION_LEVEL)
+MAX_REQUEST_BYTES = 16 * 1024 * 1024
+
+# Request counts, latencies and sizes for every route, and the gauges below,
+# served at GET /metrics (see metrics.py)
+METRICS = Metrics()
+
+# The sampling profiler (see profiler.py), which writes its profiles to
+# PROFILE_DIR. It is started for PROFILE_SECONDS by sending the server SIGUSR1,
+# or for up to MAX_PROFILE_SECONDS with POST /v1/admin/profile.
+PROFILE_DIR = os.path.join(DATA_DIR, 'profiles')
+PROFILE_SECONDS = 30
+MAX_PROFILE_SECONDS = 600
+PROFILER = Profiler(PROFILE_DIR)
 
 # If the response is a ProtoBuf object, then we should serialize it into a string
 # that will be returned in the HTTP response body. The @protoapi annotation is
 # a piece of middleware that should wrap around all API methods. It is also
 # responsible for catching UserErrors, which can be thrown by a methods to
 # indicate that the user has supplied invalid request parameters.
+#
+# Methods that have already serialized their response (or that stream it and
+# so build a flask Response themselves) are passed through untouched.
+#
+# A method that needs to wait for messages returns a Wait (see asyncserver.py),
+# whose then function gives the response once the wait is over. With the
+# async engine the wait is handed back to it in an empty Response, otherwise
+# we block here.
+#
+# Before responding we wait for any changes the method made to be stored, so
+# that a client never hears about a change that could be lost. The response is
+# then compressed if the client accepts it and it is big enough (see
+# compressed).
+#
+# Every request is recorded in METRICS under the method's name.
 def protoapi(f):
+    route = f.__name__
+
     @wraps(f)
     def wrapped(*args, **kwargs):
+        start = time.time()
+        requestBytes = request.content_length or 0
+        encoding = request.accept_encodings.best_match(ENCODINGS)
         try:
-            response = f(*args, **kwargs)
-            if response is None:
-                return "Success"
-            return response.SerializeToString()
-        except UserError as ue:
-            return ue.serialize().SerializeToString(), 400
+            response = finish(lambda: f(*args, **kwargs), encoding)
+        except Exception:
+            METRICS.observe(route, time.time() - start, 500, requestBytes, 0)
+            raise
+        return observe(route, start, requestBytes, response)
     return wrapped
 
+# Records a response in METRICS. A response still waiting for messages is
+# recorded when the wait is over.
+def observe(route, start, requestBytes, response):
+    wait = getattr(response, 'wait', None)
+    if wait is not None:
+        then = wait.then
+        wait.then = lambda: observe(route, start, requestBytes, then())
+        return response
+
+    status = 200
+    body = response
+    if isinstance(response, tuple):
+        body, status = response
+    if isinstance(body, Response):
+        status = body.status_code
+        size = body.content_length or 0
+    else:
+        size = len(body)
+    METRICS.observe(route, time.time() - start, status, requestBytes, size)
+    return response
+
+# Runs an API method (or what is left of one after a Wait) and makes its
+# response, compressed with encoding if it's worth it, see protoapi
+def finish(method, encoding=None):
+    try:
+        response = method()
+        if isinstance(response, Wait):
+            wait = Wait(response.user, response.timeout,
+                        lambda: finish(response.then, encoding))
+            if ENGINE == 'async':
+                parked = Response()
+                parked.wait = wait
+                return parked
+            wait.block()
+            return wait.then()
+
+        STORAGE.commit()
+        if response is None:
+            return "Success"
+        if not isinstance(response, (str, Response)):
+            response = response.SerializeToString()
+        return compressed(response, encoding)
+    except UserError as ue:
+        return ue.serialize().SerializeToString(), 400
+
+# Compresses a response body (or a Response's) with encoding if it's worth it,
+# see Compressor.compress. Streamed responses are sent as they are.
+def compressed(response, encoding):
+    if isinstance(response, Response):
+        if response.is_streamed or response.status_code != 200:
+            return response
+        body = COMPRESSOR.compress(response.get_data(), encoding)
+        if body is not None:
+            response.set_data(body)
+    else:
+        body = COMPRESSOR.compress(response, encoding)
+        if body is not None:
+            response = Response(body)
+    if body is not None:
+        response.headers['Content-Encoding'] = encoding
+        response.vary.add('Accept-Encoding')
+    return response
+
+# The request body, decompressed if the client compressed it
+def requestData(request):
+    try:
+        return decodeBody(request.data, request.headers.get('Content-Encoding'),
+                          MAX_REQUEST_BYTES)
+    except ValueError:
+        raise UserError("Invalid Content Encoding")
+
+#
+# Paging and streaming
+#
+# Listings take optional limit and cursor query parameters to fetch them a
+# page at a time (each page gives the cursor for the next), and a stream
+# parameter to send every page in one chunked response, as a sequence of frames
+# (see wire.py).
+#
+
+# Parses the paging query parameters, returning the page size (or None if the
+# client wants everything at once) and the cursor to start after.
+def decodePage(request):
+    limit = request.args.get('limit')
+    cursor = request.args.get('cursor') or None
+
+    if limit:
+        try:
+            limit = int(limit)
+        except ValueError:
+            raise UserError("Invalid Limit")
+        if limit <= 0:
+            raise UserError("Invalid Limit")
+        return min(limit, MAX_PAGE_SIZE), cursor
+
+    if cursor is not None or isStreaming(request):
+        return DEFAULT_PAGE_SIZE, cursor
+    return None, None
+
+# Returns the serialized users or groups matching query (all of them if there
+# is no query), or a page of them if there is a limit
+def listing(names, query, cursor, limit):
+    if limit is not None:
+        return names.serializePage(query or '*', cursor, limit)
+    elif query:
+        return names.serializeFilter(query)
+    return names.serialize()
+
+# A tag for this run of the server, as the versions of the user and group
+# lists start again from 0 when it restarts
+EPOCH = os.urandom(4).encode('hex')
+
+# Responds with a listing of users or groups, tagged with the version of the
+# list (see cache.py). A client that sends the tag back in If-None-Match gets
+# 304 Not Modified with no body, until the list changes.
+def taggedListing(names, query, cursor, limit):
+    etag = '%s-%d' % (EPOCH, names.changes.version)
+    if request.if_none_match.contains(etag):
+        response = Response(status=304)
+    else:
+        response = Response(listing(names, query, cursor, limit))
+    response.set_etag(etag)
+    return response
+
+# Checks whether a query parameter that turns something on (like stream) is
+# set
+def queryFlag(request, name):
+    return request.args.get(name, '') not in ('', '0', 'false')
+
+# Checks whether the client asked for a streamed response
+def isStreaming(request):
+    return queryFlag(request, 'stream')
+
+# Builds a chunked response sending each serialized protobuf from payloads as a
+# frame. Payloads are only generated as the response is written out. Payloads
+# may also include Waits, to pause the stream until there are messages.
+def streamFrames(payloads):
+    def frames():
+        for payload in payloads:
+            if not isinstance(payload, Wait):
+                yield frame(payload)
+            elif ENGINE == 'async':
+                yield payload
+            else:
+                payload.block()
+    return Response(frames(), mimetype='application/octet-stream')
+
 #
 # API user methods
 #
 
+# Checks that a listing query contains only alphanumeric characters and
+# wildcards
+def checkQuery(query):
+    if query:
+        starless = query.replace('*', '')
+        if starless and not starless.isalnum():
+            raise UserError("Invalid Query")
+
 # Validates that the query string contains only alphanumeric characters and
 # wildcards, then returns the global list of users filtered to the query.
+# Unless streamed the listing is tagged with an ETag (see taggedListing).
 @app.route("/v1/users", methods=["GET"])
 @protoapi
 def listUsers():
     query = request.args.get('q')
-    if query:
-        starless = query.replace('*', '')
-        if starless and not starless.isalnum():
-            raise UserError("Invalid Query")
+    checkQuery(query)
 
-        return USERS.filter(query).serialize()
-    else:
-        return USERS.serialize()
+    limit, cursor = decodePage(request)
+    if isStreaming(request):
+        return streamFrames(USERS.serializePages(query or '*', cursor, limit))
+    return taggedListing(USERS, query, cursor, limit)
 
 # Creates a user object and adds it to the global user list.
 @app.route("/v1/users/<username>", methods=["POST"])
 @protoapi
 def createUser(username):
-    if not username.isalnum():
-        raise UserError("Invalid Username, Must Be Alphanumeric")
-    elif USERS.usernameExists(username):
-        raise UserError("User Exists")
-
-    user = User(username)
-    USERS.addUser(user)
-    return user.serialize()
-
-# Deletes a user, removing them from any groups they may have joined. Note that
-# an undelivered messages could potentially still hold a reference to the user
-# object, and so the object will remain in memory until all such messages are
-# flushed.
+    return handlers.createUser(USERS, username).serializeToString()
+
+# Deletes a user, removing them from any groups they may have joined, and
+# dropping their undelivered messages. Queued messages are kept serialized, so
+# they don't keep the user object in memory.
 @app.route("/v1/users/<username>", methods=["DELETE"])
 @protoapi
 def deleteUser(username):
-    if not USERS.usernameExists(username):
-        raise UserError("Missing User")
+    handlers.deleteUser(USERS, GROUPS, username)
+    return None
 
-    USERS.deleteUser(username)
-    GROUPS.pruneUser(username)
+# Lists the groups a user belongs to, without their members.
+@app.route("/v1/users/<username>/groups", methods=["GET"])
+@protoapi
+def listUserGroups(username):
+    user = USERS.getUser(username)
+    if user is None:
+        raise UserError("Missing User")
 
-    return None
+    return GROUPS.serializeMembership(user)
 
 #
 # API group methods
 #
 
 # Validates that the query string contains only alphanumeric characters and
-# wildcards, then returns the global list of users filtered to the query.
+# wildcards, then returns the global list of groups filtered to the query.
+# Unless streamed the listing is tagged with an ETag (see taggedListing).
 @app.route("/v1/groups", methods=["GET"])
 @protoapi
 def listGroups():
     query = request.args.get('q')
-    if query:
-        starless = query.replace('*', '')
-        if starless and not starless.isalnum():
-            raise UserError("Invalid Query")
+    checkQuery(query)
 
-        return GROUPS.filter(query).serialize()
-    else:
-        return GROUPS.serialize()
+    limit, cursor = decodePage(request)
+    if isStreaming(request):
+        return streamFrames(GROUPS.serializePages(query or '*', cursor, limit))
+    return taggedListing(GROUPS, query, cursor, limit)
 
 # Creates a new group object with no users and adds it to the global group
 # list
 @app.route("/v1/groups/<groupname>", methods=["POST"])
 @protoapi
 def createGroup(groupname):
-    if not groupname.isalnum():
-        raise UserError("Invalid Groupname, Must Be Alphanumeric")
-    elif GROUPS.groupnameExists(groupname):
-        raise UserError("Group Exists")
+    return handlers.createGroup(GROUPS, groupname).serializeToString()
 
-    group = Group(groupname)
-    GROUPS.addGroup(group)
-    return group.serialize()
+#
+# Changes
+#
+# Rather than fetching whole listings, clients can keep their own copy of the
+# users and groups up to date by asking for the changes since the version they
+# have (see Roster in client.py).
+#
 
-# Adds a user to a group by name.
-@app.route("/v1/groups/<groupname>/users/<username>", methods=["PUT"])
+# Parses the since and epoch query parameters, returning the version the
+# client has, or None if it has none from this run of the server
+def decodeSince(request):
+    since = request.args.get('since')
+    if not since:
+        return None
+
+    try:
+        since = int(since)
+    except ValueError:
+        raise UserError("Invalid Version")
+    if since < 0:
+        raise UserError("Invalid Version")
+
+    if request.args.get('epoch') != EPOCH:
+        return None
+    return since
+
+# Returns a serialized ChangeList of the changes to the users or groups since
+# version since. If they aren't all kept (or since is None) the whole list is
+# sent, in the field named snapshot.
+def changeList(names, since, snapshot):
+    version, changes = names.changes.since(since)
+    response = ResponseProtoBuf.ChangeList(version=version, epoch=EPOCH)
+    if changes is None:
+        # read the version first: the list may change while we serialize it,
+        # but replaying those changes on top does no harm
+        return response.SerializeToString() + encodeRepeated(
+            fieldNumber(ResponseProtoBuf.ChangeList, snapshot), [names.serialize()])
+
+    for type, username, groupname in changes:
+        change = response.changes.add(type=type)
+        if username is not None:
+            change.username = username
+        if groupname is not None:
+            change.groupname = groupname
+    return response
+
+# Returns the users added and deleted since the version the client has
+@app.route("/v1/changes/users", methods=["GET"])
 @protoapi
-def addUserToGroup(groupname, username):
+def userChanges():
+    return changeList(USERS, decodeSince(request), 'users')
+
+# Returns the groups added, and the members added and removed, since the
+# version the client has
+@app.route("/v1/changes/groups", methods=["GET"])
+@protoapi
+def groupChanges():
+    return changeList(GROUPS, decodeSince(request), 'groups')
+
+# Returns the counters for users' message queues, how many messages (and
+# bytes) are in memory and on disk, and how many have been spilled, dropped or
+# expired.
+@app.route("/v1/stats/queues", methods=["GET"])
+@protoapi
+def queueStats():
+    return QUEUE_LIMITS.serialize()
+
+# Returns the server's metrics in the Prometheus text format
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(METRICS.render(), mimetype='text/plain; version=0.0.4')
+
+# Gauges are read on every scrape, so they only read totals that are kept as
+# we go rather than looking at every user. The messages queued come from the
+# queue counters, which don't include what users reading from group timelines
+# haven't picked up yet, or queues kept by storage (--storage sqlite).
+METRICS.gauge('users', 'Users.', lambda: len(USERS.users))
+METRICS.gauge('groups', 'Groups.', lambda: len(GROUPS.groups))
+METRICS.gauge('queued_messages', 'Messages queued for users, in memory and on disk.',
+              lambda: QUEUE_LIMITS.memoryMessages + QUEUE_LIMITS.diskMessages)
+METRICS.gauge('timeline_messages', 'Messages kept in group timelines (see Group).',
+              lambda: sum(len(group.timeline.entries) for group in GROUPS.groups.values()
+                          if group.timeline is not None))
+for field, kind, help in [
+        ('memoryMessages', 'gauge', 'Queued messages held in memory.'),
+        ('diskMessages', 'gauge', 'Queued messages spilled to disk.'),
+        ('spilled', 'counter', 'Messages spilled to disk since the server started.'),
+        ('dropped', 'counter', 'Messages dropped from full queues since the server started.'),
+        ('expired', 'counter', 'Messages expired since the server started.')]:
+    METRICS.gauge('queue_%s' % re.sub('([A-Z])', r'_\1', field).lower() +
+                  ('_total' if kind == 'counter' else ''), help,
+                  lambda field=field: getattr(QUEUE_LIMITS, field), kind)
+METRICS.gauge('compressed_responses_total', 'Responses compressed since the server started.',
+              lambda: COMPRESSOR.compressed, 'counter')
+METRICS.gauge('compressed_bytes_in_total', 'Bytes of responses before they were compressed.',
+              lambda: COMPRESSOR.bytesIn, 'counter')
+METRICS.gauge('compressed_bytes_out_total', 'Bytes of responses after they were compressed.',
+              lambda: COMPRESSOR.bytesOut, 'counter')
+
+# Profiles the server for the given number of seconds (PROFILE_SECONDS by
+# default), returning the file the profile will be written to once it's done.
+# Only one profile is taken at a time.
+@app.route("/v1/admin/profile", methods=["POST"])
+@protoapi
+def startProfile():
+    seconds = request.args.get('seconds')
+    try:
+        seconds = float(seconds) if seconds else PROFILE_SECONDS
+    except ValueError:
+        raise UserError("Invalid Seconds")
+    if not 0 < seconds <= MAX_PROFILE_SECONDS:
+        raise UserError("Invalid Seconds")
+
+    path = PROFILER.start(seconds)
+    if path is None:
+        raise UserError("Already Profiling")
+    return os.path.abspath(path)
+
+# Returns where the shards are when the server is sharded, so that clients can
+# find a user's shard themselves.
+@app.route("/v1/shards", methods=["GET"])
+@protoapi
+def listShards():
+    if SHARDS is None:
+        raise UserError("Not Sharded")
+    return SHARDS.serialize()
+
+# Returns a single group along with all of its members.
+@app.route("/v1/groups/<groupname>", methods=["GET"])
+@protoapi
+def getGroup(groupname):
     group = GROUPS.getGroup(groupname)
     if group is None:
         raise UserError("Missing Group")
 
-    if not USERS.usernameExists(username):
-        raise UserError("User does not exist")
+    return group.serializeToString()
 
-    group.addUser(USERS.getUser(username))
-    return group.serialize()
+# Adds a user to a group by name.
+@app.route("/v1/groups/<groupname>/users/<username>", methods=["PUT"])
+@protoapi
+def addUserToGroup(groupname, username):
+    return handlers.addMember(USERS, GROUPS, groupname, username).serializeToString()
 
 #
 # Messages
 #
 
 # The ProtoBuf encoded message is sent as a string in the request body.
-# We parse the string into a new Python ProtoBuf message object, and
-# return the message string as well as the Python object for the sender.
+# We parse the string into a new Python ProtoBuf message object.
 def decodeMessage(request):
     message = RequestProtoBuf.Message()
 
     try:
-        message.ParseFromString(request.data)
+        message.ParseFromString(requestData(request))
     except DecodeError:
         raise UserError("Invaid Message Protocol Buffer")
 
-    if message.msg is None or message.msg == '':
-        raise UserError("Invaid Message Body")
-
-    fromUser = USERS.getUser(message.frm)
-    if fromUser is None:
-        raise UserError("Invalid from User")
-
-    return message.msg, fromUser
+    return message
 
 # Decode the message and create a new DirectMessage object to be received
 # by the user. Responds to the request with the serialized message.
 @app.route("/v1/users/<username>/messages", methods=["POST"])
 @protoapi
 def sendDirectMessage(username):
-    msg, fromUser = decodeMessage(request)
-    toUser = USERS.getUser(username)
-    if toUser is None:
-        raise UserError("Missing To User")
-
-    message = DirectMessage(fromUser, toUser, msg)
-    toUser.receiveMessage(message)
-    return message.serialize()
+    message = handlers.sendDirectMessage(USERS, username, decodeMessage(request), SHARDS)
+    return message.serializeToString()
 
 # Decode the message and create a new GroupMessage object to be received
 # by the user. Responds to the request with the serialized message.
 @app.route("/v1/groups/<groupname>/messages", methods=["POST"])
 @protoapi
 def sendGroupMessage(groupname):
-    msg, fromUser = decodeMessage(request)
-    toGroup = GROUPS.getGroup(groupname)
-    if toGroup is None:
+    message = handlers.sendGroupMessage(USERS, GROUPS, groupname, decodeMessage(request),
+                                        SHARDS)
+    return message.serializeToString()
+
+# Queues a group message for the members on this shard. Sent by the shard that
+# holds the group, see ShardMap.fanOut. The sender may have been deleted since
+# it was sent, the members get it anyway. Only users on this shard who are
+# members of the group are sent it, and a server that isn't sharded refuses.
+@app.route("/v1/shards/deliver", methods=["POST"])
+@protoapi
+def deliverMessage():
+    if SHARDS is None:
+        raise UserError("Not Sharded")
+
+    delivery = RequestProtoBuf.Delivery()
+    try:
+        delivery.ParseFromString(requestData(request))
+    except DecodeError:
+        raise UserError("Invalid Delivery Protocol Buffer")
+
+    group = GROUPS.getGroup(delivery.groupname)
+    if group is None:
         raise UserError("Missing To Group")
 
-    message = GroupMessage(fromUser, toGroup, msg)
-    toGroup.receiveMessage(message, USERS)
-    return message.serialize()
+    sender = USERS.getUser(delivery.frm) or User(delivery.frm)
+    members = group.users
+    recipients = [USERS.getUser(username) for username in delivery.usernames
+                  if SHARDS.isLocal(username)]
+    group.deliverMessage(GroupMessage(sender, group, delivery.msg),
+                         [user for user in recipients if user in members])
+    return None
+
+#
+# Batches
+#
+
+# Applies a Batch of operations (creating users and groups, adding members and
+# sending messages) in order, and responds with a BatchResponse holding the
+# result of each. Operations that fail have a UserError as their result and
+# don't stop the rest. The changes are all stored before we respond, so a
+# batch costs one commit rather than one per operation.
+@app.route("/v1/batch", methods=["POST"])
+@protoapi
+def batch():
+    batch = RequestProtoBuf.Batch()
+    try:
+        batch.ParseFromString(requestData(request))
+    except DecodeError:
+        raise UserError("Invalid Batch Protocol Buffer")
+
+    if len(batch.operations) > MAX_BATCH_SIZE:
+        raise UserError("Batch Too Large")
+
+    return handlers.applyBatch(USERS, GROUPS, batch, SHARDS)
+
+# Parses the optional timeout query parameter (in seconds) used for long
+# polling, capping it at MAX_POLL_TIMEOUT.
+def decodeTimeout(request):
+    timeout = request.args.get('timeout')
+    if not timeout:
+        return 0
+
+    try:
+        timeout = float(timeout)
+    except ValueError:
+        raise UserError("Invalid Timeout")
+
+    if timeout < 0:
+        raise UserError("Invalid Timeout")
+    return min(timeout, MAX_POLL_TIMEOUT)
 
 # List all the messages for the given user, and clear them from the user's
 # message queue so that they are only delivered once.
+#
+# If a timeout is given and there are no messages waiting, the request is held
+# open until a message arrives or the timeout expires (long polling), so idle
+# clients don't have to keep asking.
+#
+# With a limit only that many messages are returned (and removed). When
+# streaming, pages are sent until the queue is empty. With the dictionary
+# parameter each sender is sent once per MessageList, in its senders.
 @app.route("/v1/users/<username>/messages", methods=["GET"])
 @protoapi
 def listMessages(username):
+    handlers.checkShard(SHARDS, username)
     user = USERS.getUser(username)
     if user is None:
         raise UserError("Missing User")
 
-    return user.flushMessages()
+    timeout = decodeTimeout(request)
+    limit, _ = decodePage(request)
+    streaming = isStreaming(request)
+    dictionary = queryFlag(request, 'dictionary')
+
+    def respond():
+        if streaming:
+            def pages():
+                yield user.flushMessages(limit, dictionary)
+                while user.hasMessages():
+                    yield user.flushMessages(limit, dictionary)
+            return streamFrames(pages())
+        return user.flushMessages(limit, dictionary)
+
+    if timeout > 0 and not user.hasMessages():
+        return Wait(user, timeout, respond)
+    return respond()
+
+# Stream messages to the given user as they arrive. The response body is an
+# unbounded sequence of frames (see wire.py), each holding a MessageList. An
+# empty MessageList is sent every STREAM_KEEPALIVE seconds while idle. The
+# stream ends when the user is deleted. Takes the dictionary parameter, like
+# listMessages.
+@app.route("/v1/users/<username>/messages/stream", methods=["GET"])
+@protoapi
+def streamMessages(username):
+    handlers.checkShard(SHARDS, username)
+    user = USERS.getUser(username)
+    if user is None:
+        raise UserError("Missing User")
 
-if __name__ == "__main__":
+    return streamFrames(deliveries(username, user, queryFlag(request, 'dictionary')))
 
-    #
-    # NOTE: Turn off debug in Prod
-    #
+# Waits for messages to the user and yields each lot as a serialized
+# MessageList, which is empty if none came within STREAM_KEEPALIVE seconds.
+# Stops when the user is deleted.
+def deliveries(username, user, dictionary=False):
+    while USERS.getUser(username) is user:
+        yield Wait(user, STREAM_KEEPALIVE)
+        yield user.flushMessages(dictionary=dictionary)
 
-    app.run(debug=True)
+#
+# The TCP transport
+#
+# The same operations as the endpoints above, for clients connected with
+# --tcp-port (see tcpserver.py). Each takes the request's Envelope and returns
+# what the endpoint would.
+#
+
+Envelope = RequestProtoBuf.Envelope
+
+# Parses a protobuf sent as an Envelope's payload
+def decodePayload(proto, envelope, error):
+    decoded = proto()
+    try:
+        decoded.ParseFromString(envelope.payload)
+    except DecodeError:
+        raise UserError(error)
+    return decoded
+
+# Returns the users or groups matching an Envelope's query, a page at a time
+# if it has a limit
+def listNames(names, envelope):
+    query = envelope.query or None
+    checkQuery(query)
+    limit = min(envelope.limit, MAX_PAGE_SIZE) if envelope.limit else None
+    return listing(names, query, envelope.cursor or None, limit)
+
+# Finds the user an Envelope is for
+def envelopeUser(envelope):
+    handlers.checkShard(SHARDS, envelope.username)
+    user = USERS.getUser(envelope.username)
+    if user is None:
+        raise UserError("Missing User")
+    return user
+
+def tcpGetGroup(envelope):
+    group = GROUPS.getGroup(envelope.groupname)
+    if group is None:
+        raise UserError("Missing Group")
+    return group.serializeToString()
+
+def tcpListMessages(envelope):
+    return envelopeUser(envelope).flushMessages(min(envelope.limit, MAX_PAGE_SIZE)
+                                                if envelope.limit else None,
+                                                envelope.dictionary)
+
+def tcpBatch(envelope):
+    batch = decodePayload(RequestProtoBuf.Batch, envelope, "Invalid Batch Protocol Buffer")
+    if len(batch.operations) > MAX_BATCH_SIZE:
+        raise UserError("Batch Too Large")
+    return handlers.applyBatch(USERS, GROUPS, batch, SHARDS)
+
+# the version an Envelope asking for changes has, see decodeSince
+def envelopeSince(envelope):
+    if not envelope.HasField('since') or envelope.epoch != EPOCH:
+        return None
+    return envelope.since
+
+def tcpMessage(envelope):
+    return decodePayload(RequestProtoBuf.Message, envelope, "Invaid Message Protocol Buffer")
+
+TCP_OPERATIONS = {
+    Envelope.CREATE_USER: lambda e: handlers.createUser(USERS, e.username).serializeToString(),
+    Envelope.DELETE_USER: lambda e: handlers.deleteUser(USERS, GROUPS, e.username),
+    Envelope.LIST_USERS: lambda e: listNames(USERS, e),
+    Envelope.LIST_USER_GROUPS: lambda e: GROUPS.serializeMembership(envelopeUser(e)),
+    Envelope.CREATE_GROUP: lambda e: handlers.createGroup(GROUPS, e.groupname).serializeToString(),
+    Envelope.GET_GROUP: tcpGetGroup,
+    Envelope.LIST_GROUPS: lambda e: listNames(GROUPS, e),
+    Envelope.ADD_MEMBER: lambda e: handlers.addMember(USERS, GROUPS, e.groupname,
+                                                      e.username).serializeToString(),
+    Envelope.DIRECT_MESSAGE: lambda e: handlers.sendDirectMessage(
+        USERS, e.username, tcpMessage(e), SHARDS).serializeToString(),
+    Envelope.GROUP_MESSAGE: lambda e: handlers.sendGroupMessage(
+        USERS, GROUPS, e.groupname, tcpMessage(e), SHARDS).serializeToString(),
+    Envelope.LIST_MESSAGES: tcpListMessages,
+    Envelope.BATCH: tcpBatch,
+    Envelope.USER_CHANGES: lambda e: changeList(USERS, envelopeSince(e), 'users'),
+    Envelope.GROUP_CHANGES: lambda e: changeList(GROUPS, envelopeSince(e), 'groups'),
+}
+
+# the name each operation is recorded under in METRICS
+TCP_ROUTES = dict((op, 'tcp_' + Envelope.Op.Name(op)) for op in TCP_OPERATIONS)
+
+# Runs a request sent over TCP, returning the serialized response
+def handleEnvelope(envelope):
+    operation = TCP_OPERATIONS.get(envelope.op)
+    if operation is None:
+        raise UserError("Invalid Operation")
+
+    start = time.time()
+    status = 500
+    size = 0
+    try:
+        response = operation(envelope)
+        if response is None:
+            response = ''
+        elif not isinstance(response, str):
+            response = response.SerializeToString()
+        status = 200
+        size = len(response)
+        return response
+    except UserError:
+        status = 400
+        raise
+    finally:
+        METRICS.observe(TCP_ROUTES[envelope.op], time.time() - start, status,
+                        len(envelope.payload), size)
+
+# Starts pushing a user's messages to a TCP client
+def subscribe(envelope):
+    return deliveries(envelope.username, envelopeUser(envelope), envelope.dictionary)
+
+if __name__ == "__main__":
+    args = ARGS
+    ENGINE = args.engine
+    if args.shards > 1:
+        if ENGINE == 'async':
+            PARSER.error('shards run the threaded engine, see router.py')
+        SHARDS = ShardMap(args.shards, args.shard, args.host, args.port - args.shard)
+    app.debug = args.debug
+    signal.signal(signal.SIGUSR1, lambda signum, frame: PROFILER.start(PROFILE_SECONDS))
+    if args.tcp_port:
+        TcpServer(args.host, args.tcp_port, handleEnvelope, subscribe, STORAGE.commit,
+                  COMPRESSOR).start()
+    try:
+        if ENGINE == 'async':
+            asyncserver.serve(app, args.host, args.port)
+        else:
+            # threaded so that long polling clients don't block everyone else
+            app.run(host=args.host, port=args.port, debug=args.debug, threaded=True)
+    finally:
+        STORAGE.close()
@@ -0,0 +1,138 @@
+import bisect
+import hashlib
+import requests
+from requests.adapters import HTTPAdapter
+from build.protobufs import request_pb2 as RequestProtoBuf
+from build.protobufs import response_pb2 as ResponseProtoBuf
+from model import UserError
+
+#
+# Running the server as several processes (shards), see router.py.
+#
+# One Python process can only use one core, so a sharded server splits users
+# between N server.py processes. Each user belongs to one shard, picked by
+# consistent hashing of their username (see HashRing), which holds their queue
+# of undelivered messages. Groups belong to a shard by name in the same way.
+#
+# The directory (which users and groups exist and who is in which group) is
+# small and rarely changes, so every shard has a copy: the router sends each
+# change to every shard. That way any shard can check that a user exists or
+# list users, and only messages need to go to a particular shard:
+#
+#   - a direct message goes to the recipient's shard, which queues it.
+#   - a group message goes to the group's shard, which splits the members by
+#     shard and sends each shard one Delivery with all of its members (see
+#     ShardMap.fanOut).
+#   - reading a user's messages goes to their shard.
+#
+# A shard refuses messages for users or groups that aren't its own with a
+# "Wrong Shard" error.
+#
+# A group message that can't be delivered to one of the shards fails with a
+# UserError naming it. The group's own shard delivers to the others first, so
+# the members on it never get a message that failed (see ShardMap.fanOut).
+#
+
+# The number of points each shard has on the ring. More points spread users
+# more evenly.
+VNODES = 64
+
+# a stable 64 bit hash of a name
+def hashName(name):
+    if isinstance(name, unicode):
+        name = name.encode('utf-8')
+    return int(hashlib.md5(name).hexdigest()[:16], 16)
+
+# Consistent hashing. Each shard is hashed to vnodes points on a ring, and a
+# name belongs to the shard with the first point at or after the name's hash.
+# Adding a shard only moves the names that now fall before its points.
+class HashRing(object):
+    def __init__(self, count, vnodes=VNODES):
+        points = sorted((hashName('shard-%d-%d' % (shard, v)), shard)
+                        for shard in xrange(count) for v in xrange(vnodes))
+        self.hashes = [h for h, _ in points]
+        self.shards = [shard for _, shard in points]
+
+    # the shard a name belongs to
+    def shardFor(self, name):
+        i = bisect.bisect_left(self.hashes, hashName(name)) % len(self.hashes)
+        return self.shards[i]
+
+# The shards of a sharded server, as seen from one of them (index is the
+# shard's own number) or from the router (index is None). Shard i listens on
+# host at basePort + i.
+class ShardMap(object):
+    def __init__(self, count, index, host, basePort, vnodes=VNODES):
+        self.count = count
+        self.index = index
+        self.host = host
+        self.basePort = basePort
+        self.vnodes = vnodes
+        self.ring = HashRing(count, vnodes)
+        # names already looked up on the ring, as fanning out a group message
+        # looks up every member
+        self.owners = {}
+
+        # connections to the other shards, kept open
+        self.session = requests.Session()
+        self.session.mount('http://', HTTPAdapter(pool_connections=count, pool_maxsize=32))
+
+    # the shard a user or group belongs to
+    def owner(self, name):
+        shard = self.owners.get(name)
+        if shard is None:
+            shard = self.owners[name] = self.ring.shardFor(name)
+        return shard
+
+    # whether a user or group belongs to this shard
+    def isLocal(self, name):
+        return self.owner(name) == self.index
+
+    # the base URL of a shard's API
+    def url(self, shard):
+        return 'http://%s:%d/v1' % (self.host, self.basePort + shard)
+
+    # Send a group message to every member of group, wherever they are: every
+    # other shard that has members gets one Delivery listing them, and then
+    # the members on this shard are queued here.
+    #
+    # If a shard can't be reached or refuses its Delivery we raise a UserError
+    # naming the first one, after trying the rest, and don't queue the message
+    # here. Retrying then only repeats the message for members on the other
+    # shards that did take it.
+    def fanOut(self, group, message):
+        byShard = {}
+        for user in group.users:
+            byShard.setdefault(self.owner(user.username), []).append(user)
+        local = byShard.pop(self.index, [])
+
+        failure = None
+        for shard, members in byShard.items():
+            delivery = RequestProtoBuf.Delivery(frm=message.frm.username,
+                                                groupname=group.groupname, msg=message.msg)
+            delivery.usernames.extend([user.username for user in members])
+            try:
+                r = self.session.post(self.url(shard) + '/shards/deliver',
+                                      data=delivery.SerializeToString())
+            except requests.RequestException:
+                failure = failure or UserError("Shard %d Unavailable" % shard)
+                continue
+            if r.status_code != 200 and failure is None:
+                reason = "status %d" % r.status_code
+                if r.status_code == 400:
+                    error = ResponseProtoBuf.UserError()
+                    error.ParseFromString(r.content)
+                    reason = error.message
+                failure = UserError("Shard %d Failed: %s" % (shard, reason))
+        if failure is not None:
+            raise failure
+
+        if local:
+            group.deliverMessage(message, local)
+
+    # convert to a protobuf
+    def serialize(self):
+        shards = ResponseProtoBuf.ShardList()
+        shards.vnodes = self.vnodes
+        shards.urls.extend([self.url(shard) for shard in xrange(self.count)])
+        return shards
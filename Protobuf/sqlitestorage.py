@@ -0,0 +1,237 @@
+import os
+import sqlite3
+import threading
+import time
+from model import User, Group
+from storage import Storage
+
+#
+# A Storage backend that keeps everything in a SQLite database.
+#
+# Unlike the log, undelivered messages are never held in memory: each user's
+# queue is a SqliteQueue, which reads messages out of the database when they
+# are flushed. Only the directory (users, groups and memberships) is loaded at
+# startup.
+#
+# Messages are stored already serialized, once per message, with a row in the
+# queue table for each recipient. A group message is therefore one row in
+# messages and one (small) queue row per member, inserted in a single batch.
+# Flushing a queue reads the serialized messages in order and removes them
+# with a single range delete on (recipient, seq).
+#
+# Every statement is a constant string with parameters, so the sqlite3 module
+# prepares each one once and reuses it. Writes from all threads go into one
+# open transaction, which is committed by the first thread to call commit.
+# Everything written before that point is covered, so under load many
+# requests share a single commit.
+#
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    username TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS groups (
+    groupname TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS members (
+    groupname TEXT NOT NULL,
+    username TEXT NOT NULL,
+    PRIMARY KEY (groupname, username)
+);
+CREATE INDEX IF NOT EXISTS members_by_username ON members (username);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    wire BLOB NOT NULL
+);
+CREATE TABLE IF NOT EXISTS queue (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    recipient TEXT NOT NULL,
+    message INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS queue_by_recipient ON queue (recipient, seq);
+CREATE INDEX IF NOT EXISTS queue_by_message ON queue (message);
+"""
+
+class SqliteStorage(Storage):
+    # group messages are queued in the database for every member
+    TIMELINES = False
+
+    def __init__(self, path):
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=FULL")
+        self.db.executescript(SCHEMA)
+
+        # the connection is shared, so every use of it is under this lock.
+        # written and committed count writes, and local holds the position of
+        # the last write made by each thread.
+        self.lock = threading.Lock()
+        self.written = 0
+        self.committed = 0
+        self.local = threading.local()
+        self.loading = False
+
+    # load the directory into users and groups. Queues stay in the database.
+    def load(self, users, groups):
+        start = time.time()
+        self.loading = True
+        with self.lock:
+            usernames = [row[0] for row in self.db.execute("SELECT username FROM users")]
+            groupnames = [row[0] for row in self.db.execute("SELECT groupname FROM groups")]
+            memberships = self.db.execute("SELECT groupname, username FROM members").fetchall()
+
+        for username in usernames:
+            users.addUser(User(username.decode('utf-8')))
+        for groupname in groupnames:
+            groups.addGroup(Group(groupname.decode('utf-8')))
+        for groupname, username in memberships:
+            group = groups.getGroup(groupname.decode('utf-8'))
+            user = users.getUser(username.decode('utf-8'))
+            if group is not None and user is not None:
+                group.addUser(user)
+        self.loading = False
+
+        print "Loaded %d users and %d groups in %.3fs" % (len(usernames), len(groupnames),
+                                                         time.time() - start)
+
+    #
+    # Storage methods
+    #
+
+    def addUser(self, username):
+        self.write("INSERT OR IGNORE INTO users (username) VALUES (?)", (username,))
+
+    def deleteUser(self, username):
+        self.write("DELETE FROM users WHERE username = ?", (username,))
+        self.write("DELETE FROM members WHERE username = ?", (username,))
+
+    def addGroup(self, groupname):
+        self.write("INSERT OR IGNORE INTO groups (groupname) VALUES (?)", (groupname,))
+
+    def addMember(self, groupname, username):
+        self.write("INSERT OR IGNORE INTO members (groupname, username) VALUES (?, ?)",
+                   (groupname, username))
+
+    def sendDirectMessage(self, message):
+        with self.lock:
+            messageId = self.insertMessage(message)
+            self.db.execute("INSERT INTO queue (recipient, message) VALUES (?, ?)",
+                            (message.to.username, messageId))
+            self.wrote()
+
+    def sendGroupMessage(self, message):
+        with self.lock:
+            messageId = self.insertMessage(message)
+            self.db.executemany("INSERT INTO queue (recipient, message) VALUES (?, ?)",
+                                [(user.username, messageId) for user in message.to.users])
+            self.wrote()
+
+    def deliverMessage(self, message, usernames):
+        with self.lock:
+            messageId = self.insertMessage(message)
+            self.db.executemany("INSERT INTO queue (recipient, message) VALUES (?, ?)",
+                                [(username, messageId) for username in usernames])
+            self.wrote()
+
+    # SqliteQueue removes flushed messages itself
+    def flushMessages(self, username, count):
+        pass
+
+    def messageQueue(self, username):
+        return SqliteQueue(self, username)
+
+    # commit the open transaction, unless another thread already has since
+    # this thread last wrote
+    def commit(self):
+        position = getattr(self.local, 'position', 0)
+        with self.lock:
+            if self.committed < position:
+                self.db.commit()
+                self.committed = self.written
+
+    def close(self):
+        with self.lock:
+            self.db.commit()
+            self.db.close()
+
+    #
+    # Writing
+    #
+
+    # run a single write statement
+    def write(self, statement, parameters):
+        if self.loading:
+            return
+        with self.lock:
+            self.db.execute(statement, parameters)
+            self.wrote()
+
+    # note that this thread has written something. Must hold the lock.
+    def wrote(self):
+        self.written += 1
+        self.local.position = self.written
+
+    # store a serialized message, returning its id. Must hold the lock.
+    def insertMessage(self, message):
+        wire = sqlite3.Binary(message.serializeToString())
+        return self.db.execute("INSERT INTO messages (wire) VALUES (?)", (wire,)).lastrowid
+
+# A user's queue of undelivered messages, kept in the database. SqliteStorage
+# inserts the rows when messages are sent, so adding a message here only
+# counts it.
+class SqliteQueue(object):
+    def __init__(self, storage, username):
+        self.storage = storage
+        self.username = username
+        # the number of messages in the queue, counted when first needed
+        self.count = None
+
+    def __len__(self):
+        if self.count is None:
+            with self.storage.lock:
+                (self.count,) = self.storage.db.execute(
+                    "SELECT COUNT(*) FROM queue WHERE recipient = ?", (self.username,)).fetchone()
+        return self.count
+
+    def addMessage(self, message, queued=None):
+        if self.count is not None:
+            self.count += 1
+
+    # read the first limit (or all) messages in order, then remove them from
+    # the queue with one range delete, along with any message that is no
+    # longer queued for anyone
+    def take(self, limit=None):
+        storage = self.storage
+        with storage.lock:
+            rows = storage.db.execute(
+                "SELECT queue.seq, queue.message, messages.wire FROM queue "
+                "JOIN messages ON messages.id = queue.message "
+                "WHERE queue.recipient = ? ORDER BY queue.seq LIMIT ?",
+                (self.username, -1 if limit is None else limit)).fetchall()
+            if not rows:
+                return []
+
+            storage.db.execute("DELETE FROM queue WHERE recipient = ? AND seq <= ?",
+                               (self.username, rows[-1][0]))
+            storage.db.executemany(
+                "DELETE FROM messages WHERE id = ? AND NOT EXISTS "
+                "(SELECT 1 FROM queue WHERE queue.message = messages.id)",
+                [(messageId,) for messageId in set(row[1] for row in rows)])
+            storage.wrote()
+
+        # recount next time, as messages may have been inserted for this user
+        # that haven't been added here yet
+        self.count = None
+        return [str(row[2]) for row in rows]
+
+    def discard(self, count):
+        self.take(count)
+
+    def clear(self):
+        self.take()
@@ -0,0 +1,65 @@
+#
+# Storage for the server's users, groups and message queues.
+#
+# The collections in model.py tell their storage about every change just
+# before they make it. This base Storage doesn't keep anything, so everything
+# is lost when the server restarts. Other backends (see logstorage.py) persist
+# the changes and rebuild the collections from them at startup.
+#
+
+class Storage(object):
+    # whether large groups may keep their messages in a timeline rather than
+    # in each member's queue (see Group). Backends that keep the queues
+    # themselves (see messageQueue) store group messages for every member.
+    TIMELINES = True
+
+    # rebuild the given (empty) users and groups from what has been stored
+    def load(self, users, groups):
+        pass
+
+    # a user was created
+    def addUser(self, username):
+        pass
+
+    # a user was deleted
+    def deleteUser(self, username):
+        pass
+
+    # a group was created
+    def addGroup(self, groupname):
+        pass
+
+    # a user was added to a group
+    def addMember(self, groupname, username):
+        pass
+
+    # a message was sent to a user
+    def sendDirectMessage(self, message):
+        pass
+
+    # a message was sent to a group (and so queued for all of its members)
+    def sendGroupMessage(self, message):
+        pass
+
+    # a group message was queued for some of the group's members, the ones on
+    # this shard of a sharded server (see sharding.py)
+    def deliverMessage(self, message, usernames):
+        pass
+
+    # count messages were removed from the front of a user's queue, because
+    # they were delivered, expired or dropped to make room
+    def flushMessages(self, username, count):
+        pass
+
+    # the queue to keep a user's undelivered messages in, or None to keep them
+    # in memory in a MessageList
+    def messageQueue(self, username):
+        return None
+
+    # block until all of the changes made by the calling thread are durable
+    def commit(self):
+        pass
+
+    # write out anything outstanding and stop
+    def close(self):
+        pass
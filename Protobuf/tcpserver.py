@@ -0,0 +1,210 @@
+import socket
+import threading
+import traceback
+from build.protobufs import request_pb2 as RequestProtoBuf
+from build.protobufs import response_pb2 as ResponseProtoBuf
+from google.protobuf.message import DecodeError
+from asyncserver import Wait
+from compression import ENCODINGS, decompress
+from model import UserError
+from wire import FRAME_HEADER, frame
+
+#
+# A second transport for the chat API, selected with --tcp-port: a plain TCP
+# connection carrying frames (see wire.py) rather than HTTP requests.
+#
+# The client sends Envelopes, each naming an operation and carrying a request
+# id, and the server answers each with a Reply carrying the same id. A client
+# doesn't have to wait for one answer before sending the next request
+# (pipelining): we handle every complete request that has arrived in order,
+# wait for their changes to be stored once, and send all their answers in one
+# write. A SUBSCRIBE request makes the server push the user's messages down the
+# connection as they arrive, as Replies with the PUSH status.
+#
+# Payloads may be compressed: an Envelope's contentEncoding and acceptEncoding
+# say how its payload is compressed and how its Reply's may be, like the HTTP
+# headers (see compression.py).
+#
+# There is a thread per connection, plus one per subscription. The operations
+# themselves are the server's (see TCP_OPERATIONS in server.py), which use the
+# same handlers as the HTTP endpoints.
+#
+
+# The most bytes of request we accept in one frame
+MAX_FRAME_BYTES = 16 * 1024 * 1024
+
+# How much to read from a connection at a time
+RECV_BYTES = 64 * 1024
+
+# How many connections may be waiting to be accepted
+LISTEN_BACKLOG = 1024
+
+Envelope = RequestProtoBuf.Envelope
+Reply = ResponseProtoBuf.Reply
+
+# the serialized Reply for a request, with payload compressed with encoding
+# if compressor thinks it's worth it
+def reply(id, status, payload='', encoding=None, compressor=None):
+    answer = Reply(id=id, status=status, payload=payload)
+    if compressor is not None:
+        compressed = compressor.compress(payload, encoding)
+        if compressed is not None:
+            answer.payload = compressed
+            answer.contentEncoding = encoding
+    return frame(answer.SerializeToString())
+
+#
+# The server takes:
+#
+#   handle(envelope)     - runs a request, returning the serialized response
+#                          or raising a UserError
+#   subscribe(envelope)  - for SUBSCRIBE, returns an iterator of serialized
+#                          MessageLists to push, and Waits to block on until
+#                          there are more, or raises a UserError
+#   commit()             - waits for the changes made on this thread to be
+#                          stored
+#
+# and optionally a Compressor for the payloads of Replies.
+#
+class TcpServer(object):
+    def __init__(self, host, port, handle, subscribe, commit, compressor=None):
+        self.handle = handle
+        self.subscribe = subscribe
+        self.commit = commit
+        self.compressor = compressor
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(LISTEN_BACKLOG)
+
+    # accept connections on a background thread
+    def start(self):
+        thread = threading.Thread(target=self.serve, name='tcp')
+        thread.daemon = True
+        thread.start()
+
+    def serve(self):
+        while True:
+            sock, _ = self.listener.accept()
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            thread = threading.Thread(target=Connection(self, sock).run)
+            thread.daemon = True
+            thread.start()
+
+class Connection(object):
+    def __init__(self, server, sock):
+        self.server = server
+        self.sock = sock
+        # held while writing, as subscriptions push from their own threads
+        self.writeLock = threading.Lock()
+        self.closed = False
+        # the Waits subscriptions are blocked on, so closing can wake them
+        self.waits = set()
+
+    def run(self):
+        try:
+            buffered = ''
+            while True:
+                data = self.sock.recv(RECV_BYTES)
+                if not data:
+                    return
+                buffered += data
+
+                # handle every complete request we have, then answer them all
+                replies = []
+                start = 0
+                while len(buffered) - start >= FRAME_HEADER.size:
+                    (length,) = FRAME_HEADER.unpack_from(buffered, start)
+                    if length > MAX_FRAME_BYTES:
+                        return
+                    end = start + FRAME_HEADER.size + length
+                    if len(buffered) < end:
+                        break
+                    replies.append(self.request(buffered[start + FRAME_HEADER.size:end]))
+                    start = end
+                buffered = buffered[start:]
+
+                if replies:
+                    self.server.commit()
+                    self.send(''.join(replies))
+        except socket.error:
+            return
+        finally:
+            self.close()
+
+    # runs one request, returning its serialized Reply
+    def request(self, payload):
+        envelope = Envelope()
+        try:
+            envelope.ParseFromString(payload)
+        except DecodeError:
+            error = UserError("Invalid Envelope Protocol Buffer")
+            return reply(0, Reply.USER_ERROR, error.serialize().SerializeToString())
+
+        encoding = envelope.acceptEncoding if envelope.acceptEncoding in ENCODINGS else None
+        try:
+            if envelope.contentEncoding:
+                try:
+                    envelope.payload = decompress(envelope.payload, envelope.contentEncoding,
+                                                  MAX_FRAME_BYTES)
+                except ValueError:
+                    raise UserError("Invalid Content Encoding")
+                envelope.ClearField('contentEncoding')
+
+            if envelope.op == Envelope.SUBSCRIBE:
+                self.startPushing(envelope.id, self.server.subscribe(envelope), encoding)
+                return reply(envelope.id, Reply.OK)
+            return reply(envelope.id, Reply.OK, self.server.handle(envelope), encoding,
+                         self.server.compressor)
+        except UserError as ue:
+            return reply(envelope.id, Reply.USER_ERROR, ue.serialize().SerializeToString())
+        except Exception:
+            traceback.print_exc()
+            return reply(envelope.id, Reply.SERVER_ERROR)
+
+    def startPushing(self, id, payloads, encoding):
+        thread = threading.Thread(target=self.push, args=(id, payloads, encoding))
+        thread.daemon = True
+        thread.start()
+
+    # Sends each MessageList from payloads as it comes, until the subscription
+    # or the connection ends. Asking payloads for the next MessageList takes
+    # it off the user's queue, so once the connection has closed we stop
+    # before asking rather than throw it away.
+    def push(self, id, payloads, encoding):
+        try:
+            for payload in payloads:
+                if isinstance(payload, Wait):
+                    if not self.block(payload):
+                        return
+                elif payload:
+                    self.server.commit()
+                    self.send(reply(id, Reply.PUSH, payload, encoding, self.server.compressor))
+        except socket.error:
+            self.close()
+
+    # Blocks on a Wait, returning False (straight away if need be) if the
+    # connection closes. The check is made holding the user's lock, which
+    # close takes to wake us, so a close can't slip in before we wait.
+    def block(self, wait):
+        with wait.user.messageAvailable:
+            if self.closed:
+                return False
+            self.waits.add(wait)
+            try:
+                wait.block()
+            finally:
+                self.waits.discard(wait)
+            return not self.closed
+
+    def send(self, data):
+        with self.writeLock:
+            self.sock.sendall(data)
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            self.sock.close()
+            for wait in list(self.waits):
+                with wait.user.messageAvailable:
+                    wait.user.messageAvailable.notify_all()
@@ -0,0 +1,176 @@
+import struct
+from itertools import islice
+
+#
+# Helpers for putting protobufs on the wire.
+#
+# Protobufs are not self delimiting, so when we send more than one of them down
+# the same stream (e.g. the streaming message endpoint) each one is written as
+# a frame: a 4 byte big-endian length followed by that many bytes of serialized
+# protobuf.
+#
+# We also encode some protobufs by hand. A repeated message field is just each
+# element's serialized bytes prefixed with the field key and length, so if we
+# already have the elements serialized we can splice them together without
+# going through the protobuf library again. Listings of users and groups skip
+# the protobuf library altogether (see encodeWrapped), as building a protobuf
+# for each element, copying it into the list and then serializing the list
+# costs far more than the bytes themselves. Going the other way, splitField
+# takes a field back out of a serialized protobuf (see
+# MessageList.indexSenders).
+#
+
+FRAME_HEADER = struct.Struct('>I')
+
+# wrap a serialized protobuf in a frame
+def frame(payload):
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+# read exactly n bytes from a file-like object, returning None if the stream
+# ends first
+def readExactly(stream, n):
+    chunks = []
+    while n > 0:
+        chunk = stream.read(n)
+        if not chunk:
+            return None
+        chunks.append(chunk)
+        n -= len(chunk)
+    return ''.join(chunks)
+
+# read a single frame from a file-like object and return its payload (or None
+# when the stream has been closed)
+def readFrame(stream):
+    header = readExactly(stream, FRAME_HEADER.size)
+    if header is None:
+        return None
+    (length,) = FRAME_HEADER.unpack(header)
+    return readExactly(stream, length)
+
+# encode a non-negative integer as a protobuf varint
+def encodeVarint(value):
+    if value <= 0x7f:
+        return chr(value)
+    out = []
+    while value > 0x7f:
+        out.append(chr(0x80 | (value & 0x7f)))
+        value >>= 7
+    out.append(chr(value))
+    return ''.join(out)
+
+# the key for a length delimited field (wire type 2) with the given number
+def fieldKey(number):
+    return encodeVarint(number << 3 | 2)
+
+# the field number of a field on a protobuf message class
+def fieldNumber(proto, name):
+    return proto.DESCRIPTOR.fields_by_name[name].number
+
+# encode a string field
+def encodeString(number, value):
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return fieldKey(number) + encodeVarint(len(value)) + value
+
+# encode an unsigned integer field (wire type 0)
+def encodeUint(number, value):
+    return encodeVarint(number << 3) + encodeVarint(value)
+
+# decode the varint starting at position in data, returning its value and
+# the position after it
+def decodeVarint(data, position):
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(data[position])
+        position += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, position
+        shift += 7
+
+# Finds the first length delimited field numbered number in a serialized
+# protobuf. Returns its contents and the protobuf without the field, or None
+# and the protobuf as it was if it isn't there.
+def splitField(data, number):
+    position = 0
+    while position < len(data):
+        key, start = decodeVarint(data, position)
+        wireType = key & 7
+        if wireType == 0:
+            _, end = decodeVarint(data, start)
+        elif wireType == 1:
+            end = start + 8
+        elif wireType == 2:
+            length, start = decodeVarint(data, start)
+            end = start + length
+            if key >> 3 == number:
+                return data[start:end], data[:position] + data[end:]
+        elif wireType == 5:
+            end = start + 4
+        else:
+            raise ValueError("Unsupported wire type %d" % wireType)
+        position = end
+    return None, data
+
+# encode already serialized elements as a repeated message field
+def encodeRepeated(number, payloads):
+    key = fieldKey(number)
+    parts = []
+    append = parts.append
+    for payload in payloads:
+        append(key)
+        append(encodeVarint(len(payload)))
+        append(payload)
+    return ''.join(parts)
+
+# Encode values as a repeated message field, where each element is a message
+# with just one string field set, numbered inner. A User is just its username,
+# so a list of users is encodeWrapped(users field, username field, usernames).
+#
+# Every element is written straight into one list of parts, which is joined
+# once at the end, so each name is copied only into the result. Everything
+# before a short name depends only on its length, so that is looked up.
+def encodeWrapped(number, inner, values):
+    prefixes = wrappedPrefixes(number, inner)
+    short = len(prefixes)
+    parts = []
+    append = parts.append
+    for value in values:
+        if isinstance(value, unicode):
+            value = value.encode('utf-8')
+        length = len(value)
+        if length < short:
+            append(prefixes[length])
+        else:
+            append(wrappedPrefix(number, inner, length))
+        append(value)
+    return ''.join(parts)
+
+# the bytes before a value of the given length in encodeWrapped
+def wrappedPrefix(number, inner, length):
+    innerKey = fieldKey(inner)
+    size = encodeVarint(length)
+    return (fieldKey(number) + encodeVarint(len(innerKey) + len(size) + length) +
+            innerKey + size)
+
+# the prefixes for values short enough for their lengths to fit in a byte,
+# indexed by length
+_prefixes = {}
+
+def wrappedPrefixes(number, inner):
+    prefixes = _prefixes.get((number, inner))
+    if prefixes is None:
+        prefixes = _prefixes[number, inner] = [wrappedPrefix(number, inner, length)
+                                               for length in xrange(0x7f - 2)]
+    return prefixes
+
+# split an iterator into lists of at most limit items. Each page is yielded
+# along with whether there is another page after it.
+def paginate(items, limit):
+    items = iter(items)
+    page = list(islice(items, limit))
+    while page:
+        following = list(islice(items, limit))
+        yield page, len(following) > 0
+        page = following